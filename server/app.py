@@ -1,7 +1,9 @@
 import os
 
-from flask import Flask
+from flask import Flask, Response
 
+import business_logic as bl
+import metrics
 from settings import UPLOAD_FOLDER
 from urls import urls_blueprint
 
@@ -14,9 +16,20 @@ host = app.config.get('HOST')
 
 app.register_blueprint(urls_blueprint, url_prefix='/api')
 
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text exposition format, metrics of all workers if METRICS_DIRECTORY is set, else of this process
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Development server, in production the app is served by gunicorn (gunicorn.conf.py)
 if __name__ == '__main__':
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
+    # The reloader of the debug mode runs the app in a child process
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        bl.start_worker()
     app.run(
         port=port,
         debug=debug,
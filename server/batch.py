@@ -0,0 +1,178 @@
+import psycopg2
+
+from business_logic import (db, photos, PARENTS, PHOTO_PATH_ERROR, check_fields, insert_columns, invalidate_record,
+                            is_id, normalize_data, update_record)
+from validation import validate_data
+from db_settings import DB_TABLES
+from settings import BATCH_MAX_OPERATIONS
+
+OPERATIONS = ('create', 'update', 'delete')
+
+
+class Rollback(Exception):
+    # Raised in the batch transaction to roll it back without an error of the database
+    pass
+
+
+def check_operation(operation):
+    """
+    Check the shape of an operation and validate its data with the rules of DB_TABLES.
+    :param operation: dict {'op': 'create' | 'update' | 'delete', 'table': table name,
+    'id': id of updated or deleted record, 'data': dict with fields of created or updated record}.
+    :return: dict of errors, empty if the operation is valid.
+    """
+    if not isinstance(operation, dict):
+        return {'operation': 'Operation should be an object'}
+    op = operation.get('op')
+    table_name = operation.get('table')
+    if op not in OPERATIONS:
+        return {'op': '\'op\' field should be one of this values: [{}]'.format(', '.join(OPERATIONS))}
+    if table_name not in DB_TABLES:
+        return {'table': '\'table\' field should be one of this values: [{}]'.format(', '.join(DB_TABLES))}
+    record_id = operation.get('id')
+    if op != 'create' and not is_id(record_id):
+        return {'id': '\'id\' field should be an integer'}
+    if op == 'delete':
+        return {}
+    data = operation.get('data')
+    if not isinstance(data, dict) or not data:
+        return {'data': '\'data\' field should be a non-empty object'}
+    unknown = check_fields(data, table_name)
+    if unknown:
+        return unknown
+    if table_name == 'users' and 'photo_path' in data:
+        return {'photo_path': PHOTO_PATH_ERROR}
+    if table_name in PARENTS:
+        foreign_key = PARENTS[table_name][1]
+        if foreign_key in data and not is_id(data[foreign_key]):
+            return {foreign_key: '\'{}\' field should be an integer'.format(foreign_key)}
+    if op == 'create':
+        if table_name == 'users':
+            # Photos are uploaded with PUT /users/ only, as in import
+            data.setdefault('photo_path', '')
+        columns = DB_TABLES[table_name]['required']
+    else:
+        columns = data.keys()
+    is_valid, errors = validate_data(data=data, columns=columns, table_name=table_name)
+    return errors
+
+
+def group_operations(operations):
+    """
+    Split operations into groups that are executed with one statement: runs of creates of records
+    with the same fields in one table and runs of deletes in one table. Updates are executed one by one.
+    :return: list of (op, table name, list of indexes of operations).
+    """
+    groups = []
+    last_key = None
+    for i, operation in enumerate(operations):
+        op = operation['op']
+        key = (op, operation['table'], frozenset(operation['data']) if op == 'create' else None)
+        if op != 'update' and key == last_key:
+            groups[-1][2].append(i)
+        else:
+            groups.append((op, operation['table'], [i]))
+        last_key = key
+    return groups
+
+
+def check_parents(operations, errors):
+    # Child records can reference existing parents only, ids of records created in the batch are not known yet
+    for table_name, (parent_table, foreign_key) in PARENTS.items():
+        referencing = [i for i, operation in enumerate(operations)
+                       if operation['table'] == table_name and foreign_key in operation.get('data', {})]
+        if not referencing:
+            continue
+        existing = db.existing_values(parent_table, 'id', {operations[i]['data'][foreign_key] for i in referencing})
+        for i in referencing:
+            if operations[i]['data'][foreign_key] not in existing:
+                errors[i] = {foreign_key: 'Invalid {}'.format(foreign_key)}
+
+
+def create_records(table_name, operations, indexes, results):
+    records = [normalize_data(operations[i]['data'], table_name) for i in indexes]
+    # Columns are fixed by the table, data of creates is checked to have exactly the required fields
+    column_names = insert_columns(table_name)
+    # Ids are returned in order of records
+    created = db.insert(table_name=table_name, column_names=column_names, values=records)
+    for i, record, new_record in zip(indexes, records, created):
+        if table_name in PARENTS:
+            # Parent may be cached with embedded children
+            invalidate_record(table_name, new_record['id'], parent_id=record[PARENTS[table_name][1]])
+        results[i] = {'info': 'Created', 'id': new_record['id']}
+
+
+def delete_records(table_name, operations, indexes, results):
+    foreign_key = PARENTS[table_name][1] if table_name in PARENTS else None
+    returning = 'id, {}'.format(foreign_key) if foreign_key else 'id, photo_path'
+    deleted = {record['id']: record
+               for record in db.delete_many(table_name=table_name, ids=[operations[i]['id'] for i in indexes],
+                                            returning=returning)}
+    for i in indexes:
+        record = deleted.pop(operations[i]['id'], None)
+        if record is None:
+            results[i] = {'info': 'Doesn\'t removed.  No record with such id.'}
+            continue
+        if foreign_key:
+            invalidate_record(table_name, record['id'], parent_id=record[foreign_key])
+        else:
+            # Emails and phones of the user are deleted by cascade, the photo is removed after commit
+            invalidate_record(table_name, record['id'], cascade=True)
+            db.on_commit(lambda photo_path=record['photo_path']: photos.release(photo_path))
+        results[i] = {'info': 'Deleted'}
+
+
+def execute_batch(operations):
+    """
+    Validate a list of operations and execute them in order in one transaction.
+    Nothing is changed if any operation is invalid or is rejected by the database.
+    :param operations: list of operation dicts, see check_operation.
+    :return: dict with per-operation results (or errors) in order of operations.
+    """
+    batch_result = {}
+    if not isinstance(operations, list) or not operations:
+        batch_result['info'] = '\'operations\' should be a non-empty list'
+        return batch_result
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        batch_result['info'] = 'Batch should have {} operations or less'.format(BATCH_MAX_OPERATIONS)
+        return batch_result
+
+    errors = {}
+    for i, operation in enumerate(operations):
+        operation_errors = check_operation(operation)
+        if operation_errors:
+            errors[i] = operation_errors
+    results = [None] * len(operations)
+    if not errors:
+        group = None
+        try:
+            with db.transaction():
+                check_parents(operations, errors)
+                if errors:
+                    raise Rollback()
+                for group in group_operations(operations):
+                    op, table_name, indexes = group
+                    if op == 'create':
+                        create_records(table_name, operations, indexes, results)
+                    elif op == 'delete':
+                        delete_records(table_name, operations, indexes, results)
+                    else:
+                        i = indexes[0]
+                        updated_ids = update_record(table_name, operations[i]['id'], operations[i]['data'])
+                        results[i] = {'info': 'Updated' if updated_ids else
+                                      'Doesn\'t updated.  No record with such id.'}
+        except Rollback:
+            pass
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            # The error is reported for operations of the failed statement
+            for i in group[2] if group else range(len(operations)):
+                errors[i] = {'database': e.pgerror or str(e)}
+
+    if errors:
+        batch_result['info'] = 'Invalid data'
+        batch_result['results'] = [{'errors': errors[i]} if i in errors else {'info': 'Not executed'}
+                                   for i in range(len(operations))]
+    else:
+        batch_result['info'] = 'Done'
+        batch_result['results'] = results
+    return batch_result
@@ -0,0 +1,68 @@
+import argparse
+import json
+import sys
+
+# Metric -> True if a higher value is better
+METRICS = {
+    'throughput': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+}
+
+
+def compare(baseline, current, threshold):
+    """
+    Compare results of two runs benchmark by benchmark.
+    :param threshold: float, relative change of a metric (0.1 is 10%) that is reported as a regression.
+    :return: (list of rows (benchmark, metric, baseline value, current value, change, is regression),
+    list of names of benchmarks missing in one of the runs).
+    """
+    rows = []
+    missing = sorted(set(baseline['results']) ^ set(current['results']))
+    for name, base_result in baseline['results'].items():
+        result = current['results'].get(name)
+        if result is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            base_value = base_result.get(metric)
+            value = result.get(metric)
+            if not base_value or value is None:
+                continue
+            change = (value - base_value) / base_value
+            is_regression = -change > threshold if higher_is_better else change > threshold
+            rows.append((name, metric, base_value, value, change, is_regression))
+    return rows, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark results and flag regressions.')
+    parser.add_argument('baseline', help='json results of the baseline run')
+    parser.add_argument('current', help='json results of the new run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    if baseline.get('kind') != current.get('kind'):
+        raise SystemExit('Results of different kinds: {} and {}'.format(baseline.get('kind'), current.get('kind')))
+
+    print('baseline: {} ({}), current: {} ({})'.format(baseline.get('commit'), baseline.get('created_at'),
+                                                        current.get('commit'), current.get('created_at')))
+    rows, missing = compare(baseline, current, args.threshold)
+    print('{:<32} {:<10} {:>12} {:>12} {:>8}'.format('benchmark', 'metric', 'baseline', 'current', 'change'))
+    for name, metric, base_value, value, change, is_regression in rows:
+        print('{:<32} {:<10} {:>12.3f} {:>12.3f} {:>+7.1f}% {}'.format(
+            name, metric, base_value, value, change * 100, 'REGRESSION' if is_regression else ''))
+    if missing:
+        print('Benchmarks missing in one of the runs: {}'.format(', '.join(missing)))
+    regressions = [row for row in rows if row[5]]
+    if regressions:
+        print('{} regressions'.format(len(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
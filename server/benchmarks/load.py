@@ -0,0 +1,449 @@
+import argparse
+import collections
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results import summarize, save_results, print_results  # noqa: E402
+
+# Route name -> weight in the mix, approximates traffic of the address book clients.
+# Streams read a range of ids, exports read whole tables, so they are rare.
+# Written users belong to the benchmark, emails and phones are written to them or removed at the end
+MIX = {
+    'users page': 15,
+    'users page sorted': 10,
+    'users page embed': 5,
+    'user': 20,
+    'user embed': 10,
+    'emails page': 4,
+    'phones page': 4,
+    'email': 5,
+    'phone': 5,
+    'search': 8,
+    'email lookup': 4,
+    'phone lookup': 4,
+    'batch create emails': 2,
+    'update email': 2,
+    'delete email': 2,
+    'create user': 1,
+    'update user': 2,
+    'update user photo': 1,
+    'delete user': 1,
+    'import users': 1,
+    'create email': 2,
+    'create phone': 2,
+    'update phone': 2,
+    'delete phone': 1,
+    'user photo': 3,
+    'photo': 3,
+    'sync': 2,
+    'stats': 1,
+    'cache stats': 1,
+    'metrics': 1,
+    'users stream': 1,
+    'emails stream': 1,
+    'users export': 0.1,
+    'emails export': 0.1,
+    'phones export': 0.1,
+}
+# Records of the benchmark made before requests that need them, out of measured time
+OWNED_BATCH_SIZE = 10
+# Ids read by a stream request
+STREAM_ID_RANGE = 1000
+SYNC_PAGE_SIZE = 100
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def png_photo(rnd, size=64):
+    """
+    Random RGB png, photos of different users are different files of the storage.
+    :return: bytes.
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + bytes(rnd.getrandbits(8) for _ in range(size * 3)) for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def multipart(form, files):
+    """
+    Encode a multipart/form-data body.
+    :param files: dict {field: (file name, bytes)}.
+    :return: (body bytes, content type).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in form.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, name, value).encode())
+    for name, (file_name, content) in files.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, file_name).encode()
+                     + content + b'\r\n')
+    parts.append('--{}--\r\n'.format(boundary).encode())
+    return b''.join(parts), 'multipart/form-data; boundary={}'.format(boundary)
+
+
+class Client:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, params=None, form=None, body=None, files=None, data=None, content_type=None,
+                api=True):
+        """
+        Send a request to the api.
+        :param files: dict {field: (file name, bytes)}, sent with the form as multipart/form-data.
+        :param data: bytes of the body with content_type.
+        :param api: bool, path is a path of the api, otherwise of the server (e.g. /metrics).
+        :return: (http status, response body bytes).
+        """
+        url = '{}{}{}'.format(self.base_url, '/api' if api else '', path)
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        headers = {}
+        if files is not None:
+            data, headers['Content-Type'] = multipart(form or {}, files)
+        elif data is not None:
+            headers['Content-Type'] = content_type
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(url, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Scenario:
+    def __init__(self, client, sample_size, seed):
+        """
+        Requests of the mix. Ids and search terms are sampled from existing data,
+        written records belong to the benchmark and are removed at the end.
+        """
+        self.client = client
+        self.random = random.Random(seed)
+        self.users = self.sample('users', sample_size)
+        self.emails = self.sample('emails', sample_size)
+        self.phones = self.sample('phones', sample_size)
+        if not self.users:
+            raise SystemExit('No users in the database, generate data with scripts/generate_data.py first')
+        self.owned_emails = collections.deque()
+        self.owned_users = collections.deque()
+        self.owned_phones = collections.deque()
+        # (user id, photo key) of users with uploaded photos, they aren't deleted by the mix
+        self.photo_users = []
+        self.sync_token = None
+        # Emails of users created by routes that don't return ids, users are found by them on cleanup
+        self.marker_emails = []
+        self.run_id = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+
+    def sample(self, table_name, sample_size):
+        status, body = self.client.request('POST', '/{}/'.format(table_name), params={'limit': sample_size})
+        if status != 200:
+            raise SystemExit('Can\'t read {}: {} {}'.format(table_name, status, body[:200]))
+        return json.loads(body)[table_name]
+
+    def user_data(self, rnd):
+        return {
+            'name': 'Load {}'.format(''.join(rnd.choice(LETTERS) for _ in range(10))).title(),
+            'gender': rnd.choice(['male', 'female']),
+            'born_at': '{}-{:02d}-{:02d}'.format(rnd.randint(1950, 2010), rnd.randint(1, 12), rnd.randint(1, 28)),
+            'address': '{} Benchmark street'.format(rnd.randint(1, 999)),
+        }
+
+    def marker_email(self, rnd):
+        email = 'load-{}-{}@example.org'.format(self.run_id, rnd.randint(0, 10 ** 12))
+        with self.lock:
+            self.marker_emails.append(email)
+        return email
+
+    def phone_number(self, rnd):
+        return '+7900{:07d}'.format(rnd.randint(0, 10 ** 7 - 1))
+
+    def create_owned(self, table_name, operations, owned):
+        status, body = self.client.request('POST', '/batch/', body={'operations': [
+            {'op': 'create', 'table': table_name, 'data': data} for data in operations]})
+        if status != 200:
+            return
+        with self.lock:
+            owned.extend(result['id'] for result in json.loads(body)['results'] if 'id' in result)
+
+    def owned_user(self):
+        with self.lock:
+            if not self.owned_users:
+                return None
+            user_id = self.owned_users.popleft()
+            self.owned_users.append(user_id)
+            return user_id
+
+    def prepare(self, name, rnd):
+        # Records the route writes to are made out of measured time
+        if name in ('update user', 'update user photo', 'delete user', 'create email', 'create phone',
+                    'update phone', 'delete phone') and len(self.owned_users) < OWNED_BATCH_SIZE:
+            self.create_owned('users', [self.user_data(rnd) for _ in range(OWNED_BATCH_SIZE)], self.owned_users)
+        if name in ('update phone', 'delete phone') and not self.owned_phones:
+            self.create_owned('phones', [{'user_id': self.owned_user(), 'type': 'mobile',
+                                          'number': self.phone_number(rnd)} for _ in range(OWNED_BATCH_SIZE)],
+                              self.owned_phones)
+        if name in ('user photo', 'photo') and not self.photo_users:
+            self.upload_photo(rnd)
+
+    def upload_photo(self, rnd):
+        users = collections.deque()
+        self.create_owned('users', [self.user_data(rnd)], users)
+        for user_id in users:
+            self.client.request('PATCH', '/users/{}/'.format(user_id), form={},
+                                files={'photo': ('photo.png', png_photo(rnd))})
+            status, body = self.client.request('POST', '/users/{}/'.format(user_id))
+            if status == 200:
+                with self.lock:
+                    self.photo_users.append((user_id, json.loads(body)['user'][0]['photo_path']))
+
+    def run(self, name, rnd):
+        user = rnd.choice(self.users)
+        if name == 'users page':
+            return self.client.request('POST', '/users/', params={'limit': 100})
+        if name == 'users page sorted':
+            return self.client.request('POST', '/users/', params={rnd.choice(['name', 'born_at']): 'asc',
+                                                                  'limit': 100})
+        if name == 'users page embed':
+            return self.client.request('POST', '/users/', params={'include': 'emails,phones', 'limit': 100})
+        if name == 'user':
+            return self.client.request('POST', '/users/{}/'.format(user['id']))
+        if name == 'user embed':
+            return self.client.request('POST', '/users/{}/'.format(user['id']), params={'include': 'emails,phones'})
+        if name in ('emails page', 'phones page'):
+            return self.client.request('POST', '/{}/'.format(name.split()[0]), params={'limit': 100})
+        if name == 'email' and self.emails:
+            return self.client.request('POST', '/emails/{}/'.format(rnd.choice(self.emails)['id']))
+        if name == 'phone' and self.phones:
+            return self.client.request('POST', '/phones/{}/'.format(rnd.choice(self.phones)['id']))
+        if name == 'search':
+            return self.client.request('POST', '/search/', params={'q': user['name'][:rnd.randint(3, 8)]})
+        if name == 'email lookup' and self.emails:
+            return self.client.request('POST', '/emails/lookup/', params={'email': rnd.choice(self.emails)['email']})
+        if name == 'phone lookup' and self.phones:
+            return self.client.request('POST', '/phones/lookup/',
+                                       params={'number': rnd.choice(self.phones)['number']})
+        if name == 'batch create emails':
+            operations = [{'op': 'create', 'table': 'emails',
+                           'data': {'user_id': user['id'], 'type': 'work',
+                                    'email': 'load{}@example.org'.format(rnd.randint(0, 10 ** 9))}}
+                          for _ in range(5)]
+            status, body = self.client.request('POST', '/batch/', body={'operations': operations})
+            if status == 200:
+                created = [result['id'] for result in json.loads(body).get('results') or [] if 'id' in result]
+                with self.lock:
+                    self.owned_emails.extend(created)
+            return status, body
+        if name in ('update email', 'delete email'):
+            with self.lock:
+                email_id = self.owned_emails.popleft() if self.owned_emails else None
+            if email_id is None:
+                return None
+            if name == 'delete email':
+                return self.client.request('DELETE', '/emails/{}/'.format(email_id))
+            result = self.client.request('PATCH', '/emails/{}/'.format(email_id), form={'type': 'personal'})
+            with self.lock:
+                self.owned_emails.append(email_id)
+            return result
+        if name == 'create user':
+            form = dict(self.user_data(rnd),
+                        emails=json.dumps([{'type': 'personal', 'email': self.marker_email(rnd)}]),
+                        phones=json.dumps([{'type': 'mobile', 'number': self.phone_number(rnd)}]))
+            return self.client.request('PUT', '/users/', form=form, files={'photo': ('photo.png', png_photo(rnd))})
+        if name == 'update user':
+            return self.client.request('PATCH', '/users/{}/'.format(self.owned_user()),
+                                       form={'address': '{} Benchmark avenue'.format(rnd.randint(1, 999))})
+        if name == 'update user photo':
+            return self.client.request('PATCH', '/users/{}/'.format(self.owned_user()), form={},
+                                       files={'photo': ('photo.png', png_photo(rnd))})
+        if name == 'delete user':
+            with self.lock:
+                user_id = self.owned_users.pop() if self.owned_users else None
+            if user_id is None:
+                return None
+            return self.client.request('DELETE', '/users/{}/'.format(user_id))
+        if name == 'import users':
+            lines = [json.dumps(dict(self.user_data(rnd), emails=[{'type': 'work', 'email': self.marker_email(rnd)}],
+                                     phones=[{'type': 'city', 'number': self.phone_number(rnd)}]))
+                     for _ in range(5)]
+            return self.client.request('PUT', '/users/import/', data='\n'.join(lines).encode(),
+                                       content_type='application/x-ndjson')
+        if name == 'create email':
+            return self.client.request('PUT', '/emails/', form={
+                'user_id': self.owned_user(), 'type': 'work',
+                'email': 'load{}@example.org'.format(rnd.randint(0, 10 ** 9))})
+        if name == 'create phone':
+            return self.client.request('PUT', '/phones/', form={'user_id': self.owned_user(), 'type': 'city',
+                                                                'number': self.phone_number(rnd)})
+        if name in ('update phone', 'delete phone'):
+            with self.lock:
+                phone_id = self.owned_phones.popleft() if self.owned_phones else None
+            if phone_id is None:
+                return None
+            if name == 'delete phone':
+                return self.client.request('DELETE', '/phones/{}/'.format(phone_id))
+            result = self.client.request('PATCH', '/phones/{}/'.format(phone_id),
+                                         form={'number': self.phone_number(rnd)})
+            with self.lock:
+                self.owned_phones.append(phone_id)
+            return result
+        if name == 'user photo' and self.photo_users:
+            # Redirected to the content-addressed url of the photo
+            return self.client.request('GET', '/users/{}/photo/'.format(rnd.choice(self.photo_users)[0]),
+                                       params={'size': 'small'})
+        if name == 'photo' and self.photo_users:
+            return self.client.request('GET', '/photos/{}'.format(rnd.choice(self.photo_users)[1]),
+                                       params={'size': rnd.choice(['small', 'medium', 'original'])})
+        if name == 'sync':
+            # One client syncing page by page, then incrementally from the watermark of the finished sync
+            with self.lock:
+                params = {'limit': SYNC_PAGE_SIZE, 'token': self.sync_token} if self.sync_token else {
+                    'limit': SYNC_PAGE_SIZE}
+            status, body = self.client.request('POST', '/sync/', params=params)
+            if status == 200:
+                with self.lock:
+                    self.sync_token = json.loads(body).get('next') or self.sync_token
+            return status, body
+        if name == 'stats':
+            return self.client.request('POST', '/stats/')
+        if name == 'cache stats':
+            return self.client.request('POST', '/cache/')
+        if name == 'metrics':
+            return self.client.request('GET', '/metrics', api=False)
+        if name in ('users stream', 'emails stream'):
+            table_name = name.split()[0]
+            low = user['id'] if table_name == 'users' else rnd.choice(self.emails or [user])['id']
+            return self.client.request('POST', '/{}/'.format(table_name), params={
+                'format': 'ndjson', 'id__range': '{},{}'.format(low, low + STREAM_ID_RANGE)})
+        if name in ('users export', 'emails export', 'phones export'):
+            return self.client.request('POST', '/{}/export/'.format(name.split()[0]), params={'gzip': '1'})
+        return None
+
+    def cleanup(self):
+        while self.owned_emails:
+            ids = [self.owned_emails.popleft() for _ in range(min(len(self.owned_emails), 500))]
+            self.client.request('POST', '/batch/',
+                                body={'operations': [{'op': 'delete', 'table': 'emails', 'id': email_id}
+                                                     for email_id in ids]})
+        for email in self.marker_emails:
+            status, body = self.client.request('POST', '/emails/lookup/', params={'email': email})
+            if status == 200:
+                self.owned_users.extend(user['id'] for user in json.loads(body).get('users') or [])
+        # Emails and phones of the users are deleted by cascade
+        users = list(set(self.owned_users) | {user_id for user_id, _ in self.photo_users})
+        for i in range(0, len(users), 500):
+            self.client.request('POST', '/batch/',
+                                body={'operations': [{'op': 'delete', 'table': 'users', 'id': user_id}
+                                                     for user_id in users[i:i + 500]]})
+
+
+def worker(scenario, mix, seed, deadline, samples, errors, lock):
+    rnd = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.monotonic() < deadline:
+        name = rnd.choices(names, weights)[0]
+        try:
+            scenario.prepare(name, rnd)
+        except (OSError, ValueError):
+            continue
+        started_at = time.perf_counter()
+        try:
+            result = scenario.run(name, rnd)
+        except (OSError, ValueError):
+            result = (0, b'')
+        latency = time.perf_counter() - started_at
+        if result is None:
+            continue
+        with lock:
+            samples[name].append(latency)
+            if not 200 <= result[0] < 300:
+                errors[name] += 1
+
+
+def parse_mix(values):
+    mix = dict(MIX)
+    for value in values or []:
+        name, _, weight = value.rpartition('=')
+        if name not in mix:
+            raise SystemExit('Unknown route {}, known routes: {}'.format(name, ', '.join(MIX)))
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def positive(value):
+    value = float(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('should be positive')
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a mix of api requests and report throughput and latency.')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--duration', type=positive, default=30, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of client threads')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of requests before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sample-size', type=int, default=1000, help='records read to pick ids and search terms')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a response')
+    parser.add_argument('--mix', action='append', metavar='ROUTE=WEIGHT', help='change weight of a route')
+    parser.add_argument('--output', help='save results to the json file')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    scenario = Scenario(Client(args.url, args.timeout), args.sample_size, args.seed)
+    results = {}
+    try:
+        for phase, duration in (('warmup', args.warmup), ('run', args.duration)):
+            if duration <= 0:
+                continue
+            samples = collections.defaultdict(list)
+            errors = collections.Counter()
+            lock = threading.Lock()
+            deadline = time.monotonic() + duration
+            threads = [threading.Thread(target=worker, args=(scenario, mix, args.seed * 1000 + i, deadline,
+                                                             samples, errors, lock))
+                       for i in range(args.concurrency)]
+            started_at = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started_at
+        results['total'] = summarize([latency for name in samples for latency in samples[name]], elapsed)
+        results['total']['errors'] = sum(errors.values())
+        for name in sorted(samples):
+            results[name] = summarize(samples[name], elapsed)
+            results[name]['errors'] = errors[name]
+    finally:
+        scenario.cleanup()
+    print_results(results)
+    print('errors: {}'.format(', '.join('{} {}'.format(name, count) for name, count in errors.items()) or 'none'))
+    if args.output:
+        save_results(args.output, 'load', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
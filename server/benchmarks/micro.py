@@ -0,0 +1,123 @@
+import argparse
+import copy
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import json as flask_json  # noqa: E402
+
+from db_access_layer import DB  # noqa: E402
+from db_settings import DB_TABLES  # noqa: E402
+from validation import validate_data  # noqa: E402
+from results import summarize, save_results, print_results  # noqa: E402
+
+USER = {'name': 'Benchmark User', 'photo_path': 'benchmark.jpg', 'gender': 'female', 'born_at': '1990-05-17',
+        'address': 'Benchmark street 1, Benchmark city'}
+INVALID_USER = {'name': 'B3', 'photo_path': 'benchmark.jpg', 'gender': 'unknown', 'born_at': '17.05.1990',
+                'address': 'short'}
+EMAIL = {'user_id': 1, 'type': 'work', 'email': 'Benchmark.User@example.org'}
+PHONE = {'user_id': 1, 'type': 'mobile', 'number': '+7 912 345-67-89'}
+
+
+class Rollback(Exception):
+    # Raised to roll back records written by the benchmarks
+    pass
+
+
+def timed(function, iterations):
+    """
+    Call the function iterations times.
+    :return: (list of latencies of the calls in seconds, list of results of the calls).
+    """
+    samples = []
+    returned = []
+    for _ in range(iterations):
+        started_at = time.perf_counter()
+        returned.append(function())
+        samples.append(time.perf_counter() - started_at)
+    return samples, returned
+
+
+def validation_benchmarks(iterations):
+    results = {}
+    for name, table_name, data in (('validate_data users', 'users', USER),
+                                   ('validate_data users invalid', 'users', INVALID_USER),
+                                   ('validate_data emails', 'emails', EMAIL),
+                                   ('validate_data phones', 'phones', PHONE)):
+        columns = DB_TABLES[table_name]['required']
+        samples, _ = timed(lambda: validate_data(data=data, columns=columns, table_name=table_name), iterations)
+        results[name] = summarize(samples)
+    return results
+
+
+def json_benchmarks(iterations, page_size):
+    # A page of users with embedded emails and phones, as returned by the api
+    user = dict(USER, id=1, born_at=datetime.date(1990, 5, 17),
+                emails=[dict(EMAIL, id=1), dict(EMAIL, id=2)], phones=[dict(PHONE, id=1), dict(PHONE, id=2)])
+    page = {'users': [dict(copy.deepcopy(user), id=i) for i in range(page_size)], 'next': 'cursor'}
+    results = {}
+    samples, _ = timed(lambda: flask_json.dumps(page), iterations)
+    results['flask json page'] = summarize(samples)
+    samples, _ = timed(lambda: json.dumps(page, default=str), iterations)
+    results['json page'] = summarize(samples)
+    return results
+
+
+def db_benchmarks(iterations, page_size):
+    db = DB()
+    results = {}
+    columns = DB_TABLES['users']['required']
+    try:
+        # Records are written in one transaction which is rolled back at the end
+        with db.transaction():
+            samples, returned = timed(lambda: db.insert(table_name='users', column_names=columns, values=USER),
+                                      iterations)
+            results['DB.insert users'] = summarize(samples)
+            ids = [result[0]['id'] for result in returned]
+            emails = [dict(EMAIL, user_id=user_id) for user_id in ids]
+            samples, _ = timed(lambda: db.insert(table_name='emails', column_names=list(EMAIL),
+                                                 values=emails[:page_size]), max(iterations // page_size, 1))
+            results['DB.insert emails x{}'.format(page_size)] = summarize(samples)
+            ids_iterator = iter(ids * 2)
+            samples, _ = timed(lambda: db.select(table_name='users', condition={'id': next(ids_iterator)}),
+                               iterations)
+            results['DB.select user by id'] = summarize(samples)
+            samples, _ = timed(lambda: db.select(table_name='users', order=('name', 'asc'), limit=page_size),
+                               max(iterations // 10, 1))
+            results['DB.select users page'] = summarize(samples)
+            samples, _ = timed(lambda: db.select(table_name='users', order=('name', 'asc'), limit=page_size,
+                                                 children=DB_TABLES['users']['children']),
+                               max(iterations // 10, 1))
+            results['DB.select users page embed'] = summarize(samples)
+            raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of validation, json serialization and db layer.')
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--skip-db', action='store_true', help='don\'t run benchmarks that need the database')
+    parser.add_argument('--output', help='save results to the json file')
+    args = parser.parse_args()
+
+    results = {}
+    results.update(validation_benchmarks(args.iterations))
+    results.update(json_benchmarks(max(args.iterations // 100, 1), args.page_size))
+    if not args.skip_db:
+        results.update(db_benchmarks(min(args.iterations, 2000), args.page_size))
+    print_results(results)
+    if args.output:
+        save_results(args.output, 'micro', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
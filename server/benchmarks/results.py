@@ -0,0 +1,72 @@
+import datetime
+import json
+import os
+import platform
+import subprocess
+
+
+def percentile(sorted_samples, part):
+    # Nearest-rank percentile of sorted samples
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, max(0, int(round(part * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples, duration=None):
+    """
+    Latency statistics of a benchmark.
+    :param samples: list of latencies in seconds.
+    :param duration: float, wall time of the run in seconds, throughput is samples per second of it.
+    :return: dict with count, throughput, mean, p50, p95, p99 and max latency in milliseconds.
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    if duration is None:
+        duration = sum(samples)
+    return {
+        'count': count,
+        'throughput': count / duration if duration else None,
+        'mean_ms': sum(samples) / count * 1000 if count else None,
+        'p50_ms': percentile(samples, 0.50) * 1000 if count else None,
+        'p95_ms': percentile(samples, 0.95) * 1000 if count else None,
+        'p99_ms': percentile(samples, 0.99) * 1000 if count else None,
+        'max_ms': samples[-1] * 1000 if count else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, kind, params, results):
+    """
+    Save results of a run as json, so that runs can be compared with compare.py.
+    :param path: str, path of the output file.
+    :param kind: str, 'micro' or 'load'.
+    :param params: dict, arguments of the run.
+    :param results: dict {benchmark name: summarize() result}.
+    """
+    data = {
+        'kind': kind,
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': params,
+        'results': results,
+    }
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+
+
+def print_results(results):
+    print('{:<32} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'benchmark', 'count', 'ops/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, result in results.items():
+        print('{:<32} {:>8} {:>10.1f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            name, result['count'], result['throughput'] or 0, result['mean_ms'] or 0, result['p50_ms'] or 0,
+            result['p95_ms'] or 0, result['p99_ms'] or 0))
@@ -0,0 +1,252 @@
+import csv
+import gzip
+import io
+import json
+import queue
+import threading
+
+import psycopg2
+
+from business_logic import db, normalize_data
+from photo_storage import PHOTO_KEY
+from validation import validate_batch
+from db_settings import DB_TABLES
+from settings import IMPORT_BATCH_SIZE, EXPORT_QUEUE_SIZE, EXPORT_CHUNK_SIZE
+
+USER_COLUMNS = DB_TABLES['users']['required']
+CHILD_TABLES = ('emails', 'phones')
+# Loaded columns of child tables: required and normalized ones
+CHILD_COLUMNS = {table_name: DB_TABLES[table_name]['required'] +
+                 [context['COLUMN'] for context in DB_TABLES[table_name].get('normalization', {}).values()]
+                 for table_name in CHILD_TABLES}
+
+
+# ============= Import =============
+
+
+def read_records(lines, data_format):
+    """
+    Parse users with nested emails and phones.
+    :param lines: iterable of str lines.
+    :param data_format: 'ndjson' - one json object per line, or 'csv' - csv with header where
+    'emails' and 'phones' fields hold json lists.
+    :return: generator of (row number, user dict or None if the row can't be parsed).
+    """
+    if data_format == 'csv':
+        for row_number, row in enumerate(csv.DictReader(lines), start=1):
+            try:
+                for table_name in CHILD_TABLES:
+                    row[table_name] = json.loads(row.get(table_name) or '[]')
+            except ValueError:
+                row = None
+            yield row_number, row
+    else:
+        row_number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield row_number, record if isinstance(record, dict) else None
+
+
+def validate_records(batch, errors):
+    """
+    Validate a batch of users with their emails and phones, table by table.
+    :param batch: list of (row number, user dict).
+    :param errors: dict, errors of invalid rows are added to it by row number.
+    :return: list of valid (row number, user dict).
+    """
+    checked = []
+    for row_number, record in batch:
+        # Only photos of the storage are kept, e.g. of exported users, photos are uploaded as files
+        if not isinstance(record.get('photo_path'), str) or not PHOTO_KEY.match(record['photo_path']):
+            record['photo_path'] = ''
+        children = [record.get(table_name) or [] for table_name in CHILD_TABLES]
+        if not all(isinstance(records, list) and all(isinstance(child, dict) for child in records)
+                   for records in children):
+            errors[row_number] = {'fields': 'emails and phones should be lists of objects'}
+            continue
+        for table_name, records in zip(CHILD_TABLES, children):
+            record[table_name] = records
+        checked.append((row_number, record))
+
+    for i, record_errors in validate_batch([record for _, record in checked], 'users').items():
+        errors[checked[i][0]] = record_errors
+    for table_name in CHILD_TABLES:
+        owners = []
+        children = []
+        for row_number, record in checked:
+            for i, child in enumerate(record[table_name]):
+                # Temporary set user_id as 1 for validating another fields
+                child['user_id'] = 1
+                owners.append((row_number, '{}[{}]'.format(table_name, i)))
+                children.append(child)
+        for i, child_errors in validate_batch(children, table_name).items():
+            row_number, key = owners[i]
+            errors.setdefault(row_number, {}).setdefault('additional_fields', {})[key] = child_errors
+    return [(row_number, record) for row_number, record in checked if row_number not in errors]
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_users(records):
+    """
+    Load users with their emails and phones with 'COPY FROM STDIN' in one transaction.
+    :param records: list of valid user dicts.
+    """
+    with db.transaction():
+        user_ids = db.reserve_ids('users', len(records))
+        users = []
+        children = {table_name: [] for table_name in CHILD_TABLES}
+        for user_id, record in zip(user_ids, records):
+            users.append([user_id] + [record[column] for column in USER_COLUMNS])
+            for table_name in CHILD_TABLES:
+                for child in record.get(table_name) or []:
+                    child['user_id'] = user_id
+                    normalize_data(child, table_name)
+                    children[table_name].append([child[column] for column in CHILD_COLUMNS[table_name]])
+        db.copy_from('users', ['id'] + USER_COLUMNS, to_csv(users))
+        for table_name in CHILD_TABLES:
+            if children[table_name]:
+                db.copy_from(table_name, CHILD_COLUMNS[table_name], to_csv(children[table_name]))
+
+
+def load_batch(batch, errors):
+    """
+    Load a batch of (row number, record). If the database rejects the batch
+    it is split in halves until the rejected rows are found, other rows are loaded.
+    :return: number of loaded records.
+    """
+    try:
+        copy_users([record for _, record in batch])
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        if len(batch) == 1:
+            errors[batch[0][0]] = {'database': e.pgerror or str(e)}
+            return 0
+        middle = len(batch) // 2
+        return load_batch(batch[:middle], errors) + load_batch(batch[middle:], errors)
+    return len(batch)
+
+
+def import_users(lines, data_format='ndjson', batch_size=IMPORT_BATCH_SIZE):
+    """
+    Validate and load users with nested emails and phones batch by batch.
+    Invalid rows are skipped and reported, they don't abort the import.
+    :param lines: iterable of str lines.
+    :param data_format: 'ndjson' or 'csv'.
+    :param batch_size: int, number of users loaded in one transaction.
+    :return: dict with number of imported users and errors by row number.
+    """
+    imported = 0
+    errors = {}
+    batch = []
+    for row_number, record in read_records(lines, data_format):
+        if record is None:
+            errors[row_number] = {'fields': 'Invalid {} row'.format(data_format)}
+            continue
+        batch.append((row_number, record))
+        if len(batch) == batch_size:
+            imported += load_batch(validate_records(batch, errors), errors)
+            batch = []
+    if batch:
+        imported += load_batch(validate_records(batch, errors), errors)
+    return {'info': 'Imported', 'imported': imported, 'errors': errors}
+
+
+# ============= Export =============
+
+
+def export_table(file, table_name, data_format='csv', embed=False):
+    """
+    Write a table to the file with 'COPY TO STDOUT'.
+    :param file: binary file-like object.
+    :param table_name: str, name of table.
+    :param data_format: 'csv' or 'binary'.
+    :param embed: bool, add child records (emails and phones of users) as json lists.
+    """
+    children = DB_TABLES[table_name].get('children') if embed else None
+    db.copy_to(table_name=table_name, file=file, data_format=data_format, children=children)
+
+
+class ChunkWriter:
+    """
+    File-like object that passes written data to a queue in chunks of EXPORT_CHUNK_SIZE bytes.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.cancelled = False
+
+    def put(self, item):
+        # Wait for the reader, unless it has gone away
+        while True:
+            if self.cancelled:
+                raise IOError('Export is cancelled')
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        # COPY writes the data row by row
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+
+def stream_table(table_name, data_format='csv', embed=False, compress=False):
+    """
+    Export a table in a background thread and yield the data as it comes from the database.
+    At most EXPORT_QUEUE_SIZE chunks are held in memory.
+    :param compress: bool, gzip the data.
+    :return: generator of bytes.
+    """
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    writer = ChunkWriter(chunks)
+    finished = object()
+
+    def export():
+        try:
+            if compress:
+                with gzip.GzipFile(fileobj=writer, mode='wb') as file:
+                    export_table(file, table_name, data_format, embed)
+            else:
+                export_table(writer, table_name, data_format, embed)
+            writer.flush()
+        except Exception as e:
+            result = e
+        else:
+            result = finished
+        try:
+            writer.put(result)
+        except IOError:
+            pass
+
+    threading.Thread(target=export, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is finished:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # Stop the export if the client has gone away
+        writer.cancelled = True
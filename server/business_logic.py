@@ -1,72 +1,181 @@
+import base64
+import hashlib
 import json
-import os
 import re
-import hashlib
+import threading
+
+import psycopg2
 
+import metrics
+from cache import RecordCache
 from db_access_layer import DB
 from db_settings import DB_TABLES
-from settings import UPLOAD_FOLDER
+from photo_storage import PHOTO_KEY, PhotoStorage
+from settings import (UPLOAD_FOLDER, DB_POOL_MIN_SIZE, DB_POOL_TIMEOUT, PAGE_SIZE, MAX_PAGE_SIZE, CACHE_MAX_SIZE,
+                      CACHE_TTL, CACHE_INVALIDATION_CHANNEL, SEARCH_LIMIT, MAX_SEARCH_LIMIT, SEARCH_MIN_LENGTH,
+                      SEARCH_CANDIDATES, FILTER_MAX_VALUES, FILTER_MAX_COUNT, PHOTO_WORKERS, PHOTO_CHUNK_SIZE,
+                      PHOTO_ORPHAN_GRACE, PHOTO_CLEANUP_INTERVAL, PHOTO_RENDITIONS, PHOTO_RENDITION_QUALITY,
+                      METRICS_DIRECTORY, METRICS_FLUSH_INTERVAL)
+from validation import validate_data
 
 db = DB()
+record_cache = RecordCache(max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+photos = PhotoStorage(root=UPLOAD_FOLDER, db=db, workers=PHOTO_WORKERS, chunk_size=PHOTO_CHUNK_SIZE,
+                      orphan_grace=PHOTO_ORPHAN_GRACE, renditions=PHOTO_RENDITIONS, quality=PHOTO_RENDITION_QUALITY)
+
+metrics.CallbackMetric('record_cache_size', 'gauge', 'Records in the local cache.',
+                       lambda: record_cache.stats()['size'])
+for cache_counter in ('hits', 'misses', 'evictions'):
+    metrics.CallbackMetric('record_cache_{}_total'.format(cache_counter), 'counter',
+                           'Record cache {} since the process start.'.format(cache_counter),
+                           lambda cache_counter=cache_counter: record_cache.stats()[cache_counter])
+metrics.CallbackMetric('db_pool_connections', 'gauge', 'Connections of the pool by state.',
+                       lambda: {(state,): count for state, count in db.pool.stats().items()}, labelnames=('state',))
+
+FILTER_OPERATORS = ('eq', 'in', 'range', 'prefix')
+
+# Child table name -> (parent table name, foreign key column)
+PARENTS = {child_table: (table_name, foreign_key)
+           for table_name, table in DB_TABLES.items()
+           for child_table, foreign_key in table.get('children', {}).items()}
+
+
+def evict_record(table_name, id, parent_id=None, cascade=False):
+    # Drop a changed record from the cache, and its parent (which may hold it embedded)
+    record_cache.invalidate(table_name, id, cascade=cascade)
+    if parent_id is not None:
+        record_cache.invalidate(PARENTS[table_name][0], parent_id)
+
+
+def invalidate_record(table_name, id, parent_id=None, cascade=False):
+    # Called in the transaction that changes the record: other processes are notified
+    # and the local cache entry is dropped when the transaction is committed
+    change = {'table': table_name, 'id': id, 'parent_id': parent_id, 'cascade': cascade}
+    db.notify(CACHE_INVALIDATION_CHANNEL, json.dumps(change))
+    db.on_commit(lambda: evict_record(**change))
+
+
+def on_record_change(payload):
+    try:
+        change = json.loads(payload)
+        evict_record(change['table'], change['id'], change.get('parent_id'), change.get('cascade', False))
+    except (ValueError, KeyError, TypeError):
+        print('Invalid change notification: {}'.format(payload))
+
+
+def start_change_listener():
+    # Notifications sent while the listener was disconnected are lost, so the cache is dropped on (re)connect
+    return db.listen(CACHE_INVALIDATION_CHANNEL, on_record_change, on_connect=record_cache.clear)
+
+
+def start_photo_cleanup():
+    return photos.start_cleanup(PHOTO_CLEANUP_INTERVAL)
+
+
+def warm_up():
+    # Build and prepare statements of common reads on the connection of the current transaction
+    # Single records are selected past the cache, probes of a missing id aren't counted as cache misses
+    for table_name in DB_TABLES:
+        get_data(table_name=table_name)
+        select_record(table_name, 0)
+        get_record_etag(table_name, 0)
+    include = list(DB_TABLES['users']['children'])
+    select_record('users', 0, get_children('users', include))
+    get_record_etag('users', 0, include)
+    get_stats()
+
+
+def start_worker():
+    """
+    Start the services of a server process: the change listener, photo cleanup, metrics sharing and db connections
+    with prepared statements. Called in every worker after fork (gunicorn.conf.py), because threads
+    and connections are not inherited by forked processes, or by the development server.
+    """
+    start_change_listener()
+    start_photo_cleanup()
+    if METRICS_DIRECTORY is not None:
+        metrics.start_multiprocess(METRICS_DIRECTORY, METRICS_FLUSH_INTERVAL)
+    # Statements are prepared per connection, each thread holds one of the connections opened up front
+    connections = max(DB_POOL_MIN_SIZE, 1)
+    barrier = threading.Barrier(connections)
+
+    def warm_connection():
+        try:
+            with db.transaction():
+                warm_up()
+                barrier.wait(timeout=DB_POOL_TIMEOUT)
+        except threading.BrokenBarrierError:
+            pass
+        except Exception as e:
+            # Connections are opened on demand then, the worker still serves requests
+            barrier.abort()
+            print('Warm up failed: {}'.format(e))
+    threads = [threading.Thread(target=warm_connection, name='warm-up') for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
 
 # ============= Users =============
 
 
-def validate_field(context, data):
-    is_valid = True
-    message = ''
-    valid_type = context['VALID_TYPE']
-    condition = context['CONDITION']
-    if valid_type == 'NULL':
-        is_valid = (data is None) is condition
-        if not is_valid:
-            is_null = 'shouldn\'t' if not condition else 'should'
-            message = '\'{}\' field ' + is_null + ' be null.'
-    if valid_type == 'IN_RANGE':
-        is_valid = data in condition
-        if not is_valid:
-            message = '\'{}\' field should be one of this values: [' + ', '.join(condition) + ']'
-    if valid_type == 'REGULAR':
-        if re.match(condition, data) is None:
-            is_valid = False
-            message = 'Invalid \'{}\' field format'
-    if valid_type == 'STR_LEN':
-        if len(data) < condition[0] or len(data) > condition[1]:
-            is_valid = False
-            message = '\'{}\' field must be ' + str(condition[0]) + ' characters or longer and ' \
-                      + str(condition[1]) + ' characters and less in length.'
-    if valid_type == 'IS_DIGIT':
-        if (re.search(r'\d+', data) is not None) != condition:
-            not_str = '' if condition else 'not '
-            is_valid = False
-            message = '\'{}\' field must ' + not_str + 'contain numbers.'
-    return is_valid, message
+PHOTO_PATH_ERROR = 'photo_path can\'t be set, the photo is uploaded as a file'
+NON_DIGITS = re.compile(r'\D')
+NORMALIZERS = {
+    'DIGITS': lambda value: NON_DIGITS.sub('', value),
+    'LOWER': lambda value: value.strip().lower(),
+}
 
 
-def validate_data(data, columns, table_name):
-    is_valid = True
-    errors = {}
-    # Check data
-    for column in columns:
-        if column not in DB_TABLES[table_name]['required']:
-            is_valid = False
-            errors[column] = '{} has no {} field'.format(DB_TABLES[table_name]['object_name']['singular'], column)
-        try:
-            for context in DB_TABLES[table_name]['validation'][column]:
-                is_field_valid, message = validate_field(context=context, data=data[column])
-                if not is_field_valid:
-                    errors[column] = message.format(column)
-                    is_valid = False
-        except KeyError:
-            is_valid = False
-            errors['fields'] = 'Not enough {} record fields'.format(DB_TABLES[table_name]['record_name']['singular'])
-    return is_valid, errors
+def check_fields(data, table_name):
+    """
+    Keys of data are column names of statements, only fields of the table are accepted.
+    :return: dict of errors by unknown field, empty if all fields are known.
+    """
+    object_name = DB_TABLES[table_name]['object_name']['singular']
+    return {column: '{} has no {} field'.format(object_name, column)
+            for column in data if column not in DB_TABLES[table_name]['required']}
 
 
-def generate_photo_path(data, file_type):
-    hash_object = hashlib.md5(str(data).encode())
-    return '{}.{}'.format(hash_object.hexdigest(), file_type)
+def insert_columns(table_name):
+    # Columns of a created record: required fields and canonical forms written by normalize_data
+    return DB_TABLES[table_name]['required'] + [context['COLUMN'] for context in
+                                                DB_TABLES[table_name].get('normalization', {}).values()]
+
+
+def normalize_data(data, table_name):
+    # Write canonical forms of fields (e.g. digits of phone number) to their columns
+    for column, context in DB_TABLES[table_name].get('normalization', {}).items():
+        if column in data:
+            data[context['COLUMN']] = NORMALIZERS[context['NORMAL_TYPE']](data[column])
+    return data
+
+
+def update_record(table_name, id, data):
+    """
+    Update a record and invalidate it (and its parents) in the cache. Must be called in a transaction.
+    :param table_name: str, name of table.
+    :param id: id of updating record.
+    :param data: dict with valid data of updated fields.
+    :return: list of identifications of updated records.
+    """
+    normalize_data(data, table_name)
+    if table_name not in PARENTS:
+        updated_ids = db.update(table_name=table_name, values=data, id=id)
+        invalidate_record(table_name, id)
+        return updated_ids
+    foreign_key = PARENTS[table_name][1]
+    old_parent = None
+    if foreign_key in data:
+        # Record is moved to another parent, the old one should be invalidated too
+        old_parent = db.select(table_name, foreign_key, condition={'id': id})
+    updated_ids = db.update(table_name=table_name, values=data, id=id, returning='id, {}'.format(foreign_key))
+    if len(updated_ids) != 0:
+        invalidate_record(table_name, id, parent_id=updated_ids[0][foreign_key])
+    if old_parent:
+        invalidate_record(table_name, id, parent_id=old_parent[0][foreign_key])
+    return updated_ids
 
 
 def pop_key(dictionary, key):
@@ -83,69 +192,66 @@ def check_user_additional_data(emails, phones):
     # Temporary set user_id as 1 for validating another fields
     for i, email in enumerate(emails):
         email['user_id'] = 1
-        is_emails_valid, errors['emails[{i}]'] = validate_data(data=email, columns=DB_TABLES['emails']['required'],
-                                                               table_name='emails')
+        is_emails_valid, errors['emails[{}]'.format(i)] = validate_data(
+            data=email, columns=DB_TABLES['emails']['required'], table_name='emails')
         if not is_emails_valid:
             is_valid = False
 
     for i, phone in enumerate(phones):
         phone['user_id'] = 1
-        is_phones_valid, errors['phones[{i}]'] = validate_data(data=phone, columns=DB_TABLES['phones']['required'],
-                                                               table_name='phones')
+        is_phones_valid, errors['phones[{}]'.format(i)] = validate_data(
+            data=phone, columns=DB_TABLES['phones']['required'], table_name='phones')
         if not is_phones_valid:
             is_valid = False
     return is_valid, errors
 
 
-def set_user_id_to_list(data, user_id):   # Set user_id to additional user data (emails, phones)
-    for elem in data:
-        elem['user_id'] = user_id
-    return data
-
-
 def create_user(user_data, photo_file):
-    user_data['photo_path'] = ''
-
     # Get emails and phones fields as string and parse to dict
     emails = json.loads(pop_key(user_data, 'emails'))
-    phones = json.loads(pop_key(user_data, 'photos'))
+    phones = json.loads(pop_key(user_data, 'phones'))
 
-    # Check if user data is valid
-    is_valid, errors = validate_data(data=user_data, columns=DB_TABLES['users']['required'], table_name='users')
-    is_valid, messages = check_user_additional_data(emails, phones)
+    # Check if user data is valid, photo_path is set by the photo storage
+    columns = [column for column in DB_TABLES['users']['required'] if column != 'photo_path']
+    is_user_valid, errors = validate_data(data=user_data, columns=columns, table_name='users')
+    is_additional_valid, messages = check_user_additional_data(emails, phones)
 
     creating_result = {}
-    if not is_valid:
+    if not (is_user_valid and is_additional_valid):
         creating_result['info'] = 'Invalid data'
         creating_result['errors'] = errors
         creating_result['additional_fields'] = messages
     else:
         # If user data is correct
-        # Insert user data to database (with empty string as photo_path)
-        results = db.insert(table_name='users', column_names=user_data.keys(), values=user_data)
-        # Save user photo
-        user_id = results[0]['id']
-        file_type = photo_file.filename.split('.')[-1]
-        filename = generate_photo_path(user_id, file_type)
-        photo_path = os.path.join(UPLOAD_FOLDER, filename)
-        photo_file.save(photo_path)
-        # Update photo_path field in user record
-        db.update(table_name='users', values={'photo_path': photo_path}, id=user_id)
-        # Insert emails and photos if exists
-        set_user_id_to_list(data=emails, user_id=user_id)
-        set_user_id_to_list(data=phones, user_id=user_id)
-        if len(emails) > 0:
-            db.insert('emails', emails[0].keys(), emails)
-        if len(phones) > 0:
-            db.insert('phones', phones[0].keys(), phones)
-        # Complete db transaction
-        db.complete_transaction()
+        # Photo is stored by its content, so photo_path is known before inserting the user.
+        # It is staged after validation, invalid requests don't write files
+        staged = photos.stage(photo_file)
+        user_data['photo_path'] = staged.key
+        user = {column: user_data[column] for column in DB_TABLES['users']['required']}
+        children = {
+            table_name: [normalize_data({column: record[column] for column in DB_TABLES[table_name]['required']
+                                         if column != 'user_id'}, table_name) for record in records]
+            for table_name, records in (('emails', emails), ('phones', phones))
+        }
+        try:
+            # Insert user, emails and phones with one statement
+            with db.transaction():
+                db.insert_with_children(table_name='users', values=user, children=children, foreign_key='user_id')
+                # The photo file is moved into place in the background once the user is committed
+                db.on_commit(lambda: photos.finalize(staged))
+        except Exception:
+            photos.discard(staged)
+            raise
         creating_result['info'] = 'Created'
     return creating_result
 
 
 def update_user(user_id, user_data, photo_file=None):
     is_valid, errors = validate_data(data=user_data, columns=user_data.keys(), table_name='users')
+    if 'photo_path' in user_data:
+        # The path is set by the photo storage only, photos are uploaded as files
+        is_valid = False
+        errors['photo_path'] = PHOTO_PATH_ERROR
     updating_result = {}
     if not is_valid:
         updating_result['info'] = 'Invalid data'
@@ -153,17 +259,28 @@ def update_user(user_id, user_data, photo_file=None):
     else:
         # If user data is correct
         # If new photo is received
+        staged = None
         if photo_file is not None:
-            # Resave photo
-            file_type = photo_file.filename.split('.')[-1]
-            filename = generate_photo_path(user_id, file_type)
-            photo_path = os.path.join(UPLOAD_FOLDER, filename)
-            photo_file.save(photo_path)
-            user_data['photo_path'] = filename
+            staged = photos.stage(photo_file)
+            user_data['photo_path'] = staged.key
         # Update user data
-        updated_ids = db.update(table_name='users', values=user_data, id=user_id)
-        # Complete db transaction
-        db.complete_transaction()
+        try:
+            with db.transaction():
+                old_photo = None
+                if 'photo_path' in user_data:
+                    old_photo = db.select('users', 'photo_path', condition={'id': user_id})
+                updated_ids = update_record('users', user_id, user_data)
+                if staged is not None and updated_ids:
+                    db.on_commit(lambda: photos.finalize(staged))
+                if old_photo and old_photo[0]['photo_path'] != user_data['photo_path']:
+                    # The old photo file is removed if no other user has the same photo
+                    db.on_commit(lambda: photos.release(old_photo[0]['photo_path']))
+        except Exception:
+            if staged is not None:
+                photos.discard(staged)
+            raise
+        if staged is not None and not updated_ids:
+            photos.discard(staged)
         if len(updated_ids) == 0:
             updating_result['info'] = 'Doesn\'t updated.  No user with such id.'
         else:
@@ -174,52 +291,346 @@ def update_user(user_id, user_data, photo_file=None):
 def remove_user(user_id):
     deleting_result = {}
     # Remove user with id = user_id
-    result = db.delete(table_name='users', id=user_id, returning='photo_path')
-    # Complete db transaction
-    db.complete_transaction()
-    if len(result) is not 0:
-        try:
-            os.remove(result[0]['photo_path'])
-        except:
-            pass
+    with db.transaction():
+        result = db.delete(table_name='users', id=user_id, returning='photo_path')
+        if len(result) != 0:
+            # Emails and phones of the user are deleted by cascade
+            invalidate_record('users', user_id, cascade=True)
+    if len(result) != 0:
+        photos.release(result[0]['photo_path'])
         deleting_result['info'] = 'Deleted'
     else:
         deleting_result['info'] = 'Doesn\'t removed.  No user with such id.'
     return deleting_result
 
 
+def get_photo_size(size):
+    # None is the original photo
+    if size is None or size == 'original':
+        return None, None
+    if size not in PHOTO_RENDITIONS:
+        return None, 'Invalid size'
+    return size, None
+
+
+def get_photo(photo_path, size=None):
+    # Only content-addressed photos are sent by path, the path can't point outside of the storage
+    size, error = get_photo_size(size)
+    if error is not None:
+        return {'info': error}
+    if not PHOTO_KEY.match(photo_path):
+        return {'info': 'No such photo'}
+    photo = photos.find(photo_path, size)
+    return photo if photo is not None else {'info': 'No such photo'}
+
+
+def get_user_photo(user_id, size=None):
+    """
+    Photo of a user: {'photo_path': ...} for a content-addressed photo, its url is cached by clients,
+    otherwise the file to send (see get_photo) or {'info': ...}.
+    """
+    size, error = get_photo_size(size)
+    if error is not None:
+        return {'info': error}
+    with db.transaction():
+        result = db.select(table_name='users', columns='id,photo_path', condition={'id': user_id})
+    if not result or not result[0]['photo_path']:
+        return {'info': 'No such photo'}
+    photo_path = result[0]['photo_path']
+    if PHOTO_KEY.match(photo_path):
+        return {'photo_path': photo_path}
+    photo = photos.find(photo_path)
+    return photo if photo is not None else {'info': 'No such photo'}
+
+
 def remove_data(id, table_name):
     deleting_result = {}
     # Remove record with id = id
-    result = db.delete(table_name=table_name, id=id)
-    # Complete db transaction
-    db.complete_transaction()
-    if len(result) is not 0:
+    foreign_key = PARENTS[table_name][1]
+    with db.transaction():
+        result = db.delete(table_name=table_name, id=id, returning='id, {}'.format(foreign_key))
+        if len(result) != 0:
+            invalidate_record(table_name, id, parent_id=result[0][foreign_key])
+    if len(result) != 0:
         deleting_result['info'] = 'Deleted'
     else:
         deleting_result['info'] = 'Doesn\'t removed.  No record with such id.'
     return deleting_result
 
 
-def get_data(table_name, id=None, sort_by=None):
-    condition = None if id is None else {'id': id}
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def encode_cursor(sort_column, record):
+    # Opaque keyset cursor: the sort column plus the sort value and id of the last record on the page
+    cursor = json.dumps([sort_column, record[sort_column], record['id']], default=str)
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor, sort_column, table_name):
+    """
+    :return: (sort value, id) of the cursor or None if the cursor is invalid.
+    """
+    try:
+        column, value, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if column != sort_column or column not in DB_TABLES[table_name]['sortable']:
+        # Cursor was issued for another ordering
+        return None
+    # Values of a tampered cursor are passed to the query, only scalars of the column are accepted
+    if not is_id(record_id):
+        return None
+    if value is None:
+        return (None, record_id) if column in DB_TABLES[table_name].get('nullable', ()) else None
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    return value, record_id
+
+
+def get_order(table_name, sort_by):
     order = tuple()
     if sort_by:
         column = sort_by[0]
         value = sort_by[1].lower()
-        if column in DB_TABLES[table_name]['fields'] and value in ['asc', 'desc']:
+        if column in DB_TABLES[table_name]['sortable'] and value in ['asc', 'desc']:
             order = (column, value)
-    result = db.select(table_name=table_name, columns='*', condition=condition, order=order)
-    db.complete_transaction()
+    return order
+
+
+def get_children(table_name, include):
+    # Child tables that should be embedded into records, e.g. emails and phones of users
+    children = DB_TABLES[table_name].get('children', {})
+    selected = {child_table: children[child_table] for child_table in include or [] if child_table in children}
+    return selected or None
+
+
+def get_columns(table_name, fields, sort_column='id'):
+    """
+    Columns of a projection, e.g. 'id,name'. id and the sort column are always selected, they make the page cursor.
+    :param fields: list of str, requested fields of records, all fields if empty.
+    :return: str, columns to select or None if there is an unknown field.
+    """
+    if not fields:
+        return '*'
+    if any(field not in DB_TABLES[table_name]['fields'] for field in fields):
+        return None
+    columns = [field for field in DB_TABLES[table_name]['fields']
+               if field in fields or field in ('id', sort_column)]
+    return ','.join(columns)
+
+
+def get_filters(table_name, params):
+    """
+    Parse filters of a list, e.g. ('user_id__eq', '42'), ('type__in', 'work,personal'),
+    ('born_at__range', '1990-01-01,1999-12-31'), ('name__prefix', 'Ann').
+    :param params: list of (param name, value).
+    :return: (list of (column, operator, value), error message or None).
+    """
+    filters = []
+    if len(params) > FILTER_MAX_COUNT:
+        return None, 'A list can have {} filters or less'.format(FILTER_MAX_COUNT)
+    for param, value in params:
+        column, _, operator = param.rpartition('__')
+        if column not in DB_TABLES[table_name]['fields'] or operator not in FILTER_OPERATORS:
+            return None, 'Invalid filter \'{}\''.format(param)
+        # Every filter is a part of the statement shape, a repeated one would only make a new shape
+        if any(column == other_column and operator == other_operator for other_column, other_operator, _ in filters):
+            return None, 'Repeated filter \'{}\''.format(param)
+        if operator == 'in':
+            value = value.split(',')
+            if len(value) > FILTER_MAX_VALUES:
+                return None, '\'{}\' filter should have {} values or less'.format(param, FILTER_MAX_VALUES)
+        elif operator == 'range':
+            bounds = value.split(',')
+            if len(bounds) != 2 or not any(bounds):
+                return None, '\'{}\' filter should be \'low,high\', one of them may be empty'.format(param)
+            value = tuple(bound or None for bound in bounds)
+        filters.append((column, operator, value))
+    return filters, None
+
+
+def get_data(table_name, id=None, sort_by=None, limit=None, after=None, include=None, fields=None, filters=None):
+    condition = None if id is None else {'id': id}
+    order = get_order(table_name, sort_by)
+    children = get_children(table_name, include)
     select_result = {}
 
     if id is None:
+        # Lists are always returned page by page
+        limit = PAGE_SIZE if limit is None else min(max(limit, 1), MAX_PAGE_SIZE)
+        sort_column = order[0] if order else 'id'
+        columns = get_columns(table_name, fields, sort_column)
+        if columns is None:
+            select_result['info'] = 'Invalid fields'
+            return select_result
+        filters, error = get_filters(table_name, filters or [])
+        if error is not None:
+            select_result['info'] = error
+            return select_result
+        keyset = None
+        if after:
+            keyset = decode_cursor(after, sort_column, table_name)
+            if keyset is None:
+                select_result['info'] = 'Invalid cursor'
+                return select_result
+        # Select one extra record to know if there is a next page
+        try:
+            with db.transaction():
+                result = db.select(table_name=table_name, columns=columns, condition=condition, order=order,
+                                   limit=limit + 1, after=keyset, children=children, filters=filters)
+                if len(result) <= limit and keyset is not None and \
+                        sort_column in DB_TABLES[table_name].get('nullable', ()):
+                    # NULLs are last in ascending order and first in descending, the page continues
+                    # with the other part of the column, which the keyset predicate can't reach
+                    descending = order[1] == 'desc'
+                    if (keyset[0] is None) == descending:
+                        rest = [(sort_column, 'not_null' if descending else 'eq', None)]
+                        result += db.select(table_name=table_name, columns=columns, condition=condition,
+                                            order=order, limit=limit + 1 - len(result), children=children,
+                                            filters=filters + rest)
+        except psycopg2.DataError:
+            # Filter value doesn't fit the column type, e.g. a date
+            select_result['info'] = 'Invalid filter value'
+            return select_result
+        next_cursor = None
+        if len(result) > limit:
+            result = result[:limit]
+            next_cursor = encode_cursor(sort_column, result[-1])
         select_result[DB_TABLES[table_name]['record_name']['plural']] = result
+        select_result['next'] = next_cursor
     else:
+        result = record_cache.get(table_name, id, tuple(sorted(children)) if children else ())
+        if result is None:
+            result = select_record(table_name, id, children, order)
         select_result[DB_TABLES[table_name]['record_name']['singular']] = result
     return select_result
 
 
+def select_record(table_name, id, children=None, order=()):
+    """
+    Select a record (with embedded children) and put it into the cache.
+    :return: list with the record, empty if there is no such record.
+    """
+    generation = record_cache.generation(table_name, id)
+    with db.transaction():
+        result = db.select(table_name=table_name, columns='*', condition={'id': id}, order=order, children=children)
+    if result:
+        parent = None
+        if table_name in PARENTS:
+            parent_table, foreign_key = PARENTS[table_name]
+            parent = (parent_table, result[0][foreign_key])
+        record_cache.set(table_name, id, result, tuple(sorted(children)) if children else (), parent=parent,
+                         generation=generation)
+    return result
+
+
+def is_record_cached(table_name, id, include=None):
+    children = get_children(table_name, include)
+    return record_cache.peek(table_name, id, tuple(sorted(children)) if children else ()) is not None
+
+
+def get_record_etag(table_name, id, include=None, records=None):
+    """
+    ETag of a record (with included children): a hash of the ids of the transactions that changed them,
+    set by triggers of migration 0007, so it changes with every write of the record or its children.
+    :param records: records of the response of get_data, if None the version is taken from the cache
+    or read by a query that doesn't read the record.
+    :return: str or None if there is no such record.
+    """
+    children = get_children(table_name, include)
+    if records is None:
+        records = record_cache.peek(table_name, id, tuple(sorted(children)) if children else ())
+    if records is not None:
+        if not records:
+            return None
+        version = [records[0]['change_txid']] + [
+            [len(records[0][child_table]), max([child['change_txid'] for child in records[0][child_table]] or [0])]
+            for child_table in sorted(children or ())]
+    else:
+        with db.transaction():
+            record = db.select_version(table_name, id, children)
+        if record is None:
+            return None
+        version = [record['change_txid']] + [list(record[child_table]) for child_table in sorted(children or ())]
+    tag = json.dumps([table_name, id, sorted(children or ()), version])
+    return '{}-{}'.format(version[0], hashlib.md5(tag.encode()).hexdigest()[:16])
+
+
+def stream_data(table_name, sort_by=None, include=None, fields=None, filters=None):
+    order = get_order(table_name, sort_by)
+    children = get_children(table_name, include)
+    columns = get_columns(table_name, fields, order[0] if order else 'id')
+    filters, error = get_filters(table_name, filters or [])
+    if columns is None or error is not None:
+        # The response is already started, errors are sent as the only line
+        yield {'info': error or 'Invalid fields'}
+        return
+    yield from db.select(table_name=table_name, columns=columns, order=order, stream=True, children=children,
+                         filters=filters)
+
+
+def search_users(text, limit=None):
+    search_result = {}
+    text = (text or '').strip()
+    if len(text) < SEARCH_MIN_LENGTH:
+        search_result['info'] = 'Search text must be {} characters or longer'.format(SEARCH_MIN_LENGTH)
+        return search_result
+    limit = SEARCH_LIMIT if limit is None else min(max(limit, 1), MAX_SEARCH_LIMIT)
+    # Users are found by their own fields and by fields of their emails and phones
+    fields = [('users', column, 'id') for column in DB_TABLES['users']['searchable']]
+    for child_table, foreign_key in DB_TABLES['users']['children'].items():
+        fields += [(child_table, column, foreign_key) for column in DB_TABLES[child_table]['searchable']]
+    with db.transaction():
+        result = db.search(table_name='users', text=text, fields=fields, limit=limit, candidates=SEARCH_CANDIDATES)
+    search_result[DB_TABLES['users']['record_name']['plural']] = result
+    return search_result
+
+
+def lookup_user(table_name, value):
+    # Find owners of a phone number or an email by its canonical form with one index probe
+    column, context = next(iter(DB_TABLES[table_name]['normalization'].items()))
+    lookup_result = {}
+    if not value:
+        lookup_result['info'] = '\'{}\' param is required'.format(column)
+        return lookup_result
+    normalized = NORMALIZERS[context['NORMAL_TYPE']](value)
+    with db.transaction():
+        result = db.select_parents(table_name='users', child_table=table_name, foreign_key=PARENTS[table_name][1],
+                                   condition={context['COLUMN']: normalized})
+    lookup_result[DB_TABLES['users']['record_name']['plural']] = result
+    return lookup_result
+
+
+def get_stats():
+    # Aggregates are maintained by triggers (migration 0005), reading them doesn't depend on the number of records
+    with db.transaction():
+        totals = db.select_sums('stats_totals', ['users', 'emails', 'phones'])[0]
+        by_gender = db.select_sums('stats_users_by_gender', ['users'], group_by='gender')
+        by_year = db.select_sums('stats_users_by_birth_year', ['users'], group_by='year')
+    by_decade = {}
+    for record in by_year:
+        if record['users'] > 0:
+            decade = record['year'] // 10 * 10
+            by_decade[decade] = by_decade.get(decade, 0) + record['users']
+    users = totals['users']
+    return {'stats': {
+        'users': users,
+        'emails': totals['emails'],
+        'phones': totals['phones'],
+        'emails_per_user': totals['emails'] / users if users else 0,
+        'phones_per_user': totals['phones'] / users if users else 0,
+        'by_gender': {record['gender']: record['users'] for record in by_gender if record['users'] > 0},
+        'by_birth_year': {str(record['year']): record['users'] for record in by_year if record['users'] > 0},
+        'by_birth_decade': {str(decade): count for decade, count in by_decade.items()},
+    }}
+
+
+def get_cache_stats():
+    return {'cache': record_cache.stats()}
+
+
 def update_data(id, data, table_name):
     is_valid, errors = validate_data(data=data, columns=data.keys(), table_name=table_name)
     updating_result = {}
@@ -229,9 +640,8 @@ def update_data(id, data, table_name):
     else:
         # If data is correct
         # Update it
-        updated_ids = db.update(table_name=table_name, values=data, id=id)
-        # Complete db transaction
-        db.complete_transaction()
+        with db.transaction():
+            updated_ids = update_record(table_name, id, data)
         if len(updated_ids) == 0:
             updating_result['info'] = 'Doesn\'t updated.  No record with such id.'
         else:
@@ -241,6 +651,10 @@ def update_data(id, data, table_name):
 
 def create_data(data, table_name):
     is_valid, errors = validate_data(data=data, columns=DB_TABLES[table_name]['required'], table_name=table_name)
+    unknown = check_fields(data, table_name)
+    if unknown:
+        is_valid = False
+        errors.update(unknown)
     creating_result = {}
     if not is_valid:
         creating_result['info'] = 'Invalid data'
@@ -248,15 +662,17 @@ def create_data(data, table_name):
     else:
         # If data is correct
         # Insert data to database
-        selected = db.select('users', 'id', condition={'id': data['user_id']})
-        if len(selected) == 1:
-            result = db.insert(table_name=table_name, column_names=data.keys(), values=data)
-            if len(result) == 0:
-                creating_result['info'] = 'Doesn\'t created'
+        normalize_data(data, table_name)
+        with db.transaction():
+            selected = db.select('users', 'id', condition={'id': data['user_id']})
+            if len(selected) == 1:
+                result = db.insert(table_name=table_name, column_names=insert_columns(table_name), values=data)
+                if len(result) == 0:
+                    creating_result['info'] = 'Doesn\'t created'
+                else:
+                    # Parent may be cached with embedded children
+                    invalidate_record(table_name, result[0]['id'], parent_id=selected[0]['id'])
+                    creating_result['info'] = 'Created'
             else:
-                creating_result['info'] = 'Created'
-        else:
-            creating_result['info'] = 'Invalid user_id'
-        # Complete db transaction
-        db.complete_transaction()
+                creating_result['info'] = 'Invalid user_id'
     return creating_result
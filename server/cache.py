@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Invalidations are counted per stripe of keys, so the counters take fixed memory
+GENERATION_STRIPES = 4096
+
+
+class RecordCache:
+    def __init__(self, max_size, ttl):
+        """
+        Thread-safe LRU cache of single records with a time to live.
+        Entries are keyed by (table name, id), one entry holds all variants of the record
+        (e.g. a user with and without embedded emails), so they are invalidated together.
+        :param max_size: int, max number of cached records.
+        :param ttl: float, seconds a record is kept in the cache.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records = OrderedDict()   # (table name, id) -> (expiration time, {variant: value})
+        self._dependents = {}   # parent key -> set of keys of cached child records
+        self._parents = {}   # child key -> parent key
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._generations = [0] * GENERATION_STRIPES
+        self._epoch = 0   # incremented when invalidations of unknown keys are possible
+
+    def generation(self, table_name, id):
+        """
+        Invalidation counter of a record, read before selecting the record from the database.
+        A value selected before a concurrent write must not be cached after its invalidation,
+        set() drops it if the record was invalidated since.
+        """
+        with self._lock:
+            return self._epoch, self._generations[hash((table_name, id)) % GENERATION_STRIPES]
+
+    def get(self, table_name, id, variant=()):
+        """
+        :return: cached value or None.
+        """
+        return self._get(table_name, id, variant, count=True)
+
+    def peek(self, table_name, id, variant=()):
+        """
+        Cached value or None, for internal lookups (e.g. ETags): not counted in hits and misses
+        and doesn't make the record recently used.
+        """
+        return self._get(table_name, id, variant, count=False)
+
+    def _get(self, table_name, id, variant, count):
+        key = (table_name, id)
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None or variant not in entry[1]:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self._records.move_to_end(key)
+                self.hits += 1
+            return entry[1][variant]
+
+    def set(self, table_name, id, value, variant=(), parent=None, generation=None):
+        """
+        :param parent: tuple (table name, id) of the parent record, the record is dropped when
+        the parent is invalidated with cascade.
+        :param generation: result of generation() read before the value was selected, None - don't check.
+        :return: bool, False if the value is dropped as possibly stale.
+        """
+        key = (table_name, id)
+        with self._lock:
+            if generation is not None and generation != (self._epoch,
+                                                          self._generations[hash(key) % GENERATION_STRIPES]):
+                return False
+            entry = self._records.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                entry = (time.monotonic() + self.ttl, {})
+                self._records[key] = entry
+            entry[1][variant] = value
+            self._records.move_to_end(key)
+            if parent is not None:
+                self._parents[key] = parent
+                self._dependents.setdefault(parent, set()).add(key)
+            while len(self._records) > self.max_size:
+                self._remove(next(iter(self._records)))
+                self.evictions += 1
+        return True
+
+    def invalidate(self, table_name, id, cascade=False):
+        """
+        Drop all variants of the record.
+        :param cascade: bool, drop cached child records too (e.g. when the record is deleted).
+        """
+        key = (table_name, id)
+        with self._lock:
+            self._generations[hash(key) % GENERATION_STRIPES] += 1
+            if cascade:
+                # Children deleted by cascade may be selected now without being cached yet
+                self._epoch += 1
+                for child_key in list(self._dependents.get(key, ())):
+                    self._remove(child_key)
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._records.clear()
+            self._dependents.clear()
+            self._parents.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._records),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key):
+        self._records.pop(key, None)
+        parent = self._parents.pop(key, None)
+        if parent is not None:
+            dependents = self._dependents[parent]
+            dependents.discard(key)
+            if not dependents:
+                del self._dependents[parent]
@@ -1,77 +1,574 @@
+import collections
+import hashlib
+import itertools
+import json
 import os
+import re
+import select
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
 from urllib.parse import urlparse
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
 from psycopg2.extras import RealDictCursor
 
+import metrics
+from db_settings import DB_TABLES
+from settings import (STREAM_BATCH_SIZE, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT,
+                      DB_POOL_HEALTH_CHECK_INTERVAL, DB_PREPARE_STATEMENTS, DB_STATEMENT_CACHE_SIZE,
+                      DB_PREPARED_PER_CONNECTION, SLOW_QUERY_THRESHOLD, SLOW_QUERY_EXPLAIN_INTERVAL)
+
+QUERY_DURATION = metrics.Histogram('db_query_duration_seconds', 'Time of sql statements by statement shape.',
+                                   labelnames=('statement',))
+QUERY_ROWS = metrics.Histogram('db_query_rows', 'Rows returned by sql statements by statement shape.',
+                               labelnames=('statement',), buckets=metrics.ROWS_BUCKETS)
+QUERY_ERRORS = metrics.Counter('db_query_errors_total', 'Failed sql statements by statement shape and error.',
+                               labelnames=('statement', 'error'))
+POOL_WAIT = metrics.Histogram('db_pool_wait_seconds', 'Time to check out a connection from the pool.')
+POOL_TIMEOUTS = metrics.Counter('db_pool_timeouts_total', 'Checkouts that found no free connection in time.')
+
+TABLE_NAME = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+# Repeated rows of multi-row VALUES, e.g. '(%s,%s),(%s,%s)'
+REPEATED_GROUPS = re.compile(r'(\([^()]*(?:\([^()]*\)[^()]*)*\))(?:,\1)+')
+# Rows of a list insert, each '%s' is a row adapted by psycopg2, e.g. 'VALUES %s,%s,%s'
+REPEATED_ROWS = re.compile(r'\b(VALUES\s+%s)(?:\s*,\s*%s)*', re.IGNORECASE)
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Connection that remembers names of statements prepared in its session.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = collections.OrderedDict()   # names in order of use, the last is the most recent
+
+
+class PoolTimeout(Exception):
+    """
+    No connection became free in the pool during the checkout timeout.
+    """
+
+
+def like_escape(text):
+    # Escape LIKE wildcards, so that the text is matched literally
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def array_literal(values):
+    """
+    Postgres array literal of values, e.g. '{"1","2"}'. Passed as one untyped value
+    it is cast to an array of the compared column type (bigint[], enum[], date[], ...).
+    """
+    return '{' + ','.join('"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for value in values) + '}'
+
+
+@lru_cache(maxsize=1024)
+def statement_label(query):
+    """
+    Short label of a statement shape for metrics: operation, first table and hash of the query template,
+    multi-row statements with different number of rows have the same label.
+    """
+    template = REPEATED_ROWS.sub(r'\1,...', REPEATED_GROUPS.sub(r'\1,...', query))
+    table = TABLE_NAME.search(template)
+    return '{} {} {}'.format(template.split(None, 1)[0].lower() if template.strip() else '',
+                             table.group(1) if table else '-', hashlib.md5(template.encode()).hexdigest()[:8])
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size, max_size, timeout, health_check_interval):
+        """
+        Bounded thread-safe pool of db connections. Connections are opened lazily,
+        min_size of them are opened on the first checkout (or by open()).
+        :param dsn: str, connection string.
+        :param min_size: int, number of connections opened up front.
+        :param max_size: int, max number of opened connections.
+        :param timeout: float, seconds to wait for a free connection.
+        :param health_check_interval: float, connections idle for longer are checked with 'SELECT 1' on checkout.
+        """
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = collections.deque()   # (connection, time it was returned to the pool)
+        self._size = 0   # opened + being opened connections
+        self._opened = False
+        self._condition = threading.Condition()
+
+    def open(self):
+        """
+        Open min_size connections. A slot is reserved per connection being opened,
+        so a failed connect releases its own slot and open() is retried on the next checkout.
+        """
+        while True:
+            with self._condition:
+                if self._opened:
+                    return
+                if self._size >= self.min_size:
+                    self._opened = True
+                    return
+                self._size += 1
+            try:
+                conn = psycopg2.connect(self.dsn, connection_factory=PreparingConnection)
+            except psycopg2.OperationalError:
+                self._discard(None)
+                raise
+            self.putconn(conn)
+
+    def getconn(self):
+        """
+        Check out a connection, waiting up to timeout seconds for a free one.
+        :return: psycopg2 connection.
+        """
+        if not self._opened:
+            self.open()
+        started_at = time.monotonic()
+        deadline = started_at + self.timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    POOL_TIMEOUTS.inc()
+                    raise PoolTimeout('No free db connection in {} seconds'.format(self.timeout))
+                self._condition.wait(remaining)
+        POOL_WAIT.observe(time.monotonic() - started_at)
+        if conn is not None and not self._is_healthy(conn, returned_at):
+            self._close(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = psycopg2.connect(self.dsn, connection_factory=PreparingConnection)
+            except psycopg2.OperationalError:
+                self._discard(None)
+                raise
+        return conn
+
+    def putconn(self, conn):
+        """
+        Return a connection to the pool. Broken connections and connections
+        with an unfinished transaction are rolled back or closed.
+        :param conn: psycopg2 connection.
+        """
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        """
+        :return: dict with numbers of opened and idle connections.
+        """
+        with self._condition:
+            return {'open': self._size, 'idle': len(self._idle)}
+
+    def closeall(self):
+        """
+        Close all idle connections.
+        """
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._opened = False
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        if conn is not None:
+            self._close(conn)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+class ChangeListener(threading.Thread):
+    def __init__(self, dsn, channel, callback, on_connect=None, reconnect_interval=1):
+        """
+        Thread that listens to a notification channel on its own connection and
+        passes payloads to the callback. It reconnects if the connection is lost.
+        """
+        super().__init__(name='listener-{}'.format(channel), daemon=True)
+        self.dsn = dsn
+        self.channel = channel
+        self.callback = callback
+        self.on_connect = on_connect
+        self.reconnect_interval = reconnect_interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute('LISTEN {};'.format(self.channel))
+                if self.on_connect is not None:
+                    self.on_connect()
+                while not self._stopped.is_set():
+                    # Wait until the connection has data, without polling the database
+                    if select.select([conn], [], [], 1) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.callback(conn.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                print('Listener of {} is disconnected\n{}'.format(self.channel, e))
+                self._stopped.wait(self.reconnect_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stop(self):
+        self._stopped.set()
+
 
 class DB:
     def __init__(self):
         """
-        Create connection to db.
+        Create pool of connections to db.
         """
         url = urlparse(os.environ.get('DATABASE_URL'))
         db = "dbname=%s user=%s password=%s host=%s " % (url.path[1:], url.username, url.password, url.hostname)
+        self.dsn = db
+        self.pool = ConnectionPool(db, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                                   timeout=DB_POOL_TIMEOUT, health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL)
+        self._local = threading.local()
+        self._statements = collections.OrderedDict()   # statement shape -> sql template, in order of use
+        self._statements_lock = threading.Lock()
+        self._slow_explained = {}   # statement label -> time its slow query plan was captured
+        self._slow_lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run queries of the block in one transaction on a connection checked out from the pool.
+        The transaction is committed if the block succeeds and rolled back if it raises.
+        Nested blocks join the outer transaction.
+        :return: psycopg2 connection of the transaction.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self.pool.getconn()
+        self._local.conn = conn
+        self._local.on_commit = []
         try:
-            conn = psycopg2.connect(db)
-        except psycopg2.OperationalError as e:
-            print('Unable to connect\n{}'.format(e))
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            raise
+        finally:
+            callbacks = self._local.on_commit
+            self._local.conn = None
+            self._local.on_commit = []
+            self.pool.putconn(conn)
+        for callback in callbacks:
+            callback()
+
+    def on_commit(self, callback):
+        """
+        Call the function after the current transaction is committed (right away out of a transaction block).
+        :param callback: function without arguments.
+        """
+        if getattr(self._local, 'conn', None) is None:
+            callback()
         else:
-            self.conn = conn
+            self._local.on_commit.append(callback)
 
-    def __execute_sql(self, query, values=None):
+    def notify(self, channel, payload):
+        """
+        Send a notification to listeners of the channel. Inside a transaction it is delivered on commit.
+        :param channel: str, channel name.
+        :param payload: str, notification text.
+        """
+        self.__execute_sql('SELECT pg_notify(%s, %s);', (channel, payload))
+
+    def listen(self, channel, callback, on_connect=None):
+        """
+        Start a background thread listening to the channel.
+        :param channel: str, channel name.
+        :param callback: function called with payload of each notification.
+        :param on_connect: function called when the listener is (re)connected, notifications sent while
+        the listener was disconnected are lost.
+        :return: started ChangeListener.
+        """
+        listener = ChangeListener(self.dsn, channel, callback, on_connect)
+        listener.start()
+        return listener
+
+    def __statement(self, key, build):
+        """
+        Get sql template of a statement shape from the cache, it is built on the first use.
+        :param key: tuple, statement shape: operation, table name, columns and other options.
+        :param build: function that returns sql template of the statement.
+        :return: query template string with '%s' instead of value.
+        """
+        # Columns of writes come from validated fields only (check_fields), never from keys of client data,
+        # otherwise every request could make a new shape and evict hot statements and prepared statements
+        assert key[0] not in ('insert', 'update') or set(key[2]) <= set(DB_TABLES[key[1]]['fields']), key
+        with self._statements_lock:
+            sql_q = self._statements.get(key)
+            if sql_q is not None:
+                self._statements.move_to_end(key)
+                return sql_q
+        sql_q = build()
+        with self._statements_lock:
+            self._statements[key] = sql_q
+            # Shapes depend on request params (fields, filters), so the number of them is bounded
+            while len(self._statements) > DB_STATEMENT_CACHE_SIZE:
+                self._statements.popitem(last=False)
+        return sql_q
+
+    def __execute_sql(self, query, values=None, prepare=False):
         """
         Execute sql query and return the result of query.
         :param query: query template string with '%s' instead of value.
         :param values: values (if there is need) of sql query.
+        :param prepare: bool, execute the query as a server-side prepared statement, so that it is parsed and
+        planned once per connection. For queries that are executed many times with different values.
         :return: sql query result.
         """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Out of a transaction block the query is run in its own transaction
+            with self.transaction():
+                return self.__execute_sql(query, values, prepare)
         result = []
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            if not values:
-                cursor.execute(query)
-            else:
-                cursor.execute(query, values)
-            result = cursor.fetchall()
+        label = statement_label(query)
+        started_at = time.perf_counter()
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            try:
+                if prepare and DB_PREPARE_STATEMENTS:
+                    name = 'statement_{}'.format(hashlib.md5(query.encode()).hexdigest())
+                    if name in conn.prepared:
+                        conn.prepared.move_to_end(name)
+                    else:
+                        if len(conn.prepared) >= DB_PREPARED_PER_CONNECTION:
+                            # Prepared statements hold memory of the backend until the session ends
+                            oldest, _ = conn.prepared.popitem(last=False)
+                            cursor.execute('DEALLOCATE {};'.format(oldest))
+                        # Placeholders of PREPARE are $1, $2, ..., types are inferred from the query
+                        numbers = itertools.count(1)
+                        positional = re.sub('%s', lambda match: '${}'.format(next(numbers)), query.rstrip(';'))
+                        cursor.execute('PREPARE {} AS {};'.format(name, positional))
+                        conn.prepared[name] = None
+                    try:
+                        if values:
+                            cursor.execute('EXECUTE {} ({});'.format(name, ','.join(['%s'] * len(values))), values)
+                        else:
+                            cursor.execute('EXECUTE {};'.format(name))
+                    except psycopg2.errors.FeatureNotSupported:
+                        # 'cached plan must not change result type': a table was altered after the statement
+                        # was prepared. The connection is closed, so it is replaced with a new one by the pool
+                        conn.close()
+                        raise
+                elif not values:
+                    cursor.execute(query)
+                else:
+                    cursor.execute(query, values)
+                result = cursor.fetchall()
+            except psycopg2.Error as e:
+                QUERY_ERRORS.inc(statement=label, error=type(e).__name__)
+                raise
+        duration = time.perf_counter() - started_at
+        QUERY_DURATION.observe(duration, statement=label)
+        QUERY_ROWS.observe(len(result), statement=label)
+        if SLOW_QUERY_THRESHOLD is not None and duration >= SLOW_QUERY_THRESHOLD:
+            self.__log_slow_query(label, query, values, duration)
         return result
 
+    def __log_slow_query(self, label, query, values, duration):
+        """
+        Print a slow statement. Plans of SELECT statements are captured with EXPLAIN ANALYZE
+        (in a background thread, at most once per SLOW_QUERY_EXPLAIN_INTERVAL for a statement shape),
+        other statements are not run again.
+        """
+        print('Slow query [{}] {:.3f} s: {}'.format(label, duration, query))
+        if not query.lstrip().upper().startswith('SELECT'):
+            return
+        now = time.monotonic()
+        with self._slow_lock:
+            if now - self._slow_explained.get(label, -SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL:
+                return
+            self._slow_explained[label] = now
+
+        def explain():
+            try:
+                plan = self.explain(query, values, analyze=True)
+            except (psycopg2.Error, PoolTimeout) as e:
+                print('Slow query [{}] can\'t be explained: {}'.format(label, e))
+                return
+            print('Slow query [{}] plan: {}'.format(label, json.dumps(plan)))
+        threading.Thread(target=explain, daemon=True).start()
+
+    def __stream_sql(self, query, values=None, batch_size=STREAM_BATCH_SIZE):
+        """
+        Execute sql query with a named (server-side) cursor and yield the result records batch by batch.
+        Only batch_size records are held in memory at once.
+        :param query: query template string with '%s' instead of value.
+        :param values: values (if there is need) of sql query.
+        :param batch_size: int, number of records fetched from the server at once.
+        :return: generator of records.
+        """
+        cursor_name = 'stream_{}'.format(uuid.uuid4().hex)
+        # The connection is held by the generator until it is exhausted or closed
+        with self.pool.connection() as conn:
+            try:
+                with conn.cursor(name=cursor_name, cursor_factory=RealDictCursor) as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query, values or None)
+                    while True:
+                        records = cursor.fetchmany(batch_size)
+                        if not records:
+                            break
+                        yield from records
+            finally:
+                # Nothing to commit, just end the transaction of the named cursor
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+
     def insert(self, table_name, column_names, values):
         """
         Insert value or values in table with table_name.
         :param table_name: string, name of table;
         :param column_names: list of str, names of columns of table;
         :param values: list of dict or just dict with data to be inserted;
-        :return: result of inserting - list of identifications of created objects.
+        :return: result of inserting - list of identifications of created objects, in order of values.
         """
         data = []
         values_template = ''
         # If a list of records is received
         if type(values) == list:
-            data = [tuple([value[column] for column in column_names]) for value in values]
+            # Rows of RETURNING aren't guaranteed to be in order of VALUES, so ids are taken before inserting
+            ids = self.next_ids(table_name, len(values))
+            column_names = ['id'] + list(column_names)
+            data = [tuple([id] + [value[column] for column in column_names[1:]]) for id, value in zip(ids, values)]
             values_template = ','.join(['%s'] * len(values))
         elif type(values) == dict:
             data = tuple([values[column] for column in column_names])
             values_template = '({})'.format(','.join(['%s'] * len(column_names)))
         # Create sql query
-        sql_q = 'INSERT INTO {} ({}) VALUES {} RETURNING id;'.format(table_name, ','.join(column_names),
-                                                                     values_template)
-        result = self.__execute_sql(query=sql_q, values=data)
+        def build():
+            return 'INSERT INTO {} ({}) VALUES {} RETURNING id;'.format(table_name, ','.join(column_names),
+                                                                        values_template)
+        if type(values) == dict:
+            # Single record inserts are repeated with the same shape
+            sql_q = self.__statement(('insert', table_name, tuple(column_names)), build)
+            return self.__execute_sql(query=sql_q, values=data, prepare=True)
+        self.__execute_sql(query=build(), values=data)
+        return [{'id': id} for id in ids]
+
+    def next_ids(self, table_name, count):
+        """
+        Take ids of records to be inserted from the id sequence of the table.
+        :return: list of int.
+        """
+        sql_q = self.__statement(('next_ids', table_name), lambda: (
+            "SELECT nextval(pg_get_serial_sequence('{}', 'id')) AS id FROM generate_series(1, %s);".format(table_name)))
+        return [record['id'] for record in self.__execute_sql(query=sql_q, values=(count,), prepare=True)]
+
+    def insert_with_children(self, table_name, values, children, foreign_key):
+        """
+        Insert one record and records referencing it with a single sql statement.
+        :param table_name: string, name of table;
+        :param values: dict with data of the record to be inserted;
+        :param children: dict where key is a child table name and value is a list of dicts with data of
+        child records (without foreign_key field), all dicts of a list have the same keys;
+        :param foreign_key: str, column of child tables that references the inserted record;
+        :return: result of inserting - list with identification of created record.
+        """
+        column_names = list(values.keys())
+        data = [values[column] for column in column_names]
+        queries = ['new_record AS (INSERT INTO {} ({}) VALUES ({}) RETURNING id)'.format(
+            table_name, ','.join(column_names), ','.join(['%s'] * len(column_names)))]
+        for child_table, records in children.items():
+            if len(records) == 0:
+                continue
+            child_columns = list(records[0].keys())
+            values_template = '((SELECT id FROM new_record),{})'.format(','.join(['%s'] * len(child_columns)))
+            queries.append('new_{} AS (INSERT INTO {} ({},{}) VALUES {})'.format(
+                child_table, child_table, foreign_key, ','.join(child_columns),
+                ','.join([values_template] * len(records))))
+            for record in records:
+                data += [record[column] for column in child_columns]
+        # Child inserts are data-modifying CTEs, they are executed even though they are not selected from
+        sql_q = 'WITH {} SELECT id FROM new_record;'.format(', '.join(queries))
+        result = self.__execute_sql(query=sql_q, values=tuple(data))
         return result
 
-    def update(self, table_name, values, id):
+    def update(self, table_name, values, id, returning='id'):
         """
         Update some fields of record with identificator = id.
         :param table_name:
         :param column_names:
         :param values:
+        :param returning: str, fields of updated object that should be returned after updating.
         :return:
         """
-        data = tuple([values[column] for column in values.keys()])
-        values_template = ','.join(['{} = %s'.format(column) for column in values.keys()])
+        column_names = tuple(values.keys())
+        data = tuple([values[column] for column in column_names]) + (id,)
         # Create sql query
-        sql_q = 'UPDATE {} SET {} WHERE id = {} RETURNING id;'.format(table_name, values_template, id)
-        result = self.__execute_sql(query=sql_q, values=data)
+        sql_q = self.__statement(
+            ('update', table_name, column_names, returning),
+            lambda: 'UPDATE {} SET {} WHERE id = %s RETURNING {};'.format(
+                table_name, ','.join(['{} = %s'.format(column) for column in column_names]), returning))
+        result = self.__execute_sql(query=sql_q, values=data, prepare=True)
         return result
 
     def delete(self, table_name, id, returning='id'):
@@ -82,36 +579,331 @@ class DB:
         :param table_name: str, name of table.
         :return: return True if record is deleted and False if an error has occurred.
         """
-        sql_q = 'DELETE FROM {} WHERE id = %s RETURNING {};'.format(table_name, returning)
-        result = self.__execute_sql(query=sql_q, values=(id,))
+        sql_q = self.__statement(('delete', table_name, returning),
+                                 lambda: 'DELETE FROM {} WHERE id = %s RETURNING {};'.format(table_name, returning))
+        result = self.__execute_sql(query=sql_q, values=(id,), prepare=True)
         return result
 
-    def select(self, table_name, columns='*', condition=None, order=tuple()):
+    def delete_many(self, table_name, ids, returning='id'):
+        """
+        Delete records of the table with one query.
+        :param table_name: str, name of table.
+        :param ids: list of ids of deleting records.
+        :param returning: str, fields of deleted objects that should be returned after deleting.
+        :return: list of dicts with returning fields of deleted records.
+        """
+        sql_q = self.__statement(('delete_many', table_name, returning),
+                                 lambda: 'DELETE FROM {} WHERE id = ANY(%s) RETURNING {};'.format(table_name,
+                                                                                                  returning))
+        return self.__execute_sql(query=sql_q, values=(list(ids),), prepare=True)
+
+    def existing_values(self, table_name, column, values):
+        """
+        Find which of the values are in a column of the table.
+        :param table_name: str, name of table.
+        :param column: str, column name, e.g. 'id'.
+        :param values: iterable of values.
+        :return: set of values that some records have.
+        """
+        sql_q = self.__statement(('existing_values', table_name, column),
+                                 lambda: 'SELECT DISTINCT {0} FROM {1} WHERE {0} = ANY(%s);'.format(column, table_name))
+        result = self.__execute_sql(query=sql_q, values=(list(values),), prepare=True)
+        return {record[column] for record in result}
+
+    def select(self, table_name, columns='*', condition=None, order=tuple(), limit=None, after=None, stream=False,
+               children=None, filters=None):
         """
         Get records from a table in a specific order when a given condition is met.
-        :param condition: dict of conditions where key(column_name)=value(record_value)
+        Params are the same as of select_query.
+        :param stream: bool, if True records are read with a server-side cursor and returned as a generator.
+        :return: list of tuples with records data (generator of records if stream is True).
+        """
+        sql_q, values = self.select_query(table_name=table_name, columns=columns, condition=condition, order=order,
+                                          limit=limit, after=after, children=children, filters=filters)
+        if stream:
+            return self.__stream_sql(sql_q, values)
+        return self.__execute_sql(sql_q, values, prepare=True)
+
+    def select_query(self, table_name, columns='*', condition=None, order=tuple(), limit=None, after=None,
+                     children=None, filters=None):
+        """
+        Build sql query of select.
+        :param condition: dict of conditions where key(column_name)=value(record_value), None value means NULL
         :param table_name: str, name of table.
         :param columns: str, columns name that should be selected.
         :param order: tuple of two str, where first element - column name, second - 'asc' or 'desc'.
-        :return: list of tuples with records data.
+        :param limit: int, max number of records to return (page size).
+        :param after: tuple (sort_value, id) of the last record of the previous page (keyset cursor),
+        sort_value None - the record is in the NULLs of the sort column, the page is the next of them by id.
+        :param children: dict where key is a child table name and value is its foreign key column,
+        child records are added to each record as json lists in the same query.
+        :param filters: list of (column, operator, value), operators:
+        'eq' - value or None for NULL, 'in' - list of values, 'range' - tuple (low, high), None for an open end,
+        'prefix' - str, text of the column starts with it, 'not_null' - value is ignored.
+        :return: tuple of query template string and tuple of its values.
         """
         if columns == '':
             columns = '*'
-        sql_q = 'SELECT {} FROM {}'.format(columns, table_name)
-        if condition is not None:
-            conditions = ' AND '.join(['{}={}'.format(column, condition[column]) for column in condition.keys()])
-            sql_q += ' WHERE ' + conditions
-        if order is not None:
-            if len(order) == 2:
-                sql_q += ' ORDER BY {} {}'.format(order[0], order[1])
+        condition = condition or {}
+        filters = filters or []
+        sort_column, direction = order if order is not None and len(order) == 2 else ('id', 'asc')
+        values = [condition[column] for column in condition.keys() if condition[column] is not None]
+        filter_shapes = []
+        for column, operator, value in filters:
+            if operator == 'eq':
+                shape = None if value is None else '{} = %s'
+                values += [] if value is None else [value]
+            elif operator == 'in':
+                shape = '{} = ANY(%s)'
+                values.append(array_literal(value))
+            elif operator == 'range':
+                low, high = value
+                shape = ' AND '.join((['{0} >= %s'] if low is not None else []) +
+                                     (['{0} <= %s'] if high is not None else []))
+                values += [bound for bound in value if bound is not None]
+            elif operator == 'prefix':
+                shape = '{}::text LIKE %s'
+                values.append(like_escape(value) + '%')
+            elif operator == 'not_null':
+                shape = '{} IS NOT NULL'
+            else:
+                raise ValueError('Unknown filter operator {}'.format(operator))
+            filter_shapes.append((column, operator, shape))
+        after_null = None if after is None else after[0] is None
+        if after is not None:
+            values += [after[1]] if sort_column == 'id' or after_null else [after[0], after[1]]
+        if limit is not None:
+            values.append(limit)
 
-        return self.__execute_sql(sql_q)
+        def build():
+            select_columns = columns
+            if children:
+                select_columns = ', '.join(['{}.{}'.format(table_name, column.strip()) for column in columns.split(',')]
+                                           + self.children_columns(table_name, children))
+            sql_q = 'SELECT {} FROM {}'.format(select_columns, table_name)
+            where = ['{} IS NULL'.format(column) if condition[column] is None else '{} = %s'.format(column)
+                     for column in condition.keys()]
+            where += ['{} IS NULL'.format(column) if shape is None else shape.format(column)
+                      for column, operator, shape in filter_shapes if shape != '']
+            # Records are always ordered by id as a tie-breaker, so (sort_value, id) is unique
+            # and the next page can be found by an index seek instead of an OFFSET scan
+            comparison = '<' if direction == 'desc' else '>'
+            if after is not None:
+                if sort_column == 'id':
+                    where.append('id {} %s'.format(comparison))
+                elif after_null:
+                    # NULLs aren't comparable, they are last in ascending order and first in descending
+                    where.append('{} IS NULL AND id {} %s'.format(sort_column, comparison))
+                else:
+                    where.append('({}, id) {} (%s, %s)'.format(sort_column, comparison))
+            if where:
+                sql_q += ' WHERE ' + ' AND '.join(where)
+            if sort_column == 'id':
+                sql_q += ' ORDER BY id {}'.format(direction)
+            else:
+                sql_q += ' ORDER BY {0} {1}, id {1}'.format(sort_column, direction)
+            if limit is not None:
+                sql_q += ' LIMIT %s'
+            return sql_q
 
-    def close(self):
+        key = ('select', table_name, columns, tuple((column, condition[column] is None) for column in condition.keys()),
+               sort_column, direction, after_null, limit is not None, tuple(children or ()),
+               tuple(filter_shapes))
+        return self.__statement(key, build), tuple(values)
+
+    def explain(self, query, values=None, analyze=False, force_index=False):
         """
-        Close db connection.
+        Get the execution plan of a query. The query is run in a transaction that is rolled back.
+        :param query: query template string with '%s' instead of value.
+        :param values: values (if there is need) of sql query.
+        :param analyze: bool, execute the query and add actual times to the plan.
+        :param force_index: bool, make sequential scans unattractive to the planner, so that
+        the plan shows whether an index can be used at all (even on small tables).
+        :return: plan as a dict (EXPLAIN FORMAT JSON).
+        """
+        options = 'ANALYZE, FORMAT JSON' if analyze else 'FORMAT JSON'
+        with self.pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    if force_index:
+                        cursor.execute('SET LOCAL enable_seqscan = off;')
+                    cursor.execute('EXPLAIN ({}) {}'.format(options, query), values or None)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    return plan[0]['Plan']
+            finally:
+                conn.rollback()
+
+    def select_sums(self, table_name, columns, group_by=None):
+        """
+        Sum columns of a table, e.g. of aggregate tables split into slots.
+        :param table_name: str, name of table.
+        :param columns: list of str, summed columns, sums have the same names.
+        :param group_by: str, column to group by, sums are ordered by it.
+        :return: list of dicts with group_by column and sums.
         """
-        self.conn.close()
+        def build():
+            sums = ', '.join(['coalesce(sum({0}), 0)::BIGINT AS {0}'.format(column) for column in columns])
+            if group_by is None:
+                return 'SELECT {} FROM {};'.format(sums, table_name)
+            return 'SELECT {0}, {1} FROM {2} GROUP BY {0} ORDER BY {0};'.format(group_by, sums, table_name)
+        sql_q = self.__statement(('select_sums', table_name, tuple(columns), group_by), build)
+        return self.__execute_sql(query=sql_q, prepare=True)
 
-    def complete_transaction(self):
-        self.conn.commit()
+    def select_version(self, table_name, id, children=None):
+        """
+        Get the version of a record without reading it: the id of the transaction that last changed it
+        and, for each child table, the number of child records and the last transaction that changed one of them
+        (a deleted child leaves no transaction id, but changes the number).
+        :param table_name: str, name of table.
+        :param id: int, id of the record.
+        :param children: dict where key is a child table name and value is its foreign key column.
+        :return: dict {'change_txid': ..., child table name: [count, change_txid]} or None if there is no record.
+        """
+        children = children or {}
+
+        def build():
+            columns = ['{}.change_txid'.format(table_name)] + [
+                "(SELECT ARRAY[count(*), coalesce(max({0}.change_txid), 0)] FROM {0} "
+                "WHERE {0}.{1} = {2}.id) AS {0}".format(child_table, foreign_key, table_name)
+                for child_table, foreign_key in children.items()]
+            return 'SELECT {} FROM {} WHERE id = %s;'.format(', '.join(columns), table_name)
+        sql_q = self.__statement(('select_version', table_name, tuple(children.items())), build)
+        result = self.__execute_sql(query=sql_q, values=(id,), prepare=True)
+        return result[0] if result else None
+
+    def snapshot_xmin(self):
+        """
+        Id of the oldest transaction that is still running: all transactions with smaller ids
+        are committed or rolled back, so their changes are final.
+        :return: int.
+        """
+        sql_q = self.__statement(('snapshot_xmin',),
+                                 lambda: 'SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin;')
+        return self.__execute_sql(query=sql_q, prepare=True)[0]['xmin']
+
+    def select_parents(self, table_name, child_table, foreign_key, condition):
+        """
+        Get records referenced by child records that meet a given condition,
+        e.g. users that own a phone number.
+        :param table_name: str, name of the parent table.
+        :param child_table: str, name of the child table.
+        :param foreign_key: str, column of the child table that references the parent.
+        :param condition: dict of conditions on child records where key(column_name)=value(record_value).
+        :return: list of parent records.
+        """
+        conditions = ' AND '.join(['{} = %s'.format(column) for column in condition.keys()])
+        sql_q = 'SELECT * FROM {} WHERE id IN (SELECT {} FROM {} WHERE {}) ORDER BY id;'.format(
+            table_name, foreign_key, child_table, conditions)
+        return self.__execute_sql(query=sql_q, values=tuple(condition.values()))
+
+    def update_many(self, table_name, column_names, values):
+        """
+        Update fields of many records with one query.
+        :param table_name: str, name of table.
+        :param column_names: list of str, names of updated columns.
+        :param values: list of tuples (id, values of columns in order of column_names).
+        :return: list of identifications of updated records.
+        """
+        sql_q = 'UPDATE {0} SET {1} FROM (VALUES %s) AS new_values (id, {2}) WHERE {0}.id = new_values.id ' \
+                'RETURNING {0}.id;'.format(table_name,
+                                           ','.join(['{0} = new_values.{0}'.format(column) for column in column_names]),
+                                           ','.join(column_names))
+        with self.transaction() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                return psycopg2.extras.execute_values(cursor, sql_q, values, page_size=len(values), fetch=True)
+
+    def search(self, table_name, text, fields, limit, candidates):
+        """
+        Find records by substring or similar text (pg_trgm) and rank them by similarity.
+        :param table_name: str, name of table of found records.
+        :param text: str, text to search.
+        :param fields: list of tuples (table name, column, column with id of the found record), e.g.
+        ('emails', 'email', 'user_id') finds users by emails.
+        :param limit: int, max number of found records.
+        :param candidates: int, max number of best matches taken from each field.
+        :return: list of found records with field ('table.column'), value and score of their best match.
+        """
+        pattern = '%{}%'.format(like_escape(text))
+        matches = []
+        values = []
+        for field_table, column, id_column in fields:
+            # Most similar values by an ordered scan of the GiST trigram index (<<-> is 1 - word_similarity),
+            # it stops after candidates rows instead of scoring every match of a common text
+            matches.append(
+                "(SELECT {2} AS id, '{0}.{1}' AS field, {1}::text AS value, 1 - (%s <<-> {1}) AS score "
+                "FROM {0} WHERE %s <%% {1} ORDER BY %s <<-> {1} LIMIT %s)".format(field_table, column, id_column))
+            # Substrings inside words are not similar enough, any candidates of them are taken
+            matches.append(
+                "(SELECT {2} AS id, '{0}.{1}' AS field, {1}::text AS value, word_similarity(%s, {1}) AS score "
+                "FROM {0} WHERE {1} ILIKE %s LIMIT %s)".format(field_table, column, id_column))
+            values += [text, text, text, candidates, text, pattern, candidates]
+        sql_q = 'SELECT {0}.*, best.field, best.value, best.score FROM (' \
+                'SELECT DISTINCT ON (id) id, field, value, score FROM ({1}) AS matches ' \
+                'ORDER BY id, score DESC) AS best JOIN {0} ON {0}.id = best.id ' \
+                'ORDER BY best.score DESC, best.id LIMIT %s;'.format(table_name, ' UNION ALL '.join(matches))
+        values.append(limit)
+        return self.__execute_sql(query=sql_q, values=tuple(values))
+
+    def reserve_ids(self, table_name, count):
+        """
+        Take count values of the id sequence of a table, so that ids of new records are known before inserting.
+        :param table_name: str, name of table.
+        :param count: int, number of ids.
+        :return: list of int ids.
+        """
+        sql_q = 'SELECT nextval(pg_get_serial_sequence(%s, \'id\')) AS id FROM generate_series(1, %s);'
+        result = self.__execute_sql(query=sql_q, values=(table_name, count))
+        return [record['id'] for record in result]
+
+    def copy_from(self, table_name, column_names, file):
+        """
+        Load csv data into the table with 'COPY FROM STDIN'.
+        :param table_name: str, name of table.
+        :param column_names: list of str, names of columns in order of csv fields.
+        :param file: file-like object with csv data (without header).
+        :return: number of loaded records.
+        """
+        sql_q = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table_name, ','.join(column_names))
+        with self.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(sql_q, file)
+                return cursor.rowcount
+
+    @staticmethod
+    def children_columns(table_name, children):
+        """
+        Get select columns with child records of a table record aggregated to a json list.
+        :param table_name: str, name of the parent table.
+        :param children: dict where key is a child table name and value is its foreign key column.
+        :return: list of str, column expressions named as child tables.
+        """
+        return ["(SELECT coalesce(json_agg({0} ORDER BY {0}.id), '[]'::json) FROM {0} "
+                "WHERE {0}.{1} = {2}.id) AS {0}".format(child_table, foreign_key, table_name)
+                for child_table, foreign_key in children.items()]
+
+    def copy_to(self, table_name, file, data_format='csv', children=None):
+        """
+        Write all records of the table to the file with 'COPY TO STDOUT'.
+        :param table_name: str, name of table.
+        :param file: binary file-like object to write to.
+        :param data_format: 'csv' (with header) or 'binary'.
+        :param children: dict where key is a child table name and value is its foreign key column,
+        child records are added to each record as json lists.
+        """
+        source = table_name
+        if children:
+            source = '(SELECT {0}.*, {1} FROM {0} ORDER BY {0}.id)'.format(
+                table_name, ', '.join(self.children_columns(table_name, children)))
+        options = 'FORMAT binary' if data_format == 'binary' else 'FORMAT csv, HEADER'
+        sql_q = 'COPY {} TO STDOUT WITH ({})'.format(source, options)
+        with self.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(sql_q, file)
+
+    def close(self):
+        """
+        Close db connections.
+        """
+        self.pool.closeall()
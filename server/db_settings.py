@@ -1,8 +1,17 @@
 DB_TABLES = {
     'users': {
         'primary': 'id',
-        'fields': ['id', 'name', 'photo_path', 'gender', 'born_at', 'address'],
+        'fields': ['id', 'name', 'photo_path', 'gender', 'born_at', 'address', 'updated_at'],
+        # Columns with an index on (column, id), lists can be sorted by them
+        'sortable': ['id', 'name', 'gender', 'born_at'],
+        # Columns with a trigram index, contacts are searched by them
+        'searchable': ['name', 'address'],
         'required': ['name', 'photo_path', 'gender', 'born_at', 'address'],
+        # Tables referencing users, key - table name, value - foreign key column
+        'children': {
+            'emails': 'user_id',
+            'phones': 'user_id'
+        },
         'object_name': {
             'singular': 'User',
             'plural': 'Users'
@@ -46,7 +55,9 @@ DB_TABLES = {
     },
     'phones': {
         'primary': 'id',
-        'fields': ['id', 'user_id', 'type', 'number'],
+        'fields': ['id', 'user_id', 'type', 'number', 'number_normalized', 'updated_at'],
+        'sortable': ['id', 'user_id', 'type', 'number'],
+        'searchable': ['number'],
         'required': ['user_id', 'type', 'number'],
         'object_name': {
             'singular': 'Phone',
@@ -70,11 +81,22 @@ DB_TABLES = {
                 'VALID_TYPE': 'REGULAR',
                 'CONDITION': r'^(\+)?((\d{2,3}) ?\d|\d)(([ -]?\d)|( ?(\d{2,3}) ?)){5,12}\d$'
             }]
+        },
+        # Canonical forms of fields, written to their own columns for exact lookups
+        'normalization': {
+            'number': {
+                'NORMAL_TYPE': 'DIGITS',
+                'COLUMN': 'number_normalized'
+            }
         }
     },
     'emails': {
         'primary': 'id',
-        'fields': ['id', 'user_id', 'type', 'email'],
+        'fields': ['id', 'user_id', 'type', 'email', 'email_normalized', 'updated_at'],
+        'sortable': ['id', 'user_id', 'type', 'email'],
+        # Sortable columns that can be NULL, pages continue past the NULLs (see get_data)
+        'nullable': ['email'],
+        'searchable': ['email'],
         'required': ['user_id', 'type', 'email'],
         'object_name': {
             'singular': 'Email',
@@ -98,6 +120,12 @@ DB_TABLES = {
                 'VALID_TYPE': 'REGULAR',
                 'CONDITION': r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'
             }]
+        },
+        'normalization': {
+            'email': {
+                'NORMAL_TYPE': 'LOWER',
+                'COLUMN': 'email_normalized'
+            }
         }
     }
 }
@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import tempfile
+
+# Every worker answers /metrics with the sum of metrics of all workers, shared through the directory
+os.environ.setdefault('METRICS_DIRECTORY', os.path.join(tempfile.gettempdir(), 'contacts-metrics'))
+
+import metrics  # noqa: E402
+from settings import HOST, PORT, METRICS_DIRECTORY  # noqa: E402
+
+# Prefork server: the app is imported once by the master, workers are forked from it
+# and open their own db connections (post_fork). Connections of all workers:
+# workers * (DB_POOL_MAX_SIZE + 1 listener).
+wsgi_app = 'app:app'
+bind = '{}:{}'.format(HOST, PORT)
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+preload_app = True
+
+# Workers are restarted after a random number of requests in [max_requests, max_requests + jitter],
+# so that they don't restart at once
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 1000))
+# Seconds to finish requests in progress on restart and on HUP (graceful restart of workers,
+# the code is preloaded by the master, so new code needs a restart of the server)
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # Metrics of a previous run of the server
+    metrics.clear_directory(METRICS_DIRECTORY)
+
+
+def post_fork(server, worker):
+    # Runs in the worker before it accepts requests
+    import business_logic as bl
+    bl.start_worker()
+
+
+def worker_exit(server, worker):
+    # Runs in the worker, the last values since the periodic write
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    # Runs in the master, counters of the exited worker stay in the totals
+    metrics.mark_process_dead(METRICS_DIRECTORY, worker.pid)
@@ -0,0 +1,261 @@
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# Metrics of the process in order of registration, rendered by render()
+REGISTRY = []
+# Values of exited processes of a multiprocess directory
+ARCHIVE_FILE = 'archive.json'
+
+# Directory shared by the processes of the server (start_multiprocess), None - metrics of this process only
+_directory = None
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Metric of the process exposed in Prometheus text format.
+        :param name: str, metric name.
+        :param documentation: str, help text.
+        :param labelnames: tuple of str, names of labels, values are passed to methods as keyword arguments.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}   # label values -> value
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def values(self):
+        """
+        :return: dict {tuple of label values: value}, a copy.
+        """
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(value, other):
+        # Values of several processes are summed
+        return value + other
+
+    def lines(self, values):
+        raise NotImplementedError
+
+    def render(self, values=None):
+        return ['# HELP {} {}'.format(self.name, self.documentation),
+                '# TYPE {} {}'.format(self.name, self.kind)] + self.lines(self.values() if values is None else values)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self, values):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, key), format_value(value))
+                for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Counts of buckets (the last one is +Inf) and the sum of observed values
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def values(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    @staticmethod
+    def merge(value, other):
+        return [count + other_count for count, other_count in zip(value, other)]
+
+    def lines(self, values):
+        lines = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labelnames, key,
+                                                                              [('le', format_value(bound))]),
+                                                     cumulative))
+            labels = format_labels(self.labelnames, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels, format_value(counts[-1])))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class CallbackMetric(Metric):
+    def __init__(self, name, kind, documentation, callback, labelnames=()):
+        """
+        Metric read from another object when metrics are rendered, e.g. stats of the cache.
+        :param kind: str, 'gauge' or 'counter'.
+        :param callback: function without arguments that returns the value, or a dict
+        {tuple of label values: value} if the metric has labels.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.callback = callback
+
+    def values(self):
+        values = self.callback()
+        return values if self.labelnames else {(): values}
+
+    def lines(self, values):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, key), format_value(value))
+                for key, value in values.items()]
+
+
+def collect():
+    """
+    :return: dict {metric name: {tuple of label values: value}} of this process.
+    """
+    return {metric.name: metric.values() for metric in REGISTRY}
+
+
+def merge_values(total, values, counters_only=False):
+    # Add values of a process to the total, gauges are added for processes that are alive only
+    for metric in REGISTRY:
+        if counters_only and metric.kind == 'gauge':
+            continue
+        total_values = total.setdefault(metric.name, {})
+        for key, value in values.get(metric.name, {}).items():
+            total_values[key] = metric.merge(total_values[key], value) if key in total_values else value
+
+
+def write_values(directory, file_name, values):
+    # Values are replaced atomically, readers never see a partly written file
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as file:
+        json.dump({name: [[list(key), value] for key, value in metric_values.items()]
+                   for name, metric_values in values.items()}, file)
+    os.replace(file.name, os.path.join(directory, file_name))
+
+
+def read_values(file_path):
+    try:
+        with open(file_path) as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return {name: {tuple(key): value for key, value in metric_values} for name, metric_values in data.items()}
+
+
+def flush():
+    # Write values of this process to the multiprocess directory
+    if _directory is not None:
+        write_values(_directory, '{}.json'.format(os.getpid()), collect())
+
+
+def start_multiprocess(directory, interval):
+    """
+    Share metrics between the processes of the server: every process writes its values to the directory
+    every interval seconds, render() sums values of all processes, so any process shows metrics of the server.
+    Counters and histograms of exited processes are kept (mark_process_dead), gauges are of live processes.
+    :param directory: str, directory of the server, cleared by clear_directory when the server starts.
+    :param interval: float, seconds, values of other processes are up to that old.
+    :return: threading.Thread.
+    """
+    global _directory
+    _directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+    def write():
+        while True:
+            try:
+                flush()
+            except OSError as e:
+                print('Metrics are not written: {}'.format(e))
+            time.sleep(interval)
+    thread = threading.Thread(target=write, name='metrics', daemon=True)
+    thread.start()
+    return thread
+
+
+def mark_process_dead(directory, pid):
+    """
+    Move counters and histograms of an exited process to the archive of the directory, its gauges are dropped.
+    Called by a single process (the gunicorn master), so the archive isn't locked.
+    """
+    file_path = os.path.join(directory, '{}.json'.format(pid))
+    if not os.path.exists(file_path):
+        return
+    archive = read_values(os.path.join(directory, ARCHIVE_FILE))
+    merge_values(archive, read_values(file_path), counters_only=True)
+    write_values(directory, ARCHIVE_FILE, archive)
+    os.remove(file_path)
+
+
+def clear_directory(directory):
+    # Values of a previous run of the server
+    os.makedirs(directory, exist_ok=True)
+    for file_path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(file_path)
+
+
+def render():
+    """
+    Metrics in Prometheus text exposition format: of the server if metrics are shared by its processes,
+    otherwise of this process.
+    """
+    values = None
+    if _directory is not None:
+        flush()
+        values = {}
+        for file_path in glob.glob(os.path.join(_directory, '*.json')):
+            merge_values(values, read_values(file_path))
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render(None if values is None else values.get(metric.name, {}))
+    return '\n'.join(lines) + '\n'
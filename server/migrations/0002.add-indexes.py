@@ -0,0 +1,46 @@
+from yoyo import step
+
+# CREATE INDEX CONCURRENTLY doesn't lock writes, but can't be run inside a transaction
+__transactional__ = False
+
+steps = [
+    # Foreign keys: used by ON DELETE CASCADE, user emails/phones lookups and embedding.
+    # id is added so the indexes also serve 'ORDER BY user_id, id' pages
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS emails_user_id_idx ON emails (user_id, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS emails_user_id_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS phones_user_id_idx ON phones (user_id, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS phones_user_id_idx"
+    ),
+    # Sortable columns: pages are ordered by (column, id)
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_name_idx ON users (name, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS users_name_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_born_at_idx ON users (born_at, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS users_born_at_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_gender_idx ON users (gender, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS users_gender_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS emails_type_idx ON emails (type, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS emails_type_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS emails_email_idx ON emails (email, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS emails_email_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS phones_type_idx ON phones (type, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS phones_type_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS phones_number_idx ON phones (number, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS phones_number_idx"
+    ),
+]
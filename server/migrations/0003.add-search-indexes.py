@@ -0,0 +1,16 @@
+from yoyo import step
+
+__transactional__ = False
+
+# Trigram indexes serve similarity operators and ILIKE '%substring%'. GiST indexes also return rows
+# ordered by distance (<<->), so search reads only the best matches
+TRIGRAM_COLUMNS = (('users', 'name'), ('users', 'address'), ('emails', 'email'), ('phones', 'number'))
+
+steps = [step("CREATE EXTENSION IF NOT EXISTS pg_trgm")] + [
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS {0}_{1}_trgm_idx ON {0} USING gist ({1} gist_trgm_ops)".format(
+            table_name, column),
+        "DROP INDEX CONCURRENTLY IF EXISTS {}_{}_trgm_idx".format(table_name, column)
+    )
+    for table_name, column in TRIGRAM_COLUMNS
+]
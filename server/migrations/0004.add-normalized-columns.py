@@ -0,0 +1,24 @@
+from yoyo import step
+
+__transactional__ = False
+
+steps = [
+    # Canonical forms for exact lookups, filled on write and by scripts/backfill_normalized.py
+    step(
+        "ALTER TABLE phones ADD COLUMN IF NOT EXISTS number_normalized VARCHAR(20)",
+        "ALTER TABLE phones DROP COLUMN IF EXISTS number_normalized"
+    ),
+    step(
+        "ALTER TABLE emails ADD COLUMN IF NOT EXISTS email_normalized VARCHAR(255)",
+        "ALTER TABLE emails DROP COLUMN IF EXISTS email_normalized"
+    ),
+    # Numbers and emails may be shared by several users, so the indexes are not unique
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS phones_number_normalized_idx ON phones USING hash (number_normalized)",
+        "DROP INDEX CONCURRENTLY IF EXISTS phones_number_normalized_idx"
+    ),
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS emails_email_normalized_idx ON emails USING hash (email_normalized)",
+        "DROP INDEX CONCURRENTLY IF EXISTS emails_email_normalized_idx"
+    ),
+]
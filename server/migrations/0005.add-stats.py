@@ -0,0 +1,161 @@
+from yoyo import step
+
+# Aggregates of users, emails and phones, kept current by statement-level triggers with transition tables.
+# Every aggregate row is split into STATS_SLOTS slots, a transaction updates the slot of its backend,
+# so concurrent writers don't wait for each other on one counter row. Readers sum the slots.
+STATS_SLOTS = 16
+
+steps = [
+    # No writes between the backfill and the triggers
+    step("LOCK TABLE users, emails, phones IN SHARE MODE"),
+    step(
+        "CREATE TABLE stats_users_by_gender (gender gender_type NOT NULL, slot SMALLINT NOT NULL, "
+        "users BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (gender, slot))",
+        "DROP TABLE stats_users_by_gender"
+    ),
+    step(
+        "CREATE TABLE stats_users_by_birth_year (year INTEGER NOT NULL, slot SMALLINT NOT NULL, "
+        "users BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (year, slot))",
+        "DROP TABLE stats_users_by_birth_year"
+    ),
+    step(
+        "CREATE TABLE stats_totals (slot SMALLINT PRIMARY KEY NOT NULL, users BIGINT NOT NULL DEFAULT 0, "
+        "emails BIGINT NOT NULL DEFAULT 0, phones BIGINT NOT NULL DEFAULT 0)",
+        "DROP TABLE stats_totals"
+    ),
+    step(
+        """CREATE FUNCTION stats_slot() RETURNS SMALLINT AS $$
+           SELECT (pg_backend_pid() % {})::SMALLINT;
+           $$ LANGUAGE sql STABLE""".format(STATS_SLOTS),
+        "DROP FUNCTION stats_slot()"
+    ),
+    # Inserted or deleted users, rows of the statement are in changed_users
+    step(
+        """CREATE FUNCTION stats_users_changed() RETURNS trigger AS $$
+           DECLARE
+               sign INTEGER := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+           BEGIN
+               INSERT INTO stats_users_by_gender AS stats (gender, slot, users)
+               SELECT gender, stats_slot(), sign * count(*) FROM changed_users GROUP BY gender
+               ON CONFLICT (gender, slot) DO UPDATE SET users = stats.users + EXCLUDED.users;
+               INSERT INTO stats_users_by_birth_year AS stats (year, slot, users)
+               SELECT extract(year FROM born_at)::INTEGER, stats_slot(), sign * count(*) FROM changed_users GROUP BY 1
+               ON CONFLICT (year, slot) DO UPDATE SET users = stats.users + EXCLUDED.users;
+               INSERT INTO stats_totals AS stats (slot, users)
+               SELECT stats_slot(), sign * count(*) FROM changed_users HAVING count(*) > 0
+               ON CONFLICT (slot) DO UPDATE SET users = stats.users + EXCLUDED.users;
+               RETURN NULL;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION stats_users_changed()"
+    ),
+    # Updated users, only changes of gender and birth year touch the aggregates
+    step(
+        """CREATE FUNCTION stats_users_updated() RETURNS trigger AS $$
+           BEGIN
+               INSERT INTO stats_users_by_gender AS stats (gender, slot, users)
+               SELECT gender, stats_slot(), sum(delta) FROM (
+                   SELECT gender, 1 AS delta FROM new_users UNION ALL SELECT gender, -1 FROM old_users
+               ) AS changes GROUP BY gender HAVING sum(delta) <> 0
+               ON CONFLICT (gender, slot) DO UPDATE SET users = stats.users + EXCLUDED.users;
+               INSERT INTO stats_users_by_birth_year AS stats (year, slot, users)
+               SELECT year, stats_slot(), sum(delta) FROM (
+                   SELECT extract(year FROM born_at)::INTEGER AS year, 1 AS delta FROM new_users
+                   UNION ALL SELECT extract(year FROM born_at)::INTEGER, -1 FROM old_users
+               ) AS changes GROUP BY year HAVING sum(delta) <> 0
+               ON CONFLICT (year, slot) DO UPDATE SET users = stats.users + EXCLUDED.users;
+               RETURN NULL;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION stats_users_updated()"
+    ),
+    # Inserted or deleted emails and phones (deleted by cascade too), the counter column is the table name
+    step(
+        """CREATE FUNCTION stats_records_changed() RETURNS trigger AS $$
+           BEGIN
+               EXECUTE format('INSERT INTO stats_totals AS stats (slot, %1$I) '
+                              'SELECT stats_slot(), $1 * count(*) FROM changed_records HAVING count(*) > 0 '
+                              'ON CONFLICT (slot) DO UPDATE SET %1$I = stats.%1$I + EXCLUDED.%1$I', TG_TABLE_NAME)
+               USING CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+               RETURN NULL;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION stats_records_changed()"
+    ),
+    step(
+        """CREATE FUNCTION stats_truncated() RETURNS trigger AS $$
+           BEGIN
+               IF TG_TABLE_NAME = 'users' THEN
+                   DELETE FROM stats_users_by_gender;
+                   DELETE FROM stats_users_by_birth_year;
+               END IF;
+               EXECUTE format('UPDATE stats_totals SET %I = 0', TG_TABLE_NAME);
+               RETURN NULL;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION stats_truncated()"
+    ),
+    step(
+        "CREATE TRIGGER stats_users_inserted AFTER INSERT ON users REFERENCING NEW TABLE AS changed_users "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_users_changed()",
+        "DROP TRIGGER stats_users_inserted ON users"
+    ),
+    step(
+        "CREATE TRIGGER stats_users_deleted AFTER DELETE ON users REFERENCING OLD TABLE AS changed_users "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_users_changed()",
+        "DROP TRIGGER stats_users_deleted ON users"
+    ),
+    step(
+        "CREATE TRIGGER stats_users_updated AFTER UPDATE ON users "
+        "REFERENCING OLD TABLE AS old_users NEW TABLE AS new_users "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_users_updated()",
+        "DROP TRIGGER stats_users_updated ON users"
+    ),
+    step(
+        "CREATE TRIGGER stats_emails_inserted AFTER INSERT ON emails REFERENCING NEW TABLE AS changed_records "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_records_changed()",
+        "DROP TRIGGER stats_emails_inserted ON emails"
+    ),
+    step(
+        "CREATE TRIGGER stats_emails_deleted AFTER DELETE ON emails REFERENCING OLD TABLE AS changed_records "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_records_changed()",
+        "DROP TRIGGER stats_emails_deleted ON emails"
+    ),
+    step(
+        "CREATE TRIGGER stats_phones_inserted AFTER INSERT ON phones REFERENCING NEW TABLE AS changed_records "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_records_changed()",
+        "DROP TRIGGER stats_phones_inserted ON phones"
+    ),
+    step(
+        "CREATE TRIGGER stats_phones_deleted AFTER DELETE ON phones REFERENCING OLD TABLE AS changed_records "
+        "FOR EACH STATEMENT EXECUTE FUNCTION stats_records_changed()",
+        "DROP TRIGGER stats_phones_deleted ON phones"
+    ),
+    step(
+        "CREATE TRIGGER stats_users_truncated AFTER TRUNCATE ON users FOR EACH STATEMENT "
+        "EXECUTE FUNCTION stats_truncated()",
+        "DROP TRIGGER stats_users_truncated ON users"
+    ),
+    step(
+        "CREATE TRIGGER stats_emails_truncated AFTER TRUNCATE ON emails FOR EACH STATEMENT "
+        "EXECUTE FUNCTION stats_truncated()",
+        "DROP TRIGGER stats_emails_truncated ON emails"
+    ),
+    step(
+        "CREATE TRIGGER stats_phones_truncated AFTER TRUNCATE ON phones FOR EACH STATEMENT "
+        "EXECUTE FUNCTION stats_truncated()",
+        "DROP TRIGGER stats_phones_truncated ON phones"
+    ),
+    # Aggregates of existing records
+    step(
+        "INSERT INTO stats_users_by_gender (gender, slot, users) SELECT gender, 0, count(*) FROM users GROUP BY gender"
+    ),
+    step(
+        "INSERT INTO stats_users_by_birth_year (year, slot, users) "
+        "SELECT extract(year FROM born_at)::INTEGER, 0, count(*) FROM users GROUP BY 1"
+    ),
+    step(
+        "INSERT INTO stats_totals (slot, users, emails, phones) "
+        "SELECT 0, (SELECT count(*) FROM users), (SELECT count(*) FROM emails), (SELECT count(*) FROM phones)"
+    ),
+]
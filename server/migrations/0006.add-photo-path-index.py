@@ -0,0 +1,11 @@
+from yoyo import step
+
+__transactional__ = False
+
+steps = [
+    # Photo files are shared by users with the same photo, a file is removed when no user references it
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_photo_path_idx ON users USING hash (photo_path)",
+        "DROP INDEX CONCURRENTLY IF EXISTS users_photo_path_idx"
+    ),
+]
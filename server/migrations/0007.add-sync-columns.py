@@ -0,0 +1,71 @@
+from yoyo import step
+
+# Incremental sync: every row has the id of the transaction that last wrote it (change_txid), deletes leave
+# tombstones. Changes of transactions before the xmin of a snapshot never appear later, so xmin is the watermark.
+SYNC_TABLES = ('users', 'emails', 'phones')
+
+steps = [
+    # Existing rows are part of the first sync (change_txid 0), the defaults don't rewrite the tables
+    step(
+        "ALTER TABLE {} ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+        "ADD COLUMN change_txid BIGINT NOT NULL DEFAULT 0".format(table_name),
+        "ALTER TABLE {} DROP COLUMN updated_at, DROP COLUMN change_txid".format(table_name)
+    )
+    for table_name in SYNC_TABLES
+] + [
+    # record_id NULL - all records of the table were deleted (TRUNCATE)
+    step(
+        "CREATE TABLE sync_tombstones (id BIGSERIAL PRIMARY KEY NOT NULL, table_name VARCHAR(20) NOT NULL, "
+        "record_id BIGINT, change_txid BIGINT NOT NULL DEFAULT txid_current(), "
+        "deleted_at TIMESTAMPTZ NOT NULL DEFAULT now())",
+        "DROP TABLE sync_tombstones"
+    ),
+    step(
+        """CREATE FUNCTION sync_record_changed() RETURNS trigger AS $$
+           BEGIN
+               NEW.updated_at := now();
+               NEW.change_txid := txid_current();
+               RETURN NEW;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION sync_record_changed()"
+    ),
+    # Deleted rows of the statement are in deleted_records, including rows deleted by cascade
+    step(
+        """CREATE FUNCTION sync_records_deleted() RETURNS trigger AS $$
+           BEGIN
+               INSERT INTO sync_tombstones (table_name, record_id) SELECT TG_TABLE_NAME, id FROM deleted_records;
+               RETURN NULL;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION sync_records_deleted()"
+    ),
+    step(
+        """CREATE FUNCTION sync_table_truncated() RETURNS trigger AS $$
+           BEGIN
+               INSERT INTO sync_tombstones (table_name) VALUES (TG_TABLE_NAME);
+               RETURN NULL;
+           END;
+           $$ LANGUAGE plpgsql""",
+        "DROP FUNCTION sync_table_truncated()"
+    ),
+]
+
+for table_name in SYNC_TABLES:
+    steps += [
+        step(
+            "CREATE TRIGGER sync_{0}_changed BEFORE INSERT OR UPDATE ON {0} FOR EACH ROW "
+            "EXECUTE FUNCTION sync_record_changed()".format(table_name),
+            "DROP TRIGGER sync_{0}_changed ON {0}".format(table_name)
+        ),
+        step(
+            "CREATE TRIGGER sync_{0}_deleted AFTER DELETE ON {0} REFERENCING OLD TABLE AS deleted_records "
+            "FOR EACH STATEMENT EXECUTE FUNCTION sync_records_deleted()".format(table_name),
+            "DROP TRIGGER sync_{0}_deleted ON {0}".format(table_name)
+        ),
+        step(
+            "CREATE TRIGGER sync_{0}_truncated AFTER TRUNCATE ON {0} FOR EACH STATEMENT "
+            "EXECUTE FUNCTION sync_table_truncated()".format(table_name),
+            "DROP TRIGGER sync_{0}_truncated ON {0}".format(table_name)
+        ),
+    ]
@@ -0,0 +1,12 @@
+from yoyo import step
+
+__transactional__ = False
+
+steps = [
+    # Changes are read in (change_txid, id) order from a watermark, by an index seek
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS {0}_change_txid_id_idx ON {0} (change_txid, id)".format(table_name),
+        "DROP INDEX CONCURRENTLY IF EXISTS {}_change_txid_id_idx".format(table_name)
+    )
+    for table_name in ('users', 'emails', 'phones', 'sync_tombstones')
+]
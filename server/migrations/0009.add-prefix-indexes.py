@@ -0,0 +1,17 @@
+from yoyo import step
+
+__transactional__ = False
+
+# 'prefix' filters of lists ('col::text LIKE ...%') can't use the (column, id) indexes under a non-C collation,
+# text_pattern_ops indexes compare characters byte by byte and serve them. Filters of other columns
+# (e.g. dates, addresses) by prefix scan the table.
+PREFIX_COLUMNS = (('users', 'name'), ('emails', 'email'), ('phones', 'number'))
+
+steps = [
+    step(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS {0}_{1}_prefix_idx ON {0} ({1} text_pattern_ops)".format(
+            table_name, column),
+        "DROP INDEX CONCURRENTLY IF EXISTS {}_{}_prefix_idx".format(table_name, column)
+    )
+    for table_name, column in PREFIX_COLUMNS
+]
@@ -0,0 +1,316 @@
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:   # Pillow is optional, without it photos are served without renditions
+    Image = ImageOps = None
+
+PHOTO_DURATION = metrics.Histogram('photo_operation_duration_seconds', 'Time of photo file operations.',
+                                   labelnames=('operation',))
+PHOTO_ERRORS = metrics.Counter('photo_operation_errors_total', 'Failed background photo operations.',
+                               labelnames=('operation',))
+
+# Key of a content-addressed photo: two levels of shard directories and sha256 of the file content
+PHOTO_KEY = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$')
+# Key of a rendition: key of the photo, rendition name and '.jpg'
+RENDITION_KEY = re.compile(r'^([0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+)\.(\w+)\.jpg$')
+# Empty file named as a rendition of a photo that can't be decoded, its renditions aren't made again
+# and it is removed with renditions of the photo
+UNRENDERABLE = 'unrenderable'
+TEMP_DIRECTORY = 'tmp'
+LOCK_FILE = '.lock'
+CLEANUP_LOCK_FILE = '.cleanup.lock'
+
+
+class StagedPhoto:
+    def __init__(self, key, temp_path):
+        """
+        Uploaded photo written to a temporary file, it is moved to its key by PhotoStorage.finalize.
+        :param key: str, photo_path of the photo, e.g. 'ab/cd/abcd...ef.jpg'.
+        :param temp_path: str, path of the temporary file.
+        """
+        self.key = key
+        self.temp_path = temp_path
+
+
+class PhotoStorage:
+    def __init__(self, root, db, workers, chunk_size, orphan_grace, renditions=None, quality=85):
+        """
+        Content-addressed photo files: a photo is stored once under the sha256 of its bytes,
+        in a sharded directory tree ('ab/cd/<sha256>.<ext>'), users with the same photo share the file.
+        Files are moved into place, removed and cleaned up by a pool of background threads.
+        :param root: str, root directory of the storage.
+        :param db: DB, photos are removed only if no user references them.
+        :param workers: int, number of background threads.
+        :param chunk_size: int, bytes read from an upload at once.
+        :param orphan_grace: float, seconds an unreferenced file (or a temporary file) is kept before cleanup.
+        :param renditions: dict {name: max width and height in pixels} of downscaled jpeg copies of photos,
+        they are made in the background when a photo is finalized.
+        :param quality: int, jpeg quality of renditions.
+        """
+        self.root = root
+        self.db = db
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.orphan_grace = orphan_grace
+        self.renditions = renditions or {}
+        self.quality = quality
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        self._rendering = set()   # keys of photos with renditions being made
+
+    @property
+    def executor(self):
+        # Created on first use in each process: threads are not inherited by forked workers
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='photos')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def submit(self, operation, function, *args):
+        def run():
+            try:
+                with PHOTO_DURATION.time(operation=operation):
+                    function(*args)
+            except Exception as e:
+                PHOTO_ERRORS.inc(operation=operation)
+                print('Photo {} failed: {}'.format(operation, e))
+        return self.executor.submit(run)
+
+    def path(self, photo_path):
+        """
+        File path of a photo_path value. Photos saved before the content-addressed storage
+        are paths relative to the working directory or file names in the root.
+        :return: str or None if the path is outside of the root.
+        """
+        if PHOTO_KEY.match(photo_path) or RENDITION_KEY.match(photo_path):
+            return os.path.join(self.root, photo_path)
+        file_path = photo_path if os.path.dirname(photo_path) else os.path.join(self.root, photo_path)
+        root = os.path.realpath(self.root)
+        if os.path.commonpath([root, os.path.realpath(file_path)]) != root:
+            return None
+        return file_path
+
+    @contextmanager
+    def lock(self, key):
+        # Finalizing and removing a file are serialized per shard, between threads and processes
+        directory = os.path.join(self.root, os.path.dirname(key))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stage(self, photo_file):
+        """
+        Stream an upload to a temporary file of the storage and hash it.
+        :param photo_file: werkzeug FileStorage with an allowed file extension.
+        :return: StagedPhoto.
+        """
+        extension = photo_file.filename.rsplit('.', 1)[1].lower()
+        temp_directory = os.path.join(self.root, TEMP_DIRECTORY)
+        os.makedirs(temp_directory, exist_ok=True)
+        digest = hashlib.sha256()
+        with PHOTO_DURATION.time(operation='stage'):
+            with tempfile.NamedTemporaryFile(dir=temp_directory, suffix='.' + extension, delete=False) as temp:
+                try:
+                    while True:
+                        chunk = photo_file.stream.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        temp.write(chunk)
+                except BaseException:
+                    temp.close()
+                    os.remove(temp.name)
+                    raise
+        hex_digest = digest.hexdigest()
+        key = '{}/{}/{}.{}'.format(hex_digest[:2], hex_digest[2:4], hex_digest, extension)
+        return StagedPhoto(key, temp.name)
+
+    def finalize(self, staged):
+        # Called when the record referencing the photo is committed
+        self.submit('finalize', self._finalize, staged)
+
+    def discard(self, staged):
+        # Called when the record referencing the photo is not saved
+        self.submit('discard', self._remove_file, staged.temp_path)
+
+    def release(self, photo_path):
+        # Called when a record stopped referencing the photo, the file is removed if no other record references it
+        if photo_path:
+            self.submit('remove', self._remove_unreferenced, photo_path)
+
+    def cleanup(self):
+        self.submit('cleanup', self._cleanup)
+
+    def render(self, key):
+        # Make missing renditions of a stored photo, e.g. of a photo stored before renditions were added
+        if Image is None or os.path.exists(self.path(self.rendition_key(key, UNRENDERABLE))):
+            return
+        with self._executor_lock:
+            if key in self._rendering:
+                return
+            self._rendering.add(key)
+        self.submit('render', self._render, key)
+
+    @staticmethod
+    def rendition_key(key, name):
+        return '{}.{}.jpg'.format(key, name)
+
+    def find(self, photo_path, rendition=None):
+        """
+        Find the file of a photo to send.
+        :param photo_path: str, photo_path of a user.
+        :param rendition: str, name of a rendition, the original photo if None.
+        :return: dict with file 'path', strong 'etag' and 'immutable' - if the content of the url never changes,
+        or None if there is no such file (yet).
+        """
+        match = PHOTO_KEY.match(photo_path)
+        if match is None:
+            # Photo stored before the content-addressed storage, its file may be overwritten
+            file_path = self.path(photo_path)
+            if file_path is None:
+                return None
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return None
+            return {'path': file_path, 'etag': '{:x}-{:x}'.format(int(stat.st_mtime), stat.st_size),
+                    'immutable': False}
+        if rendition is not None and rendition in self.renditions:
+            file_path = self.path(self.rendition_key(photo_path, rendition))
+            if os.path.exists(file_path):
+                return {'path': file_path, 'etag': '{}.{}'.format(match.group(1), rendition), 'immutable': True}
+            # The original is sent until the rendition is made
+            self.render(photo_path)
+            result = self.find(photo_path)
+            if result is not None:
+                result['immutable'] = False
+            return result
+        file_path = self.path(photo_path)
+        if not os.path.exists(file_path):
+            return None
+        return {'path': file_path, 'etag': match.group(1), 'immutable': True}
+
+    def _finalize(self, staged):
+        target = self.path(staged.key)
+        with self.lock(staged.key):
+            if os.path.exists(target):
+                # The same photo is already stored
+                os.remove(staged.temp_path)
+            else:
+                with open(staged.temp_path, 'rb') as temp:
+                    os.fsync(temp.fileno())
+                os.replace(staged.temp_path, target)
+        self.render(staged.key)
+
+    def _render(self, key):
+        try:
+            original = self.path(key)
+            missing = {name: size for name, size in self.renditions.items()
+                       if not os.path.exists(self.path(self.rendition_key(key, name)))}
+            if not missing or not os.path.exists(original):
+                return
+            temp_directory = os.path.join(self.root, TEMP_DIRECTORY)
+            os.makedirs(temp_directory, exist_ok=True)
+            try:
+                with Image.open(original) as image:
+                    image = ImageOps.exif_transpose(image).convert('RGB')
+            except (OSError, ValueError, Image.DecompressionBombError):
+                # Not a decodable image, the original is served instead of renditions
+                open(self.path(self.rendition_key(key, UNRENDERABLE)), 'a').close()
+                raise
+            # Largest renditions first, each one is downscaled from the previous
+            for name, size in sorted(missing.items(), key=lambda item: -item[1]):
+                image.thumbnail((size, size), Image.LANCZOS)
+                with tempfile.NamedTemporaryFile(dir=temp_directory, suffix='.jpg', delete=False) as temp:
+                    try:
+                        image.save(temp, format='JPEG', quality=self.quality, optimize=True, progressive=True)
+                    except BaseException:
+                        temp.close()
+                        os.remove(temp.name)
+                        raise
+                os.replace(temp.name, self.path(self.rendition_key(key, name)))
+        finally:
+            with self._executor_lock:
+                self._rendering.discard(key)
+
+    def _remove_unreferenced(self, photo_path):
+        key = photo_path if PHOTO_KEY.match(photo_path) else os.path.basename(photo_path)
+        if self.path(photo_path) is None:
+            return
+        with self.lock(key):
+            if not self.db.existing_values('users', 'photo_path', [photo_path]):
+                self._remove_file(self.path(photo_path))
+                if PHOTO_KEY.match(photo_path):
+                    for name in list(self.renditions) + [UNRENDERABLE]:
+                        self._remove_file(self.path(self.rendition_key(photo_path, name)))
+
+    @staticmethod
+    def _remove_file(file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+    def _cleanup(self):
+        """
+        Remove photos that no user references and temporary files of lost uploads,
+        older than orphan_grace. Only one process of the host cleans up at a time.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, CLEANUP_LOCK_FILE), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            deadline = time.time() - self.orphan_grace
+            for directory, _, file_names in os.walk(self.root):
+                relative = os.path.relpath(directory, self.root)
+                old_files = [file_name for file_name in file_names if not file_name.startswith('.')
+                             and os.path.getmtime(os.path.join(directory, file_name)) < deadline]
+                if relative == TEMP_DIRECTORY:
+                    for file_name in old_files:
+                        self._remove_file(os.path.join(directory, file_name))
+                    continue
+                for file_name in old_files:
+                    # Renditions of removed photos, e.g. made after the photo was removed
+                    rendition = RENDITION_KEY.match(os.path.join(relative, file_name))
+                    if rendition is not None and not os.path.exists(self.path(rendition.group(1))):
+                        self._remove_file(os.path.join(directory, file_name))
+                keys = [os.path.join(relative, file_name) for file_name in old_files
+                        if PHOTO_KEY.match(os.path.join(relative, file_name))]
+                if not keys:
+                    continue
+                referenced = self.db.existing_values('users', 'photo_path', keys)
+                for key in keys:
+                    if key not in referenced:
+                        self._remove_unreferenced(key)
+
+    def start_cleanup(self, interval):
+        """
+        Run cleanup every interval seconds in a daemon thread.
+        :return: threading.Thread.
+        """
+        def schedule():
+            while True:
+                self.cleanup()
+                time.sleep(interval)
+        thread = threading.Thread(target=schedule, name='photos-cleanup', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from business_logic import db, NORMALIZERS  # noqa: E402
+from db_settings import DB_TABLES  # noqa: E402
+
+
+def backfill(table_name, column, context, batch_size):
+    """
+    Fill the normalized column of records written before it was added, batch by batch
+    in separate transactions, so that the table is never locked for long.
+    :return: number of updated records.
+    """
+    normalize = NORMALIZERS[context['NORMAL_TYPE']]
+    updated = 0
+    last_id = 0
+    while True:
+        records = db.select(table_name, 'id, {}'.format(column), condition={context['COLUMN']: None},
+                            order=('id', 'asc'), limit=batch_size, after=(None, last_id))
+        if not records:
+            break
+        last_id = records[-1]['id']
+        values = [(record['id'], normalize(record[column] or '')) for record in records]
+        updated += len(db.update_many(table_name, [context['COLUMN']], values))
+        print('{}: {} records updated'.format(table_name, updated))
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill normalized phone numbers and emails of existing records.')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+    for table_name, table in DB_TABLES.items():
+        for column, context in table.get('normalization', {}).items():
+            backfill(table_name, column, context, args.batch_size)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_access_layer import DB  # noqa: E402
+from db_settings import DB_TABLES  # noqa: E402
+from settings import PAGE_SIZE  # noqa: E402
+
+# Plan nodes that mean the query reads or sorts the whole table
+FULL_TABLE_NODES = ('Seq Scan', 'Sort')
+# Columns with a text_pattern_ops index (migration 0009), 'prefix' filters of other columns scan the table
+PREFIX_COLUMNS = {'users': ['name'], 'emails': ['email'], 'phones': ['number']}
+
+
+def plan_nodes(plan):
+    yield plan
+    for subplan in plan.get('Plans', []):
+        yield from plan_nodes(subplan)
+
+
+def query_shapes(table_name, record):
+    """
+    Queries of the shapes that get_data makes through DB.select.
+    :return: generator of (description, select params).
+    """
+    table = DB_TABLES[table_name]
+    page = PAGE_SIZE + 1
+    yield 'record by id', {'condition': {'id': record['id']}}
+    for column in table['sortable']:
+        for direction in ('asc', 'desc'):
+            order = (column, direction)
+            yield 'first page by {} {}'.format(column, direction), {'order': order, 'limit': page}
+            yield 'next page by {} {}'.format(column, direction), {
+                'order': order, 'limit': page, 'after': (record[column], record['id'])}
+            if column in table.get('nullable', ()):
+                # Pages in the NULLs of the column and the page crossing from them to the values
+                yield 'next page in NULLs by {} {}'.format(column, direction), {
+                    'order': order, 'limit': page, 'after': (None, record['id'])}
+                yield 'first page of values by {} {}'.format(column, direction), {
+                    'order': order, 'limit': page, 'filters': [(column, 'not_null', None)]}
+    # Filters of lists (get_filters): one filter of an indexed column, sorted by it or by id
+    for column in table['sortable']:
+        value = record[column]
+        if value is None:
+            continue
+        for operator, filter_value in (('eq', value), ('in', [value]), ('range', (value, None))):
+            for order in ((column, 'asc'), ()) if column != 'id' else ((),):
+                yield '{}__{} filter{}'.format(column, operator, ' sorted by it' if order else ''), {
+                    'order': order, 'limit': page, 'filters': [(column, operator, filter_value)]}
+    for column in PREFIX_COLUMNS.get(table_name, []):
+        if record[column]:
+            yield '{}__prefix filter'.format(column), {
+                'limit': page, 'filters': [(column, 'prefix', str(record[column])[:3])]}
+    children = table.get('children')
+    if children:
+        yield 'record by id with children', {'condition': {'id': record['id']}, 'children': children}
+        yield 'first page with children', {'limit': page, 'children': children}
+    for parent in DB_TABLES.values():
+        for child_table, foreign_key in parent.get('children', {}).items():
+            if child_table == table_name:
+                yield 'records by {}'.format(foreign_key), {
+                    'condition': {foreign_key: record[foreign_key]}, 'limit': page}
+
+
+def main():
+    db = DB()
+    failed = 0
+    for table_name in DB_TABLES:
+        sample = db.select(table_name, limit=1)
+        if not sample:
+            print('SKIP {}: table is empty'.format(table_name))
+            continue
+        for description, params in query_shapes(table_name, sample[0]):
+            query, values = db.select_query(table_name=table_name, **params)
+            plan = db.explain(query, values, force_index=True)
+            full_table = [node['Node Type'] for node in plan_nodes(plan) if node['Node Type'] in FULL_TABLE_NODES]
+            if full_table:
+                failed += 1
+                print('FAIL {}: {} ({})\n     {}'.format(table_name, description, ', '.join(full_table), query))
+            else:
+                indexes = sorted({node['Index Name'] for node in plan_nodes(plan) if 'Index Name' in node})
+                print('OK   {}: {} ({})'.format(table_name, description, ', '.join(indexes)))
+    db.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import argparse
+import gzip
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bulk_io  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a table with COPY TO STDOUT.')
+    parser.add_argument('table', choices=['users', 'emails', 'phones'])
+    parser.add_argument('--output', default='-', help='path to the output file, "-" for stdout')
+    parser.add_argument('--format', choices=['csv', 'binary'], default='csv')
+    parser.add_argument('--embed', action='store_true', help='add emails and phones to users as json lists')
+    parser.add_argument('--gzip', action='store_true', help='compress the output')
+    args = parser.parse_args()
+
+    file = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        if args.gzip:
+            with gzip.GzipFile(fileobj=file, mode='wb') as gzip_file:
+                bulk_io.export_table(gzip_file, args.table, data_format=args.format, embed=args.embed)
+        else:
+            bulk_io.export_table(file, args.table, data_format=args.format, embed=args.embed)
+    finally:
+        if file is not sys.stdout.buffer:
+            file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,95 +1,228 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import io
+import multiprocessing
 import os
-from urllib.parse import urlparse
-
-import psycopg2
-
-
-def generate_rows(rows_num=500):
-    # Connect to database
-    url = urlparse(os.environ.get('DATABASE_URL'))
-    db = "dbname=%s user=%s password=%s host=%s " % (url.path[1:], url.username, url.password, url.hostname)
-    conn = psycopg2.connect(db)
-
-    cur = conn.cursor()
-    create_f_sql = """CREATE OR REPLACE FUNCTION random_string(int, text)
-                      RETURNS text
-                      AS $$ 
-                      SELECT array_to_string(
-                          ARRAY (
-                              SELECT substring($2 
-                                FROM (random() *36)::int FOR 1)
-                              FROM generate_series(1, $1) ), '' ) 
-                      $$ LANGUAGE sql;"""
-    cur.execute(create_f_sql)
-
-    create_f_sql = """CREATE OR REPLACE FUNCTION random_email()
-                      RETURNS text
-                      AS $$ 
-                      SELECT array_to_string(
-                          ARRAY[
-                               random_string(20, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'), '@', 
-                               random_string(10, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'), '.',
-                               random_string(5, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
-                          ], '' )
-                      $$ LANGUAGE sql;"""
-    cur.execute(create_f_sql)
-
-    create_f_sql = """CREATE OR REPLACE FUNCTION random_gender(items gender_type[])
-                        RETURNS gender_type AS
-                        $$
-                        SELECT (items)[floor(random()*2+1)];
-                        $$ LANGUAGE SQL;"""
-    cur.execute(create_f_sql)
-
-    create_f_sql = """CREATE OR REPLACE FUNCTION random_phone_type(items phone_type[])
-                            RETURNS phone_type AS
-                            $$
-                            SELECT (items)[floor(random()*2+1)];
-                            $$ LANGUAGE SQL;"""
-    cur.execute(create_f_sql)
-
-    create_f_sql = """CREATE OR REPLACE FUNCTION random_email_type(items email_type[])
-                            RETURNS email_type AS
-                            $$
-                            SELECT (items)[floor(random()*2+1)];
-                            $$ LANGUAGE SQL;"""
-    cur.execute(create_f_sql)
-
-    sql = "INSERT INTO users(id, name, photo_path, gender, born_at, address)  " \
-          "SELECT id, " \
-          "random_string(40, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'), " \
-          "md5('path'||id), " \
-          "random_gender('{male,female}'::gender_type[]), " \
-          "to_timestamp(random()*2147483647), " \
-          "random_string(100, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') " \
-          "FROM generate_series(1," + str(rows_num) + ") AS gs(id);"
-
-    cur.execute(sql)
-    conn.commit()
-
-    sql = """INSERT INTO emails(id, user_id, email, type) 
-       SELECT id, 
-              floor(id/2),
-              random_email(),
-              random_email_type('{personal,work}'::email_type[]) 
-       FROM generate_series(2,  """ + str(2*rows_num) + """) AS gs(id);"""
-
-    cur.execute(sql)
-    conn.commit()
-
-    sql = """INSERT INTO phones(id, user_id, number, type) 
-       SELECT id, 
-              floor(id/2),
-              random_string(19, '0123456789'),
-              random_phone_type('{mobile,city}'::phone_type[])
-       FROM generate_series(2,  """ + str(2*rows_num) + """) AS gs(id);"""
-
-    cur.execute(sql)
-    conn.commit()
-
-    cur.close()
-    conn.close()
+import random
+import string
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_access_layer import DB  # noqa: E402
+from db_settings import DB_TABLES  # noqa: E402
+
+TABLES = ('users', 'emails', 'phones')
+USER_COLUMNS = ['id'] + DB_TABLES['users']['required']
+CHILD_COLUMNS = {
+    'emails': ['id', 'user_id', 'type', 'email', 'email_normalized'],
+    'phones': ['id', 'user_id', 'type', 'number', 'number_normalized'],
+}
+NAME_LENGTH = (5, 70)
+ADDRESS_LENGTH = (20, 150)
+BORN_AT = (datetime.date(1940, 1, 1).toordinal(), datetime.date(2019, 12, 31).toordinal())
+# Formats accepted by validation rules of phones, 'd' is replaced with a random digit
+PHONE_FORMATS = {
+    'mobile': ['+7 9dd ddd-dd-dd', '89ddddddddd', '+79ddddddddd', '+375 dd ddd-dd-dd', '+1 ddd ddd dddd'],
+    'city': ['ddd-dd-dd', 'ddddddd', 'ddd-ddd-dddd'],
+}
+EMAIL_DOMAINS = ['gmail.com', 'mail.ru', 'yandex.ru', 'yahoo.com', 'outlook.com', 'example.org']
+EMAIL_CHARS = string.ascii_lowercase + string.digits + '._'
+
+# Set in each worker process by init_worker
+db = None
+
+
+def init_worker():
+    global db
+    db = DB()
+
+
+def chunk_random(seed, chunk, part):
+    # Every chunk has its own random generators, so data doesn't depend on the number of workers
+    return random.Random('{}-{}-{}'.format(seed, chunk, part))
+
+
+def children_count(rnd, mean, max_count):
+    """
+    Number of children of a user: geometric distribution with the given mean, so that most users
+    have few children and some have many.
+    """
+    if mean <= 0:
+        return 0
+    p = 1 / (mean + 1)
+    count = 0
+    while count < max_count and rnd.random() > p:
+        count += 1
+    return count
+
+
+def chunk_counts(args, chunk):
+    """
+    Draw numbers of emails and phones of every user of the chunk.
+    :return: dict {table name: list of counts in order of users}.
+    """
+    rnd = chunk_random(args.seed, chunk, 'counts')
+    size = min(args.chunk_size, args.users - chunk * args.chunk_size)
+    counts = {'emails': [], 'phones': []}
+    for _ in range(size):
+        counts['emails'].append(children_count(rnd, args.emails_per_user, args.max_children))
+        counts['phones'].append(children_count(rnd, args.phones_per_user, args.max_children))
+    return counts
+
+
+def count_children(task):
+    args, chunk = task
+    return {table_name: sum(counts) for table_name, counts in chunk_counts(args, chunk).items()}
+
+
+def random_name(rnd, skew):
+    # skew > 1 makes short names more frequent, skew < 1 long ones
+    length = NAME_LENGTH[0] + int((NAME_LENGTH[1] - NAME_LENGTH[0]) * rnd.random() ** skew)
+    letters = rnd.choices(string.ascii_lowercase, k=length)
+    space = rnd.randint(2, length - 3)
+    return '{} {}'.format(''.join(letters[:space]).capitalize(), ''.join(letters[space + 1:]).capitalize())
+
+
+def random_address(rnd):
+    length = rnd.randint(*ADDRESS_LENGTH)
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(''.join(rnd.choices(string.ascii_letters + string.digits, k=rnd.randint(2, 12))))
+    return ' '.join(words)[:length].strip()
+
+
+def random_phone(rnd, phone_type):
+    phone_format = rnd.choice(PHONE_FORMATS[phone_type])
+    number = ''.join(rnd.choice(string.digits) if char == 'd' else char for char in phone_format)
+    return number, ''.join(char for char in number if char.isdigit())
+
+
+def random_email(rnd, mixed_case):
+    local = rnd.choice(string.ascii_lowercase) + ''.join(rnd.choices(EMAIL_CHARS, k=rnd.randint(4, 20)))
+    email = '{}@{}'.format(local, rnd.choice(EMAIL_DOMAINS))
+    if rnd.random() < mixed_case:
+        # Same address in another case, it is found by the normalized column
+        email = email.capitalize()
+    return email, email.strip().lower()
+
+
+def generate_chunk(args, chunk, child_offsets):
+    """
+    Build csv data of users of the chunk with their emails and phones.
+    :param child_offsets: dict {table name: id of the first child record of the chunk}.
+    :return: dict {table name: csv file-like object}.
+    """
+    rnd = chunk_random(args.seed, chunk, 'records')
+    counts = chunk_counts(args, chunk)
+    files = {table_name: io.StringIO() for table_name in TABLES}
+    writers = {table_name: csv.writer(file) for table_name, file in files.items()}
+    child_ids = dict(child_offsets)
+    first_user_id = args.start_id + chunk * args.chunk_size
+    for i in range(len(counts['emails'])):
+        user_id = first_user_id + i
+        writers['users'].writerow([
+            user_id,
+            random_name(rnd, args.name_skew),
+            '{}.jpg'.format(hashlib.md5('path{}'.format(user_id).encode()).hexdigest()),
+            rnd.choice(('male', 'female')),
+            datetime.date.fromordinal(rnd.randint(*BORN_AT)).isoformat(),
+            random_address(rnd),
+        ])
+        for _ in range(counts['emails'][i]):
+            email, email_normalized = random_email(rnd, args.mixed_case)
+            writers['emails'].writerow([child_ids['emails'], user_id, rnd.choice(('personal', 'work')),
+                                        email, email_normalized])
+            child_ids['emails'] += 1
+        for _ in range(counts['phones'][i]):
+            phone_type = rnd.choice(('mobile', 'city'))
+            number, number_normalized = random_phone(rnd, phone_type)
+            writers['phones'].writerow([child_ids['phones'], user_id, phone_type, number, number_normalized])
+            child_ids['phones'] += 1
+    for file in files.values():
+        file.seek(0)
+    return files
+
+
+def load_chunk(task):
+    """
+    Generate and load a chunk with 'COPY FROM STDIN' in one transaction of the worker.
+    :return: dict {table name: number of loaded records}.
+    """
+    args, chunk, child_offsets = task
+    files = generate_chunk(args, chunk, child_offsets)
+    loaded = {}
+    with db.transaction() as conn:
+        with conn.cursor() as cursor:
+            # Generated data can be regenerated, so commits don't wait for the wal to be flushed
+            cursor.execute('SET LOCAL synchronous_commit = off;')
+        loaded['users'] = db.copy_from('users', USER_COLUMNS, files['users'])
+        for table_name in CHILD_COLUMNS:
+            loaded[table_name] = db.copy_from(table_name, CHILD_COLUMNS[table_name], files[table_name])
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate users with emails and phones for load testing. '
+                                                 'The same arguments give the same data.')
+    parser.add_argument('--users', type=int, default=500, help='number of users')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='users generated and loaded at once')
+    parser.add_argument('--emails-per-user', type=float, default=2, help='mean number of emails of a user')
+    parser.add_argument('--phones-per-user', type=float, default=2, help='mean number of phones of a user')
+    parser.add_argument('--max-children', type=int, default=20, help='max number of emails (phones) of a user')
+    parser.add_argument('--name-skew', type=float, default=2,
+                        help='> 1 - short names are more frequent, < 1 - long ones, 1 - uniform')
+    parser.add_argument('--mixed-case', type=float, default=0.1, help='part of emails written in mixed case')
+    parser.add_argument('--start-id', type=int, default=None,
+                        help='id of the first user and first email and phone, the next free ids by default')
+    parser.add_argument('--truncate', action='store_true', help='remove all users, emails and phones first')
+    args = parser.parse_args()
+
+    main_db = DB()
+    with main_db.transaction() as conn:
+        with conn.cursor() as cursor:
+            if args.truncate:
+                cursor.execute('TRUNCATE {} RESTART IDENTITY CASCADE;'.format(', '.join(TABLES)))
+            cursor.execute('SELECT {};'.format(', '.join(
+                '(SELECT COALESCE(max(id), 0) FROM {0}) AS {0}'.format(table_name) for table_name in TABLES)))
+            max_ids = dict(zip(TABLES, cursor.fetchone()))
+    # Connections are not shared with forked workers
+    main_db.close()
+    if args.start_id is None:
+        args.start_id = max(max_ids.values()) + 1
+
+    started_at = time.time()
+    chunks = range((args.users + args.chunk_size - 1) // args.chunk_size)
+    with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+        # Ids of emails and phones are known before loading: first count children of every chunk
+        totals = pool.map(count_children, [(args, chunk) for chunk in chunks])
+        tasks = []
+        child_offsets = {table_name: args.start_id for table_name in CHILD_COLUMNS}
+        for chunk, chunk_totals in zip(chunks, totals):
+            tasks.append((args, chunk, dict(child_offsets)))
+            for table_name in CHILD_COLUMNS:
+                child_offsets[table_name] += chunk_totals[table_name]
+        loaded = {table_name: 0 for table_name in TABLES}
+        for chunk_loaded in pool.imap_unordered(load_chunk, tasks):
+            for table_name, count in chunk_loaded.items():
+                loaded[table_name] += count
+            print('{users} users, {emails} emails, {phones} phones loaded'.format(**loaded))
+
+    # Records are loaded with explicit ids, sequences are moved past them
+    with main_db.transaction() as conn:
+        with conn.cursor() as cursor:
+            for table_name in TABLES:
+                cursor.execute('SELECT setval(pg_get_serial_sequence(%s, \'id\'), '
+                               'GREATEST((SELECT max(id) FROM {}), 1));'.format(table_name), (table_name,))
+            cursor.execute('ANALYZE {};'.format(', '.join(TABLES)))
+    main_db.close()
+    print('Done in {:.1f} s'.format(time.time() - started_at))
 
 
 if __name__ == '__main__':
-    generate_rows()
+    main()
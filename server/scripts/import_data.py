@@ -0,0 +1,29 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bulk_io  # noqa: E402
+from settings import IMPORT_BATCH_SIZE  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import users with nested emails and phones from csv or ndjson.')
+    parser.add_argument('path', help='path to the file, "-" for stdin')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    file = sys.stdin if args.path == '-' else open(args.path, encoding='utf-8', newline='')
+    try:
+        result = bulk_io.import_users(lines=file, data_format=args.format, batch_size=args.batch_size)
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,44 @@
-DEBUG = True
+import os
+
+DEBUG = os.environ.get('DEBUG', 'False') == 'True'
 PORT = 8000
 HOST = '0.0.0.0'
 UPLOAD_FOLDER = './users/photos/'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 2000
+DB_POOL_MIN_SIZE = 2
+DB_POOL_MAX_SIZE = 20
+DB_POOL_TIMEOUT = 5   # seconds to wait for a free connection
+DB_POOL_HEALTH_CHECK_INTERVAL = 30   # seconds a connection may stay idle without a check
+IMPORT_BATCH_SIZE = 5000
+EXPORT_QUEUE_SIZE = 64   # chunks buffered between db and response
+EXPORT_CHUNK_SIZE = 64 * 1024
+CACHE_MAX_SIZE = 10000   # cached single records
+CACHE_TTL = 60   # seconds
+CACHE_INVALIDATION_CHANNEL = 'record_changes'
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+SEARCH_MIN_LENGTH = 3   # trigram index can't serve shorter text
+SEARCH_CANDIDATES = 200   # best matches taken from each searchable column
+DB_PREPARE_STATEMENTS = True   # run repeated point queries as server-side prepared statements
+DB_STATEMENT_CACHE_SIZE = 1000   # statement templates kept by a process, the least recently used are dropped
+DB_PREPARED_PER_CONNECTION = 200   # prepared statements of a connection, the least recently used are deallocated
+BATCH_MAX_OPERATIONS = 1000   # operations of one batch request
+SLOW_QUERY_THRESHOLD = None   # seconds, slower statements are logged with their plan, None - disabled
+SLOW_QUERY_EXPLAIN_INTERVAL = 60   # seconds between captured plans of one statement shape
+FILTER_MAX_VALUES = 1000   # values of an 'in' filter of lists
+FILTER_MAX_COUNT = 8   # filters of a list
+PHOTO_WORKERS = 4   # background threads finalizing and removing photo files
+PHOTO_CHUNK_SIZE = 64 * 1024
+PHOTO_ORPHAN_GRACE = 24 * 60 * 60   # seconds an unreferenced photo file is kept
+PHOTO_CLEANUP_INTERVAL = 6 * 60 * 60   # seconds
+PHOTO_RENDITIONS = {'small': 64, 'medium': 256}   # max width and height of downscaled photos, pixels
+PHOTO_RENDITION_QUALITY = 85   # jpeg quality of downscaled photos
+PHOTO_MAX_AGE = 365 * 24 * 60 * 60   # seconds photos of content-addressed urls are cached by clients
+PHOTO_MUTABLE_MAX_AGE = 60   # seconds other photo responses are cached by clients
+SYNC_PAGE_SIZE = 1000   # max changes in a response of the sync endpoint
+# Directory shared by the processes of the server to sum their metrics, None - /metrics shows the answering process
+METRICS_DIRECTORY = os.environ.get('METRICS_DIRECTORY') or None
+METRICS_FLUSH_INTERVAL = 5   # seconds between writes of metrics of a process to the directory
@@ -0,0 +1,100 @@
+import base64
+import json
+
+from business_logic import db
+from settings import SYNC_PAGE_SIZE
+
+# Changes are sent in this order: a record deleted and created again with the same id is deleted first,
+# users come before their emails and phones
+SYNC_STAGES = ('deleted', 'users', 'emails', 'phones')
+TOMBSTONES_TABLE = 'sync_tombstones'
+
+
+def encode_token(state):
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_token(token):
+    """
+    :param token: str, token of a previous response.
+    :return: dict {'since': watermark of the previous sync, 'until': watermark of this sync or None if it is not
+    started, 'stage': stage being read, 'after': [change_txid, id] of the last sent change of the stage or None},
+    None if the token is invalid.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token.encode()))
+        since, until, stage, after = state['since'], state['until'], state['stage'], state['after']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not is_int(since) or not (until is None or is_int(until)) or not (stage is None or stage in SYNC_STAGES):
+        return None
+    if after is not None and not (isinstance(after, list) and len(after) == 2 and all(map(is_int, after))):
+        return None
+    return {'since': since, 'until': until, 'stage': stage, 'after': after}
+
+
+def read_stage(stage, state, limit):
+    """
+    Changes of a stage made by transactions in [since, until), in (change_txid, id) order after the token.
+    :return: list of changes, at most limit + 1 to know if the stage has more.
+    """
+    table_name = TOMBSTONES_TABLE if stage == 'deleted' else stage
+    records = db.select(table_name=table_name, columns='*', order=('change_txid', 'asc'), limit=limit + 1,
+                        after=state['after'], filters=[('change_txid', 'range', (state['since'], state['until'] - 1))])
+    if stage == 'deleted':
+        # id None - all records of the table are deleted
+        return [{'table': record['table_name'], 'id': record['record_id'], 'change_txid': record['change_txid'],
+                 'tombstone_id': record['id']} for record in records]
+    return records
+
+
+def get_changes(token=None, limit=None):
+    """
+    Records created, updated and deleted since the sync of the token, page by page.
+    The watermark is the xmin of a snapshot: transactions before it are finished, so no change
+    can appear below it later, and every change is sent once.
+    :param token: str, 'next' token of the previous response, None for the first sync (all records).
+    :param limit: int, max number of changes in the response.
+    :return: dict with lists of changes by stage ('deleted' - list of {'table', 'id'}), 'next' token and
+    'done' - False if there are more pages of this sync.
+    """
+    limit = SYNC_PAGE_SIZE if limit is None else min(max(limit, 1), SYNC_PAGE_SIZE)
+    if token:
+        state = decode_token(token)
+        if state is None:
+            return {'info': 'Invalid token'}
+    else:
+        state = {'since': 0, 'until': None, 'stage': None, 'after': None}
+    changes = {stage: [] for stage in SYNC_STAGES}
+    done = True
+    with db.transaction():
+        if state['until'] is None:
+            state['until'] = max(db.snapshot_xmin(), state['since'])
+            # Nothing is deleted before the first sync
+            state['stage'] = SYNC_STAGES[0] if state['since'] else SYNC_STAGES[1]
+            state['after'] = None
+        for stage in SYNC_STAGES[SYNC_STAGES.index(state['stage']):]:
+            remaining = limit - sum(len(stage_changes) for stage_changes in changes.values())
+            state['stage'] = stage
+            records = read_stage(stage, state, remaining)
+            if len(records) > remaining:
+                records = records[:remaining]
+                changes[stage] = records
+                key = 'tombstone_id' if stage == 'deleted' else 'id'
+                state['after'] = [records[-1]['change_txid'], records[-1][key]] if records else state['after']
+                done = False
+                break
+            changes[stage] = records
+            state['after'] = None
+    for change in changes['deleted']:
+        del change['tombstone_id']
+    if done:
+        # The next sync starts from the watermark of this one
+        state = {'since': state['until'], 'until': None, 'stage': None, 'after': None}
+    changes['next'] = encode_token(state)
+    changes['done'] = done
+    return changes
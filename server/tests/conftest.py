@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of the server are imported by their names, as the server imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,62 @@
+from batch import check_operation, group_operations
+
+EMAIL = {'user_id': 1, 'type': 'work', 'email': 'a@b.cd'}
+
+
+def test_valid_operations():
+    assert check_operation({'op': 'create', 'table': 'emails', 'data': dict(EMAIL)}) == {}
+    assert check_operation({'op': 'update', 'table': 'emails', 'id': 3, 'data': {'type': 'personal'}}) == {}
+    assert check_operation({'op': 'delete', 'table': 'users', 'id': 3}) == {}
+
+
+def test_operation_shape():
+    assert 'operation' in check_operation([])
+    assert 'op' in check_operation({'op': 'upsert', 'table': 'emails'})
+    assert 'table' in check_operation({'op': 'delete', 'table': 'accounts', 'id': 1})
+    for record_id in (None, '3', True):
+        assert 'id' in check_operation({'op': 'delete', 'table': 'emails', 'id': record_id}), record_id
+    assert 'data' in check_operation({'op': 'update', 'table': 'emails', 'id': 3, 'data': {}})
+
+
+def test_unknown_fields():
+    errors = check_operation({'op': 'create', 'table': 'emails', 'data': dict(EMAIL, **{'id) --': 1})})
+    assert errors == {'id) --': 'Email has no id) -- field'}
+    errors = check_operation({'op': 'update', 'table': 'phones', 'id': 3, 'data': {'number_normalized': '1'}})
+    assert list(errors) == ['number_normalized']
+
+
+def test_photo_path_and_foreign_key():
+    errors = check_operation({'op': 'update', 'table': 'users', 'id': 3, 'data': {'photo_path': '../x'}})
+    assert list(errors) == ['photo_path']
+    errors = check_operation({'op': 'create', 'table': 'emails', 'data': dict(EMAIL, user_id='1')})
+    assert errors == {'user_id': '\'user_id\' field should be an integer'}
+
+
+def test_validation_of_data():
+    errors = check_operation({'op': 'create', 'table': 'emails', 'data': dict(EMAIL, type='home')})
+    assert list(errors) == ['type']
+    errors = check_operation({'op': 'create', 'table': 'emails', 'data': {'user_id': 1, 'type': 'work'}})
+    assert errors == {'fields': 'Not enough email record fields'}
+
+
+def test_group_operations():
+    operations = [
+        {'op': 'create', 'table': 'emails', 'data': dict(EMAIL)},
+        {'op': 'create', 'table': 'emails', 'data': dict(EMAIL)},
+        {'op': 'create', 'table': 'phones', 'data': {'user_id': 1, 'type': 'mobile', 'number': '1234567'}},
+        {'op': 'update', 'table': 'emails', 'id': 1, 'data': {'type': 'work'}},
+        {'op': 'update', 'table': 'emails', 'id': 2, 'data': {'type': 'work'}},
+        {'op': 'delete', 'table': 'emails', 'id': 1},
+        {'op': 'delete', 'table': 'emails', 'id': 2},
+        {'op': 'delete', 'table': 'phones', 'id': 1},
+        {'op': 'create', 'table': 'emails', 'data': dict(EMAIL)},
+    ]
+    assert group_operations(operations) == [
+        ('create', 'emails', [0, 1]),
+        ('create', 'phones', [2]),
+        ('update', 'emails', [3]),
+        ('update', 'emails', [4]),
+        ('delete', 'emails', [5, 6]),
+        ('delete', 'phones', [7]),
+        ('create', 'emails', [8]),
+    ]
@@ -0,0 +1,85 @@
+import time
+
+from cache import RecordCache
+
+
+def test_get_set_and_variants():
+    cache = RecordCache(max_size=10, ttl=60)
+    assert cache.get('users', 1) is None
+    cache.set('users', 1, [{'id': 1}])
+    cache.set('users', 1, [{'id': 1, 'emails': []}], variant=('emails',))
+    assert cache.get('users', 1) == [{'id': 1}]
+    assert cache.get('users', 1, ('emails',)) == [{'id': 1, 'emails': []}]
+    assert cache.get('users', 1, ('phones',)) is None
+    stats = cache.stats()
+    assert (stats['size'], stats['hits'], stats['misses']) == (1, 2, 2)
+
+
+def test_lru_eviction():
+    cache = RecordCache(max_size=2, ttl=60)
+    cache.set('users', 1, 'a')
+    cache.set('users', 2, 'b')
+    cache.get('users', 1)
+    cache.set('users', 3, 'c')
+    assert cache.get('users', 2) is None
+    assert cache.get('users', 1) == 'a'
+    assert cache.get('users', 3) == 'c'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl(monkeypatch):
+    cache = RecordCache(max_size=10, ttl=60)
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cache.set('users', 1, 'a')
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert cache.get('users', 1) is None
+    assert cache.stats()['size'] == 0
+
+
+def test_invalidate_cascade():
+    cache = RecordCache(max_size=10, ttl=60)
+    cache.set('users', 1, 'user')
+    cache.set('emails', 5, 'email', parent=('users', 1))
+    cache.set('emails', 6, 'other email', parent=('users', 2))
+    cache.invalidate('users', 1)
+    assert cache.get('users', 1) is None
+    assert cache.get('emails', 5) == 'email'
+    cache.set('users', 1, 'user')
+    cache.invalidate('users', 1, cascade=True)
+    assert cache.get('emails', 5) is None
+    assert cache.get('emails', 6) == 'other email'
+
+
+def test_generation_drops_stale_values():
+    cache = RecordCache(max_size=10, ttl=60)
+    generation = cache.generation('users', 1)
+    # The record is changed between the select and set() of the value selected before
+    cache.invalidate('users', 1)
+    assert not cache.set('users', 1, 'stale', generation=generation)
+    assert cache.get('users', 1) is None
+    generation = cache.generation('users', 1)
+    assert cache.set('users', 1, 'fresh', generation=generation)
+    assert cache.get('users', 1) == 'fresh'
+
+
+def test_cascade_and_clear_change_generation_of_all_records():
+    cache = RecordCache(max_size=10, ttl=60)
+    generation = cache.generation('emails', 5)
+    cache.invalidate('users', 1, cascade=True)
+    assert not cache.set('emails', 5, 'stale', generation=generation)
+    generation = cache.generation('emails', 5)
+    cache.clear()
+    assert not cache.set('emails', 5, 'stale', generation=generation)
+
+
+def test_peek_is_not_counted():
+    cache = RecordCache(max_size=2, ttl=60)
+    cache.set('users', 1, 'a')
+    cache.set('users', 2, 'b')
+    assert cache.peek('users', 1) == 'a'
+    assert cache.peek('users', 3) is None
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (0, 0)
+    # Peeked records aren't made recently used
+    cache.set('users', 3, 'c')
+    assert cache.peek('users', 1) is None
@@ -0,0 +1,42 @@
+import base64
+import datetime
+import json
+
+from business_logic import decode_cursor, encode_cursor
+
+
+def make_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def test_round_trip():
+    cursor = encode_cursor('name', {'id': 7, 'name': 'Anna Smith'})
+    assert decode_cursor(cursor, 'name', 'users') == ('Anna Smith', 7)
+
+
+def test_dates_are_sent_as_strings():
+    cursor = encode_cursor('born_at', {'id': 7, 'born_at': datetime.date(1990, 5, 17)})
+    assert decode_cursor(cursor, 'born_at', 'users') == ('1990-05-17', 7)
+
+
+def test_null_values_of_nullable_columns():
+    cursor = encode_cursor('email', {'id': 7, 'email': None})
+    assert decode_cursor(cursor, 'email', 'emails') == (None, 7)
+    assert decode_cursor(make_cursor('name', None, 7), 'name', 'users') is None
+
+
+def test_cursor_of_another_order():
+    cursor = encode_cursor('name', {'id': 7, 'name': 'Anna Smith'})
+    assert decode_cursor(cursor, 'id', 'users') is None
+    assert decode_cursor(make_cursor('address', 'Main street', 7), 'address', 'users') is None
+
+
+def test_malformed_cursor():
+    for cursor in ('', 'not base64!', 'W10=', 'e30='):
+        assert decode_cursor(cursor, 'id', 'users') is None, cursor
+
+
+def test_tampered_values():
+    for value, record_id in ((['a'], 7), ({'a': 1}, 7), (True, 7), ('Anna Smith', '7'), ('Anna Smith', 7.5),
+                             ('Anna Smith', None), ('Anna Smith', [7])):
+        assert decode_cursor(make_cursor('name', value, record_id), 'name', 'users') is None, (value, record_id)
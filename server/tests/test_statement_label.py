@@ -0,0 +1,16 @@
+from db_access_layer import statement_label
+
+
+def test_multi_row_inserts_have_one_label():
+    label = statement_label('INSERT INTO emails (user_id,type,email) VALUES %s RETURNING id;')
+    for rows in (2, 3, 1000):
+        query = 'INSERT INTO emails (user_id,type,email) VALUES {} RETURNING id;'.format(','.join(['%s'] * rows))
+        assert statement_label(query) == label, rows
+    query = 'INSERT INTO emails (user_id,type,email) VALUES {} RETURNING id;'.format(','.join(['(%s,%s,%s)'] * 5))
+    assert statement_label(query) == statement_label(query.replace(',(%s,%s,%s)', '', 3))
+
+
+def test_label_of_statement():
+    label = statement_label('SELECT * FROM users WHERE id = %s;')
+    assert label.startswith('select users ')
+    assert label != statement_label('SELECT * FROM users WHERE name = %s;')
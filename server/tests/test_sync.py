@@ -0,0 +1,22 @@
+from sync import decode_token, encode_token
+
+STATE = {'since': 100, 'until': 200, 'stage': 'emails', 'after': [150, 7]}
+
+
+def test_round_trip():
+    assert decode_token(encode_token(STATE)) == STATE
+    first = {'since': 0, 'until': None, 'stage': None, 'after': None}
+    assert decode_token(encode_token(first)) == first
+
+
+def test_invalid_values():
+    for change in ({'since': '100'}, {'since': True}, {'until': 1.5}, {'stage': 'accounts'},
+                   {'after': [150]}, {'after': [150, '7']}, {'after': {'id': 7}}):
+        assert decode_token(encode_token(dict(STATE, **change))) is None, change
+
+
+def test_malformed_token():
+    state = dict(STATE)
+    del state['after']
+    for token in ('', 'not base64!', 'W10=', encode_token(state)):
+        assert decode_token(token) is None, token
@@ -0,0 +1,83 @@
+from validation import compile_rule, validate_batch, validate_data
+
+USER = {'name': 'Anna Smith', 'photo_path': '', 'gender': 'female', 'born_at': '1990-05-17',
+        'address': 'Main street 1, Springfield'}
+USER_COLUMNS = ['name', 'photo_path', 'gender', 'born_at', 'address']
+
+
+def test_valid_user():
+    assert validate_data(data=dict(USER), columns=USER_COLUMNS, table_name='users') == (True, {})
+
+
+def test_null_rule():
+    check = compile_rule({'VALID_TYPE': 'NULL', 'CONDITION': False}, 'user_id')
+    assert check(1) is None
+    assert check(None) == '\'user_id\' field shouldn\'t be null.'
+    is_valid, errors = validate_data(data={'user_id': None, 'type': 'work', 'email': 'a@b.cd'},
+                                     columns=['user_id', 'type', 'email'], table_name='emails')
+    assert not is_valid and list(errors) == ['user_id']
+
+
+def test_in_range_rule():
+    is_valid, errors = validate_data(data=dict(USER, gender='other'), columns=USER_COLUMNS, table_name='users')
+    assert not is_valid
+    assert errors == {'gender': '\'gender\' field should be one of this values: [male, female]'}
+
+
+def test_date_rule():
+    for born_at in ('1990-13-01', '1890-01-01', '01.02.1990', 19900101):
+        is_valid, errors = validate_data(data=dict(USER, born_at=born_at), columns=USER_COLUMNS, table_name='users')
+        assert errors == {'born_at': 'Invalid \'born_at\' field format'}, born_at
+    assert validate_data(data=dict(USER, born_at='2019-1-9'), columns=USER_COLUMNS, table_name='users')[0]
+
+
+def test_regular_rule():
+    phone = {'user_id': 1, 'type': 'mobile', 'number': '+7 912 345-67-89'}
+    assert validate_data(data=phone, columns=list(phone), table_name='phones') == (True, {})
+    is_valid, errors = validate_data(data=dict(phone, number='12-ab'), columns=list(phone), table_name='phones')
+    assert errors == {'number': 'Invalid \'number\' field format'}
+    is_valid, errors = validate_data(data={'user_id': 1, 'type': 'work', 'email': 'not an email'},
+                                     columns=['user_id', 'type', 'email'], table_name='emails')
+    assert errors == {'email': 'Invalid \'email\' field format'}
+
+
+def test_str_len_rule():
+    message = '\'name\' field must be 5 characters or longer and 70 characters and less in length.'
+    for name in ('Ann', 'A' * 71):
+        is_valid, errors = validate_data(data=dict(USER, name=name), columns=USER_COLUMNS, table_name='users')
+        assert errors['name'] == message, name
+    is_valid, errors = validate_data(data=dict(USER, photo_path='p' * 251), columns=USER_COLUMNS,
+                                     table_name='users')
+    assert list(errors) == ['photo_path']
+
+
+def test_is_digit_rule():
+    is_valid, errors = validate_data(data=dict(USER, name='Anna 2nd'), columns=USER_COLUMNS, table_name='users')
+    assert errors == {'name': '\'name\' field must not contain numbers.'}
+    check = compile_rule({'VALID_TYPE': 'IS_DIGIT', 'CONDITION': True}, 'code')
+    assert check('a1') is None
+    assert check('ab') == '\'code\' field must contain numbers.'
+
+
+def test_missing_and_unknown_fields():
+    data = dict(USER)
+    del data['address']
+    is_valid, errors = validate_data(data=data, columns=USER_COLUMNS, table_name='users')
+    assert errors == {'fields': 'Not enough user record fields'}
+    is_valid, errors = validate_data(data=dict(USER, id=1), columns=['name', 'id'], table_name='users')
+    assert errors == {'id': 'User has no id field', 'fields': 'Not enough user record fields'}
+
+
+def test_validate_batch_errors_by_row():
+    records = [dict(USER), dict(USER, gender='other'), dict(USER), dict(USER, name='Ann', born_at='')]
+    errors = validate_batch(records, 'users')
+    assert list(errors) == [1, 3]
+    assert list(errors[1]) == ['gender']
+    assert sorted(errors[3]) == ['born_at', 'name']
+    assert validate_batch([dict(USER)], 'users') == {}
+
+
+def test_validate_batch_columns():
+    emails = [{'type': 'work', 'email': 'a@b.cd'}, {'type': 'home', 'email': 'a@b.cd'}]
+    assert validate_batch(emails, 'emails', columns=['type', 'email']) == {
+        1: {'type': '\'type\' field should be one of this values: [personal, work]'}}
@@ -1,18 +1,169 @@
-from flask import Blueprint, request
+import time
+from urllib.parse import unquote_plus
 
+from flask import Blueprint, Response, g, json, jsonify, redirect, request, send_file, stream_with_context, url_for
+
+import batch
 import business_logic as bl
-from settings import ALLOWED_EXTENSIONS
+import bulk_io
+import metrics
+import sync
+from db_settings import DB_TABLES
+from settings import ALLOWED_EXTENSIONS, STREAM_BATCH_SIZE, PHOTO_MAX_AGE, PHOTO_MUTABLE_MAX_AGE
 
 urls_blueprint = Blueprint('urls', __name__,)
 
+REQUEST_DURATION = metrics.Histogram('http_request_duration_seconds',
+                                     'Time of api requests by route (time to first byte of streamed responses).',
+                                     labelnames=('method', 'route', 'status'))
+REQUEST_EXCEPTIONS = metrics.Counter('http_request_exceptions_total', 'Api requests failed with an exception.',
+                                     labelnames=('method', 'route', 'error'))
+
+# Query params that are not a sort order
+RESERVED_PARAMS = ('limit', 'after', 'format', 'include', 'fields')
+# Filter params are named '<column>__<operator>'
+FILTER_SEPARATOR = '__'
+
+
+def get_route():
+    # Route rule, not the path, so that records of different ids have the same label
+    return request.url_rule.rule if request.url_rule is not None else 'unknown'
+
+
+@urls_blueprint.before_request
+def start_timer():
+    g.started_at = time.perf_counter()
+
+
+@urls_blueprint.after_request
+def record_request(response):
+    started_at = g.get('started_at')
+    if started_at is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started_at, method=request.method, route=get_route(),
+                                 status=response.status_code)
+    return response
+
+
+@urls_blueprint.teardown_request
+def record_exception(error=None):
+    if error is not None:
+        REQUEST_EXCEPTIONS.inc(method=request.method, route=get_route(), error=type(error).__name__)
+
 
 def get_first_param():
-    sort_by = None
-    if request.query_string:
-        first_param = request.query_string.decode('utf-8').split('&')[0]
-        first_param = first_param.split('=')
-        sort_by = (first_param[0], first_param[1])
-    return sort_by
+    """
+    Sort order of a list: the first query param that isn't reserved or a filter, e.g. '?name=asc'.
+    :return: (tuple (column, direction) or None, error message or None).
+    """
+    params = []
+    for param in request.query_string.decode('utf-8').split('&'):
+        if not param:
+            continue
+        name, separator, value = param.partition('=')
+        if not separator:
+            return None, 'Invalid query param \'{}\''.format(unquote_plus(name))
+        params.append((unquote_plus(name), unquote_plus(value)))
+    params = [(name, value) for name, value in params if name not in RESERVED_PARAMS and FILTER_SEPARATOR not in name]
+    return (params[0] if params else None), None
+
+
+def get_page_params():
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after')
+    return limit, after
+
+
+def get_include_param():
+    include = request.args.get('include')
+    return include.split(',') if include else None
+
+
+def get_fields_param():
+    fields = request.args.get('fields')
+    return fields.split(',') if fields else None
+
+
+def get_filter_params():
+    return [(param, value) for param, value in request.args.items(multi=True) if FILTER_SEPARATOR in param]
+
+
+def ndjson_lines(records):
+    # Send records as newline delimited json, a batch of lines per chunk
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record))
+        if len(lines) == STREAM_BATCH_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def conditional_response(data, etag=None):
+    """
+    Json response with an ETag (a hash of the body if etag is None), or 304 without a body
+    if it matches If-None-Match. Reads are POST requests, werkzeug's make_conditional handles only GET and HEAD.
+    """
+    response = jsonify(data)
+    if etag is None:
+        response.add_etag()
+    else:
+        response.set_etag(etag)
+    etag = response.get_etag()[0]
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    return response
+
+
+def record_response(table_name, record_id, include=None):
+    # A poll of an unchanged record that isn't cached is answered by the version of the record, without reading it.
+    # Otherwise the ETag is computed once from the cached or selected record, for the 304 check and the response
+    if request.if_none_match and not bl.is_record_cached(table_name, record_id, include):
+        etag = bl.get_record_etag(table_name, record_id, include)
+        if etag is not None and request.if_none_match.contains(etag):
+            return not_modified(etag)
+    sort_by, error = get_first_param()
+    if error is not None:
+        return {'info': error}, 400
+    result = bl.get_data(id=record_id, table_name=table_name, sort_by=sort_by, include=include)
+    records = result[DB_TABLES[table_name]['record_name']['singular']]
+    return conditional_response(result, bl.get_record_etag(table_name, record_id, include, records))
+
+
+def get_list(table_name):
+    sort_by, error = get_first_param()
+    if error is not None:
+        return {'info': error}, 400
+    include = get_include_param()
+    fields = get_fields_param()
+    filters = get_filter_params()
+    if request.args.get('format') == 'ndjson':
+        records = bl.stream_data(table_name=table_name, sort_by=sort_by, include=include, fields=fields,
+                                 filters=filters)
+        return Response(stream_with_context(ndjson_lines(records)), mimetype='application/x-ndjson')
+    limit, after = get_page_params()
+    return conditional_response(bl.get_data(table_name=table_name, sort_by=sort_by, limit=limit, after=after,
+                                            include=include, fields=fields, filters=filters))
+
+
+def export_response(table_name):
+    data_format = 'binary' if request.args.get('format') == 'binary' else 'csv'
+    embed = request.args.get('embed') == '1'
+    compress = request.args.get('gzip') == '1'
+    filename = '{}.{}'.format(table_name, 'bin' if data_format == 'binary' else 'csv')
+    mimetype = 'application/octet-stream' if data_format == 'binary' else 'text/csv'
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    chunks = bulk_io.stream_table(table_name=table_name, data_format=data_format, embed=embed, compress=compress)
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
 
 
 def allowed_file(filename):
@@ -35,6 +186,18 @@ def validate_photo_file(photo_file):
     return is_valid, errors
 
 
+def photo_response(photo):
+    # The file is sent with wsgi.file_wrapper (sendfile by gunicorn, or X-Sendfile with USE_X_SENDFILE)
+    if 'info' in photo:
+        return photo, 404
+    max_age = PHOTO_MAX_AGE if photo['immutable'] else PHOTO_MUTABLE_MAX_AGE
+    response = send_file(photo['path'], add_etags=False, cache_timeout=max_age)
+    response.set_etag(photo['etag'])
+    response.headers['Cache-Control'] = 'public, max-age={}{}'.format(max_age,
+                                                                     ', immutable' if photo['immutable'] else '')
+    return response.make_conditional(request)
+
+
 # ============= Users endpoints =============
 @urls_blueprint.route('/users/<int:user_id>/', methods=['DELETE'])
 def remove_user(user_id):
@@ -43,14 +206,22 @@ def remove_user(user_id):
 
 @urls_blueprint.route('/users/<int:user_id>/', methods=['POST'])
 def get_user(user_id):
-    sort_by = get_first_param()
-    return bl.get_data(id=user_id, table_name='users', sort_by=sort_by)
+    return record_response(table_name='users', record_id=user_id, include=get_include_param())
+
+
+@urls_blueprint.route('/users/<int:user_id>/photo/', methods=['GET'])
+def get_user_photo(user_id):
+    size = request.args.get('size')
+    photo = bl.get_user_photo(user_id=user_id, size=size)
+    if 'photo_path' in photo:
+        # Content-addressed url, the photo itself is cached by clients
+        return redirect(url_for('.get_photo', photo_path=photo['photo_path'], size=size))
+    return photo_response(photo)
 
 
 @urls_blueprint.route('/users/', methods=['POST'])
 def get_users_list():
-    sort_by = get_first_param()
-    return bl.get_data(table_name='users', sort_by=sort_by)
+    return get_list(table_name='users')
 
 
 @urls_blueprint.route('/users/', methods=['PUT'])
@@ -67,6 +238,19 @@ def create_user():
     return result
 
 
+@urls_blueprint.route('/users/export/', methods=['POST'])
+def export_users():
+    return export_response(table_name='users')
+
+
+@urls_blueprint.route('/users/import/', methods=['PUT'])
+def import_users():
+    # Body is csv or ndjson of users with nested emails and phones, it is read line by line
+    data_format = 'csv' if request.args.get('format') == 'csv' or request.mimetype == 'text/csv' else 'ndjson'
+    lines = (line.decode('utf-8') for line in request.stream)
+    return bulk_io.import_users(lines=lines, data_format=data_format)
+
+
 @urls_blueprint.route('/users/<int:user_id>/', methods=['PATCH'])
 def update_user(user_id):
     # Check if the request has the file part
@@ -90,16 +274,24 @@ def remove_email(email_id):
     return bl.remove_data(id=email_id, table_name='emails')
 
 
+@urls_blueprint.route('/emails/lookup/', methods=['POST'])
+def lookup_email_owner():
+    return bl.lookup_user(table_name='emails', value=request.args.get('email'))
+
+
 @urls_blueprint.route('/emails/<int:email_id>/', methods=['POST'])
 def get_email(email_id):
-    sort_by = get_first_param()
-    return bl.get_data(id=email_id, table_name='emails', sort_by=sort_by)
+    return record_response(table_name='emails', record_id=email_id)
 
 
 @urls_blueprint.route('/emails/', methods=['POST'])
 def get_emails_list():
-    sort_by = get_first_param()
-    return bl.get_data(table_name='emails', sort_by=sort_by)
+    return get_list(table_name='emails')
+
+
+@urls_blueprint.route('/emails/export/', methods=['POST'])
+def export_emails():
+    return export_response(table_name='emails')
 
 
 @urls_blueprint.route('/emails/', methods=['PUT'])
@@ -119,16 +311,24 @@ def remove_phone(phone_id):
     return bl.remove_data(id=phone_id, table_name='phones')
 
 
+@urls_blueprint.route('/phones/lookup/', methods=['POST'])
+def lookup_phone_owner():
+    return bl.lookup_user(table_name='phones', value=request.args.get('number'))
+
+
 @urls_blueprint.route('/phones/<int:phone_id>/', methods=['POST'])
 def get_phone(phone_id):
-    sort_by = get_first_param()
-    return bl.get_data(id=phone_id, table_name='phones', sort_by=sort_by)
+    return record_response(table_name='phones', record_id=phone_id)
 
 
 @urls_blueprint.route('/phones/', methods=['POST'])
 def get_phones_list():
-    sort_by = get_first_param()
-    return bl.get_data(table_name='phones', sort_by=sort_by)
+    return get_list(table_name='phones')
+
+
+@urls_blueprint.route('/phones/export/', methods=['POST'])
+def export_phones():
+    return export_response(table_name='phones')
 
 
 @urls_blueprint.route('/phones/', methods=['PUT'])
@@ -139,3 +339,49 @@ def create_phone():
 @urls_blueprint.route('/phones/<int:phone_id>/', methods=['PATCH'])
 def update_phone(phone_id):
     return bl.update_data(id=phone_id, data=request.form.to_dict(), table_name='phones')
+
+
+# ============= Batch endpoints =============
+
+@urls_blueprint.route('/batch/', methods=['POST'])
+def execute_batch():
+    # Body is a json object {"operations": [{"op": ..., "table": ..., "id": ..., "data": {...}}, ...]}
+    body = request.get_json(silent=True) or {}
+    return batch.execute_batch(operations=body.get('operations') if isinstance(body, dict) else None)
+
+
+# ============= Sync endpoints =============
+
+@urls_blueprint.route('/sync/', methods=['POST'])
+def get_changes():
+    # Changes since the 'next' token of the previous response, the first sync is started without a token
+    return sync.get_changes(token=request.args.get('token'), limit=request.args.get('limit', type=int))
+
+
+# ============= Photos endpoints =============
+
+@urls_blueprint.route('/photos/<path:photo_path>', methods=['GET'])
+def get_photo(photo_path):
+    # ?size=small|medium, the original photo by default
+    return photo_response(bl.get_photo(photo_path=photo_path, size=request.args.get('size')))
+
+
+# ============= Search endpoints =============
+
+@urls_blueprint.route('/search/', methods=['POST'])
+def search_users():
+    return bl.search_users(text=request.args.get('q'), limit=request.args.get('limit', type=int))
+
+
+# ============= Stats endpoints =============
+
+@urls_blueprint.route('/stats/', methods=['POST'])
+def get_stats():
+    return bl.get_stats()
+
+
+# ============= Cache endpoints =============
+
+@urls_blueprint.route('/cache/', methods=['POST'])
+def get_cache_stats():
+    return bl.get_cache_stats()
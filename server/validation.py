@@ -0,0 +1,104 @@
+import re
+
+import metrics
+from db_settings import DB_TABLES
+
+DIGITS = re.compile(r'\d+')
+
+VALIDATION_DURATION = metrics.Histogram('validation_duration_seconds', 'Time of validation of a record by table.',
+                                        labelnames=('table',))
+
+
+def compile_rule(context, column):
+    """
+    Build a check of one validation rule of DB_TABLES for a column.
+    :param context: dict with 'VALID_TYPE' and 'CONDITION' of the rule.
+    :param column: str, column name used in the error message.
+    :return: function that takes the field value and returns error message or None if the value is valid.
+    """
+    valid_type = context['VALID_TYPE']
+    condition = context['CONDITION']
+    if valid_type == 'NULL':
+        is_null = 'shouldn\'t' if not condition else 'should'
+        message = '\'{}\' field {} be null.'.format(column, is_null)
+        return lambda data: None if (data is None) is condition else message
+    if valid_type == 'IN_RANGE':
+        values = frozenset(condition)
+        message = '\'{}\' field should be one of this values: [{}]'.format(column, ', '.join(condition))
+        return lambda data: None if data in values else message
+    if valid_type == 'REGULAR':
+        match = re.compile(condition).match
+        message = 'Invalid \'{}\' field format'.format(column)
+        return lambda data: None if isinstance(data, str) and match(data) is not None else message
+    if valid_type == 'STR_LEN':
+        min_len, max_len = condition
+        message = '\'{}\' field must be {} characters or longer and {} characters and less in length.'.format(
+            column, min_len, max_len)
+        return lambda data: None if isinstance(data, str) and min_len <= len(data) <= max_len else message
+    if valid_type == 'IS_DIGIT':
+        not_str = '' if condition else 'not '
+        message = '\'{}\' field must {}contain numbers.'.format(column, not_str)
+        return lambda data: None if isinstance(data, str) and (DIGITS.search(data) is not None) == condition \
+            else message
+    raise ValueError('Unknown validation type {} of \'{}\' field'.format(valid_type, column))
+
+
+def compile_table(table_name):
+    """
+    Build a validator of records of a table from its DB_TABLES rules.
+    :param table_name: str, name of table.
+    :return: function that takes record data and columns to check and returns (is_valid, errors).
+    """
+    table = DB_TABLES[table_name]
+    required = frozenset(table['required'])
+    object_name = table['object_name']['singular']
+    not_enough = 'Not enough {} record fields'.format(table['record_name']['singular'])
+    rules = {column: [compile_rule(context, column) for context in contexts]
+             for column, contexts in table['validation'].items()}
+
+    def validate(data, columns):
+        errors = {}
+        for column in columns:
+            if column not in required:
+                errors[column] = '{} has no {} field'.format(object_name, column)
+            column_rules = rules.get(column)
+            if column_rules is None or column not in data:
+                errors['fields'] = not_enough
+                continue
+            value = data[column]
+            for rule in column_rules:
+                message = rule(value)
+                if message is not None:
+                    errors[column] = message
+        return not errors, errors
+
+    return validate
+
+
+# Validators are built once, on import
+VALIDATORS = {table_name: compile_table(table_name) for table_name in DB_TABLES}
+
+
+def validate_data(data, columns, table_name):
+    with VALIDATION_DURATION.time(table=table_name):
+        return VALIDATORS[table_name](data, columns)
+
+
+def validate_batch(records, table_name, columns=None):
+    """
+    Validate many records of a table.
+    :param records: list of dicts with records data.
+    :param table_name: str, name of table.
+    :param columns: columns to check, required columns of the table by default.
+    :return: dict of errors of invalid records by their index in records.
+    """
+    validate = VALIDATORS[table_name]
+    if columns is None:
+        columns = DB_TABLES[table_name]['required']
+    errors = {}
+    with VALIDATION_DURATION.time(table=table_name):
+        for i, record in enumerate(records):
+            is_valid, record_errors = validate(record, columns)
+            if not is_valid:
+                errors[i] = record_errors
+    return errors